@@ -0,0 +1,77 @@
+"""
+Benchmark of clonotypes_QC_fraction.create_clonotype_fraction_df on synthetic contigs (~2 contigs per cell)
+
+	python benchmarks/bench_qc_fraction.py
+	python benchmarks/bench_qc_fraction.py --sizes 100000 1000000 4000000 --baseline_size 20000
+
+The baseline (per-barcode loop of the original implementation) is timed on a small frame only,
+its per-cell pairing types are checked against the vectorized version
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from clonotype_analyses.compute import clonotypes_QC_fraction
+from clonotype_analyses.common.constants import PAIRING_TYPES
+
+
+def make_contigs(n_contigs, seed=0):
+	rng = np.random.default_rng(seed)
+	cells = np.sort(rng.integers(0, n_contigs // 2, n_contigs))
+	return pd.DataFrame(
+		{
+			'chain': rng.choice(['TRA', 'TRB', 'TRG'], n_contigs, p=[0.45, 0.5, 0.05]),
+			'Condition': np.where(cells % 2 == 0, 'AML', 'Normal'),
+		},
+		index=np.char.add('BC', cells.astype(str))
+	)
+
+
+def baseline_pairing_types(VDJ_10X):
+	"""
+	Original implementation: one scan of all contigs per barcode, O(cells x contigs)
+	"""
+	all_cells = VDJ_10X.index.unique()
+	pairing = []
+	for bc in all_cells:
+		chains = VDJ_10X['chain'].values[VDJ_10X.index.values == bc]
+		key = '{} TRA - {} TRB'.format(np.sum(chains == 'TRA'), np.sum(chains == 'TRB'))
+		pairing.append(key if key in PAIRING_TYPES else 'others')
+	return pd.Series(pairing, index=all_cells)
+
+
+def _timed(func, *args):
+	start = time.perf_counter()
+	res = func(*args)
+	return res, time.perf_counter() - start
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark create_clonotype_fraction_df')
+	parser.add_argument('--sizes', type=int, nargs='*', default=[100000, 1000000, 4000000])
+	parser.add_argument('--baseline_size', type=int, default=20000, help='0: skip the baseline')
+	args = parser.parse_args()
+
+	if args.baseline_size:
+		contigs_df = make_contigs(args.baseline_size)
+		expected, elapsed = _timed(baseline_pairing_types, contigs_df)
+		print('baseline loop, {} contigs: {:.2f} s'.format(args.baseline_size, elapsed))
+		fraction_clo_df, _ = clonotypes_QC_fraction.create_clonotype_fraction_df(contigs_df)
+		pairing = fraction_clo_df[list(PAIRING_TYPES)].idxmax(axis=1)
+		if not (pairing.values == expected.loc[pairing.index].values).all():
+			raise Exception('vectorized pairing types differ from the baseline')
+
+	for n_contigs in args.sizes:
+		contigs_df = make_contigs(n_contigs)
+		_, elapsed = _timed(clonotypes_QC_fraction.create_clonotype_fraction_df, contigs_df)
+		print('vectorized, {} contigs: {:.3f} s ({:.0f} ns / contig)'.format(
+			n_contigs, elapsed, 1e9 * elapsed / n_contigs
+		))
+
+
+if __name__ == '__main__':
+	main()
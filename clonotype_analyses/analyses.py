@@ -1,22 +1,60 @@
+import os
+import h5py
 import pandas as pd
+import numpy as np
 from typing import List
 from typing import Dict
+from concurrent.futures import ProcessPoolExecutor
 
+from .compute import analytics
 from .compute import processing
 from .compute import clonotypes_tracing
 from .compute import clonotypes_expansion
+from .compute import clonotypes_clustering
+from .compute import clonotypes_cdr3_length
 from .compute import clonotypes_QC_fraction
 from .compute import clonotypes_diversity_rate
 
 from . import common
+from .common import export
+from .common import grouping
+from .common import h5_store
+from .common import shard_store
+from .common.cache import make_key
+from .common.cache import ResultCache
+from .common.cache import file_fingerprint
+from .common.constants import BARCODE_ENCODING_ATTR
+from .common.constants import BARCODE_KEY
+from .common.constants import CDR3_LENGTH
+from .common.constants import CDR3_CLUSTER
+from .common.constants import CELL_COLUMNS
+from .common.constants import CLONOTYPE_CLUSTER
+from .common.constants import ENCODING
+from .common.constants import H5_LAYOUT_VERSION
+from .common.constants import INDEXED_COLUMNS
 from .common.constants import SAMPLE_NAME
 from .common.constants import VDJ_10X_COLUMNS
 
+# default parameters of fuzzy CDR3 clusters, see clonotypes_clustering.create_cdr3_clusters
+CLUSTERS = {'k': 1, 'metric': 'levenshtein', 'by_genes': True}
+CLUSTER_KEYS = (CDR3_CLUSTER, CLONOTYPE_CLUSTER)
+
+
+def _record_barcode_encoding(f, keys):
+	"""
+	Merge the encoding of appended keys into the BARCODE_ENCODING_ATTR of the BARCODE_KEY column of f
+	"""
+	node = f[BARCODE_KEY]
+	encoding = common.barcode_encoding(keys, node.attrs.get(BARCODE_ENCODING_ATTR, None))
+	if encoding is not None:
+		node.attrs[BARCODE_ENCODING_ATTR] = encoding
+
 
 class ClonotypePreprocessing(object):
 	def __init__(
 		self,
 		batch_info: List[Dict],
+		n_workers: int = 1,
 	):
 		"""
 		Create object for preprocessing clonotypes data
@@ -24,17 +62,29 @@ class ClonotypePreprocessing(object):
 		Parameters
 		----------
 		batch_info : List[dict]
-			Allow merging multiple VDJ samples\n
+			Allow merging multiple VDJ samples, sample_name must be unique and non-empty with several samples\n
 			For each sample: barcodes of vdj_df and clinical_meta_df MUST have similar items \n
 			Example:
 				[{
 					'sample_name': 'sample_1',\n
 					'vdj_path': 'root/fol/GSM123_vdj_t_filtered_contig_annotations.csv',\n
 					'clinical_meta_path': 'root/fol/GSM123_clinical_meta.tsv',
-				}, {...}]
+				}, {
+					'sample_name': 'sample_2',\n
+					'vdj_format': 'parsebio',\n
+					'vdj_path': 'root/fol/parse_sample_2',\n
+					'clinical_meta_path': 'root/fol/parse_sample_2_clinical_meta.tsv',
+				}, {...}]\n
+				vdj_format: '10X' (default), 'parsebio' (vdj_path: folder with tcr_annotation_airr.tsv, barcode_report.tsv, clonotype_frequency.tsv)
+				or 'airr' (vdj_path: AIRR rearrangement tsv), see processing.VDJ_READERS\n
+				Samples of different formats are ingested together
+		n_workers : int
+			Number of processes parsing samples in parallel, default: 1 (serial)
 		"""
 		print ('NOTE: barcode (first column) of vdj and clinical_meta MUST have similar items')
+		h5_store.check_sample_names([i.get(SAMPLE_NAME, '') for i in batch_info])
 		self.__batch_info = batch_info
+		self.__n_workers = n_workers
 		self.__sample_specific_columns = [
 			VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value,
 			VDJ_10X_COLUMNS.RAW_CONSENSUS_ID.value
@@ -45,37 +95,19 @@ class ClonotypePreprocessing(object):
 		"""
 		Only keep necessary columns in VDJ file
 		"""
-		final_vdj_df = None
-		final_clinical_df = None
-		for info in self.__batch_info:
-			prefix = info.get('sample_name', '')
-			vdj_path = info['vdj_path']
-			clinical_path = info['clinical_meta_path']
-
-			vdj_df = processing.reformat_clonotypes(
-				vdj_path, preprocessing
-			)
-			clinical_df = common.read_csv(
-				clinical_path, index_col=0
-			)
-
-			if len(prefix):
-				for col in self.__sample_specific_columns:
-					vdj_df[col] = prefix + '_' + vdj_df[col].values
-				vdj_df.index = prefix + '_' + vdj_df.index.values
-				vdj_df[SAMPLE_NAME] = prefix
-
-				clinical_df.index = prefix + '_' + clinical_df.index.values
-				clinical_df[SAMPLE_NAME] = prefix
+		all_vdj_df = []
+		all_clinical_df = []
+		for _, vdj_df, clinical_df in processing.iter_samples(
+			self.__batch_info,
+			self.__sample_specific_columns,
+			preprocessing=preprocessing,
+			n_workers=self.__n_workers,
+		):
+			all_vdj_df.append(vdj_df)
+			all_clinical_df.append(clinical_df)
 
-			final_vdj_df = common.concat_df(
-				[final_vdj_df, vdj_df],
-				axis=0
-			)
-			final_clinical_df = common.concat_df(
-				[final_clinical_df, clinical_df],
-				axis=0
-			)
+		final_vdj_df = common.concat_df(all_vdj_df, axis=0)
+		final_clinical_df = common.concat_df(all_clinical_df, axis=0)
 		return final_vdj_df, final_clinical_df
 
 
@@ -92,10 +124,14 @@ class ClonotypePreprocessing(object):
 			ouput_clinical_h5_path: str,
 			preprocessing: bool = True,
 			intersect_barcodes: bool = False,
+			compression: str = 'gzip',
+			n_workers: int = None,
 		):
 		"""
 		Save VDJ as h5 format\n
-		Keep clinical metadata as pandas dataframe
+		Keep clinical metadata as pandas dataframe\n
+		Samples are streamed one by one into the h5 files, row offsets of each sample are saved\n
+		A cells table (one row per cell, see processing.summarize_cells) is saved next to the contigs
 
 		Parameters
 		----------
@@ -103,6 +139,11 @@ class ClonotypePreprocessing(object):
 		ouput_clinical_h5_path : str
 		preprocessing : boolean
 		intersect_barcodes : boolean
+		compression : str
+			HDF5 filter for the chunked column datasets: 'gzip', 'lzf' or None
+		n_workers : int
+			Override n_workers of the object\n
+			Samples are parsed in a process pool and written in batch_info order by this process
 
 		Returns
 		----------
@@ -111,57 +152,598 @@ class ClonotypePreprocessing(object):
 				'10X_VDJ': location of VDJ h5\n
 				'clinical_meta': location of clinical meta h5
 		"""
-		vdj_df, clinical_df = self._processing_vdj(preprocessing)
-
-		if intersect_barcodes:
-			vdj_df, clinical_df = processing.matching_barcodes(
-				vdj_df, clinical_df
+		with common.H5AtomicWriter(ouput_vdj_h5_path) as vdj_f, \
+			common.H5AtomicWriter(ouput_clinical_h5_path) as clinical_f:
+			self._write_samples(
+				vdj_f, clinical_f,
+				self._iter_samples(preprocessing, intersect_barcodes, n_workers),
+				compression
 			)
-
-		processing.store_df_as_h5(vdj_df, ouput_vdj_h5_path)
-		processing.store_df_as_h5(clinical_df, ouput_clinical_h5_path)
 		return {
 			'10X_VDJ': ouput_vdj_h5_path,
 			'clinical_meta': ouput_clinical_h5_path
 		}
 
 
+	def _iter_samples(self, preprocessing, intersect_barcodes, n_workers, first_sample_idx=0):
+		return processing.iter_samples(
+			self.__batch_info,
+			self.__sample_specific_columns,
+			preprocessing=preprocessing,
+			intersect_barcodes=intersect_barcodes,
+			n_workers=self.__n_workers if n_workers is None else n_workers,
+			first_sample_idx=first_sample_idx,
+		)
+
+
+	def _write_samples(self, vdj_f, clinical_f, samples, compression):
+		"""
+		Stream samples ((sample_name, vdj_df, clinical_df), see processing.iter_samples)
+		into opened h5 files, empty or holding earlier samples\n
+		Only one sample is kept in memory, cells table and inverted indexes only get the new rows
+		"""
+		vdj_writer = h5_store.H5ColumnWriter(
+			vdj_f, VDJ_10X_COLUMNS.BARCODE.value, compression
+		)
+		clinical_writer = h5_store.H5ColumnWriter(
+			clinical_f, VDJ_10X_COLUMNS.BARCODE.value, compression
+		)
+
+		cells_writer = None
+		if vdj_writer.n_rows == 0 or h5_store.has_cells_table(vdj_f):
+			cells_writer = h5_store.H5ColumnWriter(
+				vdj_f.require_group(h5_store.CELLS_GROUP), VDJ_10X_COLUMNS.BARCODE.value, compression
+			)
+		else:
+			print ('NOTE: {} has no cells table, only contigs are appended'.format(vdj_f.filename))
+
+		# derived columns missing from earlier samples are not started half-way
+		skipped_columns = [
+			i for i in (BARCODE_KEY, CDR3_LENGTH)
+			if vdj_writer.n_rows and i not in vdj_f
+		]
+		# keys saved without their encoding (older files) are never joined on, see ClonotypeToolkits._join_index
+		record_encoding = vdj_writer.n_rows == 0 or all(
+			BARCODE_KEY in i and BARCODE_ENCODING_ATTR in i[BARCODE_KEY].attrs
+			for i in (vdj_f, clinical_f)
+		)
+		for prefix, vdj_df, clinical_df in samples:
+			vdj_df = vdj_df.drop(columns=skipped_columns, errors='ignore')
+			clinical_df = clinical_df.drop(columns=skipped_columns, errors='ignore')
+			contig_start, _ = vdj_writer.append(vdj_df, prefix)
+			clinical_writer.append(clinical_df, prefix)
+			cells_df = None
+			if cells_writer is not None:
+				cells_df = processing.summarize_cells(vdj_df, contig_start)
+				cells_writer.append(cells_df, prefix)
+			if record_encoding and BARCODE_KEY in vdj_df.columns:
+				_record_barcode_encoding(vdj_f, vdj_df[BARCODE_KEY].values)
+				_record_barcode_encoding(clinical_f, clinical_df[BARCODE_KEY].values)
+				if cells_df is not None:
+					_record_barcode_encoding(vdj_f[h5_store.CELLS_GROUP], cells_df[BARCODE_KEY].values)
+
+		vdj_writer.close()
+		clinical_writer.close()
+		if cells_writer is not None:
+			cells_writer.close().attrs['n_contig_rows'] = vdj_writer.n_rows
+		for col in INDEXED_COLUMNS:
+			if col in vdj_f and h5_store.get_encoding(vdj_f, col) == ENCODING.CATEGORICAL.value:
+				h5_store.update_inverted_index(vdj_f, col, compression)
+
+
+	def append_samples(
+			self,
+			vdj_h5_path: str,
+			clinical_h5_path: str,
+			preprocessing: bool = True,
+			intersect_barcodes: bool = False,
+			compression: str = 'gzip',
+			n_workers: int = None,
+		):
+		"""
+		Append the samples of batch_info to h5 files saved by ingest_data, without rewriting earlier samples\n
+		Categorical dictionaries, sample offsets, cells table and inverted indexes are extended in place\n
+		Crash-safe: the state of both files is journaled before writing,
+		an interrupted append is rolled back (or finished if both files were fully written) by the next append_samples,
+		files with a pending append cannot be read (see h5_store.recover_append)
+
+		Parameters
+		----------
+		vdj_h5_path : str
+		clinical_h5_path : str
+			Outputs of ingest_data
+		preprocessing, intersect_barcodes, compression, n_workers :
+			See ingest_data, should match the ones used at ingest
+
+		Returns
+		----------
+		Saving location: Dict, see ingest_data
+		"""
+		recovered = h5_store.recover_append(vdj_h5_path, clinical_h5_path)
+		if recovered is not None:
+			print ('WARNING: interrupted append found and {}'.format(recovered))
+
+		new_samples = [i.get(SAMPLE_NAME, '') for i in self.__batch_info]
+		with h5py.File(vdj_h5_path, 'r+') as vdj_f, h5py.File(clinical_h5_path, 'r+') as clinical_f:
+			existing_samples = [i for i in new_samples if i in h5_store.read_sample_offsets(vdj_f)]
+			if len(existing_samples):
+				raise Exception('samples already in {}: {}'.format(vdj_h5_path, existing_samples))
+
+			# packed barcodes of new samples continue the sample ordinals
+			n_samples = len(h5_store.read_sample_offsets(vdj_f))
+			h5_store.begin_append(vdj_f, new_samples)
+			h5_store.begin_append(clinical_f, new_samples)
+			try:
+				self._write_samples(
+					vdj_f, clinical_f,
+					self._iter_samples(preprocessing, intersect_barcodes, n_workers, n_samples),
+					compression
+				)
+			except BaseException:
+				h5_store.rollback_append(vdj_f)
+				h5_store.rollback_append(clinical_f)
+				raise
+			# commit only once both files are fully written
+			h5_store.mark_append_done(vdj_f)
+			h5_store.mark_append_done(clinical_f)
+			h5_store.commit_append(vdj_f)
+			h5_store.commit_append(clinical_f)
+		return {
+			'10X_VDJ': vdj_h5_path,
+			'clinical_meta': clinical_h5_path
+		}
+
+
+	def ingest_shards(
+			self,
+			output_dir: str,
+			preprocessing: bool = True,
+			intersect_barcodes: bool = False,
+			compression: str = 'gzip',
+			n_workers: int = None,
+		):
+		"""
+		Sharded layout: one pair of VDJ / clinical h5 per sample (same format as ingest_data) + a manifest\n
+		Samples already in output_dir are replaced, other shards are never touched\n
+		Every shard is written aside then renamed, the manifest is rewritten after each shard:
+		an interrupted ingest keeps the shards written so far
+
+		Parameters
+		----------
+		output_dir : str
+			Folder of the shards, created if missing
+		preprocessing, intersect_barcodes, compression, n_workers :
+			See ingest_data
+
+		Returns
+		----------
+		Saving location: Dict
+			In which:
+				'manifest': location of the manifest, see common.shard_store
+		"""
+		common.mkdir(output_dir)
+		manifest = shard_store.read_manifest(output_dir)
+		first_sample_idx = shard_store.next_sample_idx(manifest)
+		for sample_idx, sample in enumerate(
+				self._iter_samples(preprocessing, intersect_barcodes, n_workers, first_sample_idx),
+				first_sample_idx
+			):
+			vdj_name, clinical_name = shard_store.shard_file_names(sample_idx)
+			with common.H5AtomicWriter(common.join_path(output_dir, vdj_name)) as vdj_f, \
+				common.H5AtomicWriter(common.join_path(output_dir, clinical_name)) as clinical_f:
+				self._write_samples(vdj_f, clinical_f, [sample], compression)
+				n_cells = vdj_f[h5_store.CELLS_GROUP].attrs.get('n_rows', 0)
+
+			sample_name, vdj_df, _ = sample
+			replaced_shards = [i for i in manifest['shards'] if i['sample_name'] == sample_name]
+			manifest['shards'] = [i for i in manifest['shards'] if i['sample_name'] != sample_name]
+			manifest['shards'].append({
+				'sample_name': sample_name,
+				'sample_idx': sample_idx,
+				'10X_VDJ': vdj_name,
+				'clinical_meta': clinical_name,
+				'n_contigs': len(vdj_df),
+				'n_cells': int(n_cells),
+			})
+			shard_store.write_manifest(output_dir, manifest)
+			for i in replaced_shards:
+				for k in ('10X_VDJ', 'clinical_meta'):
+					os.remove(common.join_path(output_dir, i[k]))
+		return {
+			'manifest': shard_store.manifest_path(output_dir)
+		}
+
+
+# analyses merged from per-partition partial aggregates, see ClonotypeToolkits._map_partitions
+MAP_REDUCE_ANALYSES = ('clonotypes_QC_fraction', 'clonotypes_diversity', 'clone_sizes', 'cdr3_length')
+
+
+def _partition_fingerprint(partition):
+	vdj_h5_path, clinical_h5_path, _ = partition
+	return file_fingerprint(vdj_h5_path) + file_fingerprint(clinical_h5_path)
+
+
+def _partial_aggregate(partition, method_name, args):
+	toolkits = ClonotypeToolkits._partition_toolkits(*partition)
+	return getattr(toolkits, method_name)(*args)
+
+
 class ClonotypeToolkits(object):
 	def __init__(
 		self,
 		vdj_h5_path: str,
-		clinical_h5_path: str,
+		clinical_h5_path: str = None,
+		samples: List[str] = None,
+		cache_size: int = 32,
+		cache_dir: str = None,
+		n_workers: int = 1,
 	):
 		"""
 		Load necessary files for analyses\n
+		Merged VDJ + clinical dataframes and analyses results are cached,
+		keyed by the h5 files (size, mtime), the analysis name and its parameters:
+		samples appended (or shards ingested) after the toolkits are created are read on the next analysis\n
+		Map-reduce path (sharded store, or n_workers > 1): QC fraction, diversity, expansion and CDR3 length
+		are computed per sample (partition) in a process pool, then partial aggregates are merged
 
 		Parameters
 		----------
 		vdj_h5_path : str
-			vdj_h5_path output from ClonotypePreprocessing.ingest_data()
+			vdj_h5_path output from ClonotypePreprocessing.ingest_data()\n
+			Or output_dir of ClonotypePreprocessing.ingest_shards(): only map-reduce analyses are available
 		clinical_h5_path : str
-			clinical_h5_path output from ClonotypePreprocessing.ingest_data()
+			clinical_h5_path output from ClonotypePreprocessing.ingest_data(), None for a sharded store
+		samples : List[str]
+			Only analyse these samples (sample_name of batch_info), default: all samples\n
+			Only the rows (or shards) of these samples are read
+		cache_size : int
+			Number of results kept in memory (LRU), 0 to disable\n
+			Partial aggregates are cached per partition: reruns on other samples only compute new partitions
+		cache_dir : str
+			Optional folder to also keep cached results on disk
+		n_workers : int
+			Number of processes of the map-reduce path, None: all cores\n
+			1: single pass over all samples, except for a sharded store
 		"""
 		print ("NOTE: vdj_h5_path, clinical_h5_path are the outputs from ClonotypePreprocessing.ingest_data()")
-		self.__vdj_h5_path = vdj_h5_path
-		self.__clinical_h5_path = clinical_h5_path
+		self._init(vdj_h5_path, clinical_h5_path, samples, cache_size, cache_dir, n_workers)
+
+
+	@classmethod
+	def _partition_toolkits(cls, vdj_h5_path, clinical_h5_path, samples):
+		"""
+		Toolkits of one partition of the map-reduce path: single pass, no cache
+		"""
+		toolkits = cls.__new__(cls)
+		toolkits._init(vdj_h5_path, clinical_h5_path, samples, 0, None, 1)
+		return toolkits
+
+
+	def _init(self, vdj_h5_path, clinical_h5_path, samples, cache_size, cache_dir, n_workers):
+		self.__samples = samples
+		self.__cache = ResultCache(cache_size, cache_dir)
+		self.__n_workers = os.cpu_count() if n_workers is None else n_workers
+		self._open(vdj_h5_path, clinical_h5_path)
+		self.__partial_cache = ResultCache(cache_size * max(len(self.__partitions), 1), cache_dir)
+
+
+	def _open(self, vdj_h5_path, clinical_h5_path):
+		"""
+		Read the layout (samples, rows, shards) of the h5 files
+		"""
+		if shard_store.is_shard_dir(vdj_h5_path):
+			self.__shard_dir = vdj_h5_path
+			self.__partitions = [
+				(vdj_path, clinical_path, None)
+				for _, vdj_path, clinical_path in shard_store.shard_paths(vdj_h5_path, self.__samples)
+			]
+		else:
+			self.__shard_dir = None
+			self.__vdj_h5_path = vdj_h5_path
+			self.__clinical_h5_path = clinical_h5_path
+			self.__vdj_dataset = h5_store.H5Dataset(vdj_h5_path, self.__samples)
+			# None for h5 ingested without cells table -> analyses collapse contigs themselves
+			self.__cells_dataset = self.__vdj_dataset.cells()
+			self.__clinical_dataset = h5_store.H5Dataset(clinical_h5_path, self.__samples)
+			self.__partitions = [
+				(vdj_h5_path, clinical_h5_path, [i]) for i in self.__vdj_dataset.samples
+			]
+		self.__layout_fingerprint = self._layout_fingerprint()
+
+
+	def _layout_fingerprint(self):
+		if self.__shard_dir is not None:
+			# the manifest is rewritten after every shard
+			return file_fingerprint(shard_store.manifest_path(self.__shard_dir))
+		return self._fingerprints()
+
+
+	def _reopen_if_changed(self):
+		"""
+		Files appended to (or shards replaced) since they were opened: read their layout again
+		"""
+		if self._layout_fingerprint() == self.__layout_fingerprint:
+			return
+		if self.__shard_dir is not None:
+			self._open(self.__shard_dir, None)
+		else:
+			self._open(self.__vdj_h5_path, self.__clinical_h5_path)
+
+
+	@property
+	def is_sharded(self):
+		"""
+		True for a sharded store: only MAP_REDUCE_ANALYSES are available
+		"""
+		return self.__shard_dir is not None
+
+
+	@property
+	def meta_columns(self):
+		"""
+		Categorical / string clinical metadata columns usable as meta_keys,
+		continuous columns (eg: embedding coordinates, age) are left out
+		"""
+		self._reopen_if_changed()
+		if self.__shard_dir is None:
+			columns = self.__clinical_dataset.label_columns()
+		elif len(self.__partitions):
+			columns = h5_store.H5Dataset(self.__partitions[0][1]).label_columns()
+		else:
+			columns = []
+		return [i for i in columns if i != BARCODE_KEY]
+
+
+	def _fingerprints(self):
+		if self.__shard_dir is None:
+			return [
+				file_fingerprint(self.__vdj_h5_path),
+				file_fingerprint(self.__clinical_h5_path),
+			]
+		# only the chosen shards: replacing another shard keeps the cached results
+		return [_partition_fingerprint(i) for i in self.__partitions]
+
+
+	def _cached(self, name, params, func, *args):
+		"""
+		Return func(*args), memoized by input files, samples, name and params
+		"""
+		if self.__shard_dir is not None and name not in MAP_REDUCE_ANALYSES:
+			raise Exception('{} needs all samples at once, not available on sharded store {}'.format(
+				name, self.__shard_dir
+			))
+		self._reopen_if_changed()
+		key = make_key(
+			self._fingerprints(),
+			self.__samples,
+			name,
+			params,
+		)
+		res = self.__cache.get_or_compute(key, func, *args)
+		# shallow copy: callers may add columns without touching the cached result
+		if isinstance(res, pd.DataFrame):
+			return res.copy(deep=False)
+		if isinstance(res, tuple):
+			return tuple(i.copy(deep=False) if isinstance(i, pd.DataFrame) else i for i in res)
+		return res
+
+
+	def _use_map_reduce(self, clusters=None):
+		if clusters is not None:
+			# fuzzy clusters are built over all samples at once
+			if self.__shard_dir is not None:
+				raise Exception('clusters are not available on sharded store {}'.format(self.__shard_dir))
+			return False
+		return self.__shard_dir is not None or (self.__n_workers > 1 and len(self.__partitions) > 1)
+
+
+	def _map_partitions(self, method_name, *args):
+		"""
+		Partial aggregate of every partition (one sample / shard): getattr(partition toolkits, method_name)(*args)\n
+		Partials are cached per partition, missing ones are computed in a process pool of n_workers
+
+		Returns
+		----------
+		List of partial aggregates, in partition order
+		"""
+		_missing = object()
+		keys = [
+			make_key(_partition_fingerprint(i), i[2], method_name, args)
+			for i in self.__partitions
+		]
+		partials = [self.__partial_cache.get(k, _missing) for k in keys]
+		missing_idx = [i for i, v in enumerate(partials) if v is _missing]
+		tasks = [(self.__partitions[i], method_name, args) for i in missing_idx]
+
+		if self.__n_workers <= 1 or len(tasks) <= 1:
+			results = [_partial_aggregate(*i) for i in tasks]
+		else:
+			with ProcessPoolExecutor(max_workers=min(self.__n_workers, len(tasks))) as executor:
+				results = list(executor.map(_partial_aggregate, *zip(*tasks)))
+		for i, res in zip(missing_idx, results):
+			partials[i] = self.__partial_cache.set(keys[i], res)
+		return partials
+
+
+	def _join_index(self):
+		# join on packed barcodes when both files have them with the same encoding -> barcode strings are never decoded
+		if (
+			BARCODE_KEY in self.__vdj_dataset.columns
+			and BARCODE_KEY in self.__clinical_dataset.columns
+		):
+			encodings = [
+				i.column_attrs(BARCODE_KEY).get(BARCODE_ENCODING_ATTR, None)
+				for i in (self.__vdj_dataset, self.__clinical_dataset)
+			]
+			if encodings[0] is not None and encodings[0] == encodings[1]:
+				return BARCODE_KEY
+		return None
+
+
+	def _read_merged_df(self, vdj_columns, meta_keys):
+		return self._cached(
+			'merged_df',
+			{'vdj_columns': list(vdj_columns), 'meta_keys': list(meta_keys)},
+			self._compute_merged_df, list(vdj_columns), list(meta_keys)
+		)
+
+
+	def _compute_merged_df(self, vdj_columns, meta_keys, dataset=None):
+		"""
+		Read chosen columns, keep intersect barcodes and add clinical columns to VDJ rows
+		"""
+		index = self._join_index()
+		dataset = self.__vdj_dataset if dataset is None else dataset
+		vdj_df = dataset.read(vdj_columns, index=index)
+		clinical_df = self.__clinical_dataset.read(meta_keys, index=index)
+		vdj_df, clinical_df, clinical_idx = processing.matching_barcodes(
+			vdj_df, clinical_df, return_indexer=True
+		)
+		return processing.merge_vdj_and_clinical_meta(
+			vdj_df, clinical_df, clinical_idx
+		)
+
+
+	def _read_merged_cells(self, cell_columns, meta_keys):
+		return self._cached(
+			'merged_cells',
+			{'cell_columns': list(cell_columns), 'meta_keys': list(meta_keys)},
+			self._compute_merged_df, list(cell_columns), list(meta_keys), self.__cells_dataset
+		)
+
+
+	def _cluster_params(self, clusters):
+		# n_workers does not change the clusters -> not part of the cache key
+		if clusters is None:
+			return None
+		params = dict(CLUSTERS, **clusters)
+		params.pop('n_workers', None)
+		return params
+
+
+	def _prepare_cdr3_clusters(self, clusters):
+		return self._cached(
+			'cdr3_clusters',
+			self._cluster_params(clusters),
+			self._compute_cdr3_clusters, clusters
+		)
+
+
+	def _compute_cdr3_clusters(self, clusters):
+		vdj_df = self.__vdj_dataset.read(
+			[
+				VDJ_10X_COLUMNS.CHAIN.value,
+				VDJ_10X_COLUMNS.V_GENE.value,
+				VDJ_10X_COLUMNS.J_GENE.value,
+				VDJ_10X_COLUMNS.CDR3.value,
+			],
+			index=self._join_index()
+		)
+		return clonotypes_clustering.create_cdr3_clusters(
+			vdj_df, **dict(CLUSTERS, **clusters)
+		)
+
+
+	def cdr3_clusters(self, k=1, metric='levenshtein', by_genes=True, n_workers=1):
+		"""
+		Fuzzy CDR3 clusters: CDR3s within distance k of each other, per chain (and per V / J gene)\n
+		Clusters can replace clonotypes in the other analyses, through their clusters parameter
+
+		Parameters
+		----------
+		k : int
+			Maximum distance between two neighbor CDR3s
+		metric : str
+			'hamming' (same length only) or 'levenshtein'
+		by_genes : bool
+			Only cluster CDR3s having the same V and J genes
+		n_workers : int
+			Number of processes, one chain / V / J partition is never split
+
+		Returns
+		----------
+		Pandas dataframe, one row per VDJ row, columns: 'cdr3_cluster', 'clonotype_cluster'
+		"""
+		return self._prepare_cdr3_clusters(
+			{'k': k, 'metric': metric, 'by_genes': by_genes, 'n_workers': n_workers}
+		)
+
+
+	def _read_clonotypes_df(self, vdj_columns, meta_keys, clusters=None, cell_columns=None):
+		"""
+		Merged dataframe and its clonotype column: raw_clonotype_id, or CLONOTYPE_CLUSTER with clusters\n
+		Merged cells table (cell_columns) when the VDJ h5 has one, merged contigs (vdj_columns) otherwise
+		"""
+		if cell_columns is not None and self.__cells_dataset is not None:
+			merged_df = self._read_merged_cells(
+				list(cell_columns) + [
+					VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value,
+					CELL_COLUMNS.CONTIG_START.value,
+					CELL_COLUMNS.N_CONTIGS.value,
+				],
+				meta_keys
+			)
+		else:
+			merged_df = self._read_merged_df(vdj_columns, meta_keys)
+		if clusters is None:
+			return merged_df, VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value
+
+		cluster_values = self._prepare_cdr3_clusters(clusters)[CLONOTYPE_CLUSTER].values
+		if processing.is_cells_table(merged_df):
+			# clonotype cluster of a cell: the one of its first contig
+			merged_df[CLONOTYPE_CLUSTER] = cluster_values[
+				self.__vdj_dataset.file_rows_to_view(merged_df[CELL_COLUMNS.CONTIG_START.value].values)
+			]
+		else:
+			# merged rows: VDJ rows having a clinical row, same order
+			merged_df[CLONOTYPE_CLUSTER] = cluster_values[self._prepare_row_links() >= 0]
+		return merged_df, CLONOTYPE_CLUSTER
+
+
+	def _inverted_index(self, key, clusters=None):
+		"""
+		InvertedIndex of key over VDJ file rows, built from the clusters for CDR3_CLUSTER / CLONOTYPE_CLUSTER
+		"""
+		if key not in CLUSTER_KEYS:
+			return self.__vdj_dataset.inverted_index(key)
+		clusters = {} if clusters is None else clusters
+		return self._cached(
+			'cluster_index',
+			dict(self._cluster_params(clusters), key=key),
+			self._compute_cluster_index, key, clusters
+		)
+
+
+	def _compute_cluster_index(self, key, clusters):
+		cluster_values = self._prepare_cdr3_clusters(clusters)[key].values
+		file_rows = self.__vdj_dataset.file_rows(np.arange(len(cluster_values)))
+		codes = np.full(file_rows.max() + 1 if len(file_rows) else 0, -1, dtype=np.int64)
+		codes[file_rows] = cluster_values.codes
+		return h5_store.InvertedIndex.from_codes(
+			codes, np.asarray(cluster_values.categories, dtype='O')
+		)
 
 
 	def _prepare_clonotypes_QC_fraction(self, meta_keys):
 		if not len(meta_keys):
 			raise Exception('Need at least one meta column to compare')
 
-		vdj_df = processing.h5_to_pandas(
-			self.__vdj_h5_path, [VDJ_10X_COLUMNS.CHAIN.value]
+		return self._cached(
+			'clonotypes_QC_fraction',
+			{'meta_keys': list(meta_keys)},
+			self._compute_clonotypes_QC_fraction, list(meta_keys)
 		)
-		clinical_df = processing.h5_to_pandas(
-			self.__clinical_h5_path, meta_keys
-		)
-		vdj_df, clinical_df = processing.matching_barcodes(
-			vdj_df, clinical_df
-		)
-		merged_df = processing.merge_vdj_and_clinical_meta(
-			vdj_df, clinical_df
+
+
+	def _compute_clonotypes_QC_fraction(self, meta_keys):
+		if self._use_map_reduce():
+			return clonotypes_QC_fraction.merge_clonotype_fraction_dfs(
+				self._map_partitions('_partial_clonotypes_QC_fraction', meta_keys), meta_keys
+			)
+
+		merged_df, _ = self._read_clonotypes_df(
+			[VDJ_10X_COLUMNS.CHAIN.value], meta_keys,
+			cell_columns=[CELL_COLUMNS.PAIRING.value]
 		)
 		return clonotypes_QC_fraction.create_clonotype_fraction_df(
 			merged_df, meta_keys
@@ -210,4 +792,949 @@ class ClonotypeToolkits(object):
 		)
 
 
+	def _prepare_clonotypes_diversity(self, meta_keys, abundance='cells', hill_orders=(0, 1, 2), clusters=None):
+		if not len(meta_keys):
+			raise Exception('Need at least one meta column to compare')
+
+		return self._cached(
+			'clonotypes_diversity',
+			{
+				'meta_keys': list(meta_keys),
+				'abundance': abundance,
+				'hill_orders': list(hill_orders),
+				'clusters': self._cluster_params(clusters),
+			},
+			self._compute_clonotypes_diversity, list(meta_keys), abundance, tuple(hill_orders), clusters
+		)
+
+
+	def _partial_clonotypes_QC_fraction(self, meta_keys):
+		fraction_clo_df, _ = self._compute_clonotypes_QC_fraction(meta_keys)
+		return fraction_clo_df
+
+
+	def _compute_clonotypes_diversity(self, meta_keys, abundance, hill_orders, clusters):
+		if self._use_map_reduce(clusters):
+			abundance_df = clonotypes_diversity_rate.merge_clonotype_abundances(
+				self._map_partitions('_partial_clonotype_abundances', meta_keys, abundance, True),
+				meta_keys
+			)
+			return clonotypes_diversity_rate.diversity_from_abundances(
+				abundance_df, meta_keys, hill_orders, abundance
+			)
+
+		merged_df, clonotype_key = self._read_clonotypes_df(
+			[
+				VDJ_10X_COLUMNS.CHAIN.value,
+				VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value,
+				VDJ_10X_COLUMNS.UMIS.value,
+			],
+			meta_keys, clusters,
+			cell_columns=[
+				CELL_COLUMNS.N_TRA.value,
+				CELL_COLUMNS.N_TRB.value,
+				CELL_COLUMNS.N_TRG.value,
+				CELL_COLUMNS.N_TRD.value,
+				CELL_COLUMNS.UMIS_MIN.value,
+			]
+		)
+		return clonotypes_diversity_rate.create_diversity_df(
+			merged_df, meta_keys, abundance, hill_orders, clonotype_key=clonotype_key
+		)
+
+
+	def clonotypes_diversity(self, meta_keys=[], abundance='cells', hill_orders=(0, 1, 2), clusters=None):
+		"""
+		Clonotype diversity of every group: Shannon entropy, Simpson, inverse Simpson, Hill numbers, clonality\n
+		Only cells having paired chains (TRA + TRB or TRG + TRD) are counted
+
+		Parameters
+		----------
+		meta_keys : List[str]
+			List of metadata keys for grouping \n
+			If more than one keys provided, the values will be combined together \n
+			Eg: ['condition', 'patient']
+		abundance : str
+			'cells': clonotype abundance = number of cells\n
+			'umis': clonotype abundance = sum of min UMI per cell
+		hill_orders : List[float]
+			Orders q of the Hill numbers
+		clusters : Dict
+			Count fuzzy clonotypes instead of raw_clonotype_id, eg: {'k': 1, 'metric': 'levenshtein'}\n
+			See cdr3_clusters for the keys
+
+		Returns
+		----------
+		Pandas dataframe, one row per group: meta_keys, n_cells (n_umis if abundance is 'umis'), n_clonotypes, diversity metrics
+		"""
+		return self._prepare_clonotypes_diversity(meta_keys, abundance, hill_orders, clusters)
+
+
+	def matplotlib_clonotypes_diversity(self, meta_keys=[], metric='shannon', abundance='cells'):
+		"""
+		Box plot of a diversity metric, groups are split by the first meta key
+
+		Parameters
+		----------
+		meta_keys : List[str]
+			Eg: ['condition', 'patient'] -> one value per patient, one box per condition
+		metric : str
+			'shannon', 'simpson', 'inverse_simpson', 'clonality', 'hill_<q>'
+		abundance : str
+			'cells' or 'umis'
+
+		Returns
+		----------
+		Matplotlib image
+		"""
+		diversity_df = self._prepare_clonotypes_diversity(meta_keys, abundance)
+		return clonotypes_diversity_rate.visualize_diversity(
+			diversity_df, meta_keys, metric
+		)
+
+
+	def plotly_clonotypes_diversity(self, meta_keys=[], metric='shannon', abundance='cells'):
+		"""
+		Produce dataframe for plotly: diversity metric of each group
+
+		Parameters
+		----------
+		meta_keys : List[str]
+			Eg: ['condition', 'patient'] -> columns: 'condition', '<metric> per patient'
+		metric : str
+			'shannon', 'simpson', 'inverse_simpson', 'clonality', 'hill_<q>'
+		abundance : str
+			'cells' or 'umis'
+
+		Returns
+		----------
+		Pandas dataframe using for plotly
+		"""
+		diversity_df = self._prepare_clonotypes_diversity(meta_keys, abundance)
+		return clonotypes_diversity_rate.plotly_diversity(
+			diversity_df, meta_keys, metric
+		)
+
+
+	def _partial_clonotype_abundances(self, meta_keys, abundance, paired_only):
+		merged_df, clonotype_key = self._read_clonotypes_df(
+			[
+				VDJ_10X_COLUMNS.CHAIN.value,
+				VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value,
+				VDJ_10X_COLUMNS.UMIS.value,
+			],
+			meta_keys,
+			cell_columns=[
+				CELL_COLUMNS.N_TRA.value,
+				CELL_COLUMNS.N_TRB.value,
+				CELL_COLUMNS.N_TRG.value,
+				CELL_COLUMNS.N_TRD.value,
+				CELL_COLUMNS.UMIS_MIN.value,
+			]
+		)
+		return clonotypes_diversity_rate.create_clonotype_abundance_df(
+			merged_df, meta_keys, abundance, paired_only, clonotype_key
+		)
+
+
+	def _compute_clonotypes_resampled_diversity(self, meta_keys, params, clusters):
+		merged_df, clonotype_key = self._read_clonotypes_df(
+			[
+				VDJ_10X_COLUMNS.CHAIN.value,
+				VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value,
+				VDJ_10X_COLUMNS.UMIS.value,
+			],
+			meta_keys, clusters,
+			cell_columns=[
+				CELL_COLUMNS.N_TRA.value,
+				CELL_COLUMNS.N_TRB.value,
+				CELL_COLUMNS.N_TRG.value,
+				CELL_COLUMNS.N_TRD.value,
+				CELL_COLUMNS.UMIS_MIN.value,
+			]
+		)
+		return clonotypes_diversity_rate.create_resampled_diversity_df(
+			merged_df, meta_keys, clonotype_key=clonotype_key, **params
+		)
+
+
+	def clonotypes_resampled_diversity(
+			self,
+			meta_keys=[],
+			depth=None,
+			n_iter=1000,
+			method='rarefaction',
+			abundance='cells',
+			seed=0,
+			n_workers=1,
+			hill_orders=(0, 1, 2),
+			clusters=None,
+		):
+		"""
+		Diversity of every group resampled to a common depth, with confidence intervals
+
+		Parameters
+		----------
+		meta_keys : List[str]
+			List of metadata keys for grouping \n
+			Eg: ['condition', 'patient']
+		depth : int
+			Number of cells (or UMIs) drawn per replicate, default: size of the smallest group
+		n_iter : int
+			Number of replicates per group
+		method : str
+			'rarefaction': subsample without replacement, groups smaller than depth are NaN\n
+			'bootstrap': resample with replacement
+		abundance : str
+			'cells' or 'umis'
+		seed : int
+			Same seed -> same result, whatever n_workers
+		n_workers : int
+			Number of processes drawing the replicates
+		hill_orders : List[float]
+			Orders q of the Hill numbers
+		clusters : Dict
+			Count fuzzy clonotypes instead of raw_clonotype_id, eg: {'k': 1, 'metric': 'levenshtein'}\n
+			See cdr3_clusters for the keys
+
+		Returns
+		----------
+		Pandas dataframe, one row per group: <metric>_mean, <metric>_std, <metric>_lower, <metric>_upper
+		"""
+		if not len(meta_keys):
+			raise Exception('Need at least one meta column to compare')
+
+		params = {
+			'depth': depth,
+			'n_iter': n_iter,
+			'method': method,
+			'abundance': abundance,
+			'seed': seed,
+			'hill_orders': tuple(hill_orders),
+		}
+		# n_workers does not change the result -> not part of the cache key
+		return self._cached(
+			'clonotypes_resampled_diversity',
+			dict(
+				params,
+				meta_keys=list(meta_keys),
+				hill_orders=list(hill_orders),
+				clusters=self._cluster_params(clusters),
+			),
+			self._compute_clonotypes_resampled_diversity,
+			list(meta_keys), dict(params, n_workers=n_workers), clusters
+		)
+
+
+	def _prepare_clone_sizes(self, meta_keys, clusters=None):
+		if not len(meta_keys):
+			raise Exception('Need at least one meta column to compare')
 
+		# lower_n is not part of the key: every sweep of lower_n reuses the same histogram
+		return self._cached(
+			'clone_sizes',
+			{'meta_keys': list(meta_keys), 'clusters': self._cluster_params(clusters)},
+			self._compute_clone_sizes, list(meta_keys), clusters
+		)
+
+
+	def _compute_clone_sizes(self, meta_keys, clusters):
+		if self._use_map_reduce(clusters):
+			abundance_df = clonotypes_diversity_rate.merge_clonotype_abundances(
+				self._map_partitions('_partial_clonotype_abundances', meta_keys, 'cells', False),
+				meta_keys
+			)
+			return clonotypes_expansion.clone_sizes_from_abundances(abundance_df, meta_keys)
+
+		merged_df, clonotype_key = self._read_clonotypes_df(
+			[VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value], meta_keys, clusters, cell_columns=[]
+		)
+		return clonotypes_expansion.create_clone_size_df(merged_df, meta_keys, clonotype_key)
+
+
+	def clonotypes_expansion(self, meta_keys=[], lower_n=5, clusters=None):
+		"""
+		Proportion of clonotypes of size 1, 2, .., lower_n and > lower_n in every group
+
+		Parameters
+		----------
+		meta_keys : List[str]
+			List of metadata keys for grouping \n
+			If more than one keys provided, the values will be combined together \n
+			Eg: ['condition', 'patient']
+		lower_n : int or List[int]
+			Clones larger than lower_n are pooled together
+		clusters : Dict
+			Count fuzzy clonotypes instead of raw_clonotype_id, eg: {'k': 1, 'metric': 'levenshtein'}\n
+			See cdr3_clusters for the keys
+
+		Returns
+		----------
+		Pandas dataframe, one row per group\n
+		Dict: lower_n -> Pandas dataframe when lower_n is a list
+		"""
+		clone_size_df = self._prepare_clone_sizes(meta_keys, clusters)
+		if np.ndim(lower_n) == 0:
+			return clonotypes_expansion.expansion_from_clone_sizes(clone_size_df, lower_n)
+		return {
+			n: clonotypes_expansion.expansion_from_clone_sizes(clone_size_df, n)
+			for n in lower_n
+		}
+
+
+	def matplotlib_clonotypes_expansion(self, meta_keys=[], lower_n=5):
+		"""
+		Stacked bar of clone size proportions of every group
+
+		Parameters
+		----------
+		meta_keys : List[str]
+			Eg: ['condition', 'patient']
+		lower_n : int
+			Clones larger than lower_n are pooled together
+
+		Returns
+		----------
+		Matplotlib image
+		"""
+		expansion_df = self.clonotypes_expansion(meta_keys, lower_n)
+		return clonotypes_expansion.visualize_clonotypes_expansion(expansion_df)
+
+
+	def plotly_clonotypes_expansion(self, meta_keys=[], lower_n=5):
+		"""
+		Produce dataframe for plotly: clone size proportions of every group
+
+		Parameters
+		----------
+		meta_keys : List[str]
+			Eg: ['condition', 'patient']
+		lower_n : int
+			Clones larger than lower_n are pooled together
+
+		Returns
+		----------
+		Pandas dataframe using for plotly, columns: 'Groups', 'Clonotypes size', 'Ratio'
+		"""
+		expansion_df = self.clonotypes_expansion(meta_keys, lower_n)
+		return clonotypes_expansion.plotly_clonotypes_expansion(expansion_df)
+
+
+	def _prepare_cdr3_length(self, meta_keys):
+		if not len(meta_keys):
+			raise Exception('Need at least one meta column to compare')
+
+		# one histogram serves every chain
+		return self._cached(
+			'cdr3_length',
+			{'meta_keys': list(meta_keys)},
+			self._compute_cdr3_length, list(meta_keys)
+		)
+
+
+	def _compute_cdr3_length(self, meta_keys):
+		if self._use_map_reduce():
+			return clonotypes_cdr3_length.merge_cdr3_length_hists(
+				self._map_partitions('_compute_cdr3_length', meta_keys)
+			)
+
+		# files ingested before CDR3_LENGTH existed: measure the cdr3 dictionary instead
+		length_column = CDR3_LENGTH
+		if CDR3_LENGTH not in self.__vdj_dataset.columns:
+			length_column = VDJ_10X_COLUMNS.CDR3.value
+
+		merged_df = self._read_merged_df(
+			[VDJ_10X_COLUMNS.CHAIN.value, length_column], meta_keys
+		)
+		return clonotypes_cdr3_length.create_cdr3_length_hist(merged_df, meta_keys)
+
+
+	def cdr3_length(self, meta_keys=[], chain='TRB'):
+		"""
+		Distribution of CDR3 lengths of every group
+
+		Parameters
+		----------
+		meta_keys : List[str]
+			List of metadata keys for grouping \n
+			Eg: ['condition']
+		chain : str or List[str]
+			Eg: 'TRA', 'TRB'
+
+		Returns
+		----------
+		Pandas dataframe: one row per group, one column per CDR3 length\n
+		Dict: chain -> Pandas dataframe when chain is a list
+		"""
+		hist_df = self._prepare_cdr3_length(meta_keys)
+		if isinstance(chain, str):
+			return clonotypes_cdr3_length.cdr3_length_ratio(hist_df, chain)
+		return {
+			i: clonotypes_cdr3_length.cdr3_length_ratio(hist_df, i)
+			for i in chain
+		}
+
+
+	def matplotlib_cdr3_length(self, meta_keys=[], chain='TRB'):
+		"""
+		Area plot of CDR3 lengths of one chain, one area per group
+
+		Parameters
+		----------
+		meta_keys : List[str]
+			Eg: ['condition']
+		chain : str
+			Eg: 'TRA', 'TRB'
+
+		Returns
+		----------
+		Matplotlib image
+		"""
+		cdr3_length_df = self.cdr3_length(meta_keys, chain)
+		return clonotypes_cdr3_length.visualize_cdr3_length(cdr3_length_df, chain)
+
+
+	def plotly_cdr3_length(self, meta_keys=[], chain='TRB'):
+		"""
+		Produce dataframe for plotly: CDR3 lengths of one chain
+
+		Parameters
+		----------
+		meta_keys : List[str]
+			Eg: ['condition']
+		chain : str
+			Eg: 'TRA', 'TRB'
+
+		Returns
+		----------
+		Pandas dataframe using for plotly, columns: <meta key>, 'CDR3 length', 'Ratio'
+		"""
+		cdr3_length_df = self.cdr3_length(meta_keys, chain)
+		return clonotypes_cdr3_length.plotly_cdr3_length(cdr3_length_df)
+
+
+	def _prepare_row_links(self):
+		return self._cached('row_links', {}, self._compute_row_links)
+
+
+	def _compute_row_links(self):
+		"""
+		Position of the clinical row of every VDJ row, -1: barcode not in clinical metadata
+		"""
+		index = self._join_index()
+		vdj_keys = self.__vdj_dataset.read([], index=index).index.values
+		clinical_keys = self.__clinical_dataset.read([], index=index).index.values
+		_, clinical_idx = common.barcodes_indexer(vdj_keys, clinical_keys)
+		return clinical_idx
+
+
+	def _prepare_indexed_groups(self, meta_keys, key, clusters=None):
+		if not len(meta_keys):
+			raise Exception('Need at least one meta column to compare')
+
+		return self._cached(
+			'indexed_groups',
+			{'meta_keys': list(meta_keys), 'key': key, 'clusters': self._tracing_clusters(key, clusters)},
+			self._compute_indexed_groups, list(meta_keys), key, clusters
+		)
+
+
+	def _tracing_clusters(self, key, clusters):
+		# clusters only matter for cluster keys
+		if key not in CLUSTER_KEYS:
+			return None
+		return self._cluster_params({} if clusters is None else clusters)
+
+
+	def _compute_indexed_groups(self, meta_keys, key, clusters):
+		"""
+		Returns
+		----------
+		indexed_groups: group of every row of the inverted index of key, -1: other samples / no clinical row
+		group_labels
+		group_totals: number of VDJ rows of every group
+		"""
+		clinical_pos = self._prepare_row_links()
+		clinical_df = pd.DataFrame({
+			k: self.__clinical_dataset.read_column(k) for k in meta_keys
+		})
+		matched = np.flatnonzero(clinical_pos >= 0)
+		group_key = grouping.factorize_groups(clinical_df, meta_keys, clinical_pos[matched])
+		row_groups = np.full(len(clinical_pos), -1, dtype=np.int64)
+		row_groups[matched] = group_key.codes
+
+		index = self._inverted_index(key, clusters)
+		positions = self.__vdj_dataset.file_rows_to_view(index.indices)
+		indexed_groups = np.where(positions >= 0, row_groups[positions], -1)
+		group_totals = np.bincount(group_key.codes, minlength=group_key.n_groups)
+		return indexed_groups, group_key.labels, group_totals
+
+
+	def clonotype_tracing(self, meta_keys=[], n_cdr3=5, clonotypes=None, key=VDJ_10X_COLUMNS.CDR3.value, clusters=None):
+		"""
+		Fraction of the VDJ rows of every group carrying some clonotypes\n
+		Rows are found with the inverted index of key saved at ingest
+
+		Parameters
+		----------
+		meta_keys : List[str]
+			List of metadata keys for grouping \n
+			Eg: ['simplified_celltype']
+		n_cdr3 : int
+			Without clonotypes: trace the n_cdr3 values shared by the most groups
+		clonotypes : List[str]
+			Values of key to trace
+		key : str
+			'cdr3', 'raw_clonotype_id', or fuzzy clusters: 'cdr3_cluster', 'clonotype_cluster'
+		clusters : Dict
+			Parameters of the fuzzy clusters, see cdr3_clusters
+
+		Returns
+		----------
+		Pandas dataframe, index: groups, one column per traced clonotype
+		"""
+		indexed_groups, group_labels, group_totals = self._prepare_indexed_groups(meta_keys, key, clusters)
+		return self._cached(
+			'clonotype_tracing',
+			{
+				'meta_keys': list(meta_keys),
+				'n_cdr3': n_cdr3,
+				'clonotypes': None if clonotypes is None else list(clonotypes),
+				'key': key,
+				'clusters': self._tracing_clusters(key, clusters),
+			},
+			clonotypes_tracing.create_tracing_df,
+			self._inverted_index(key, clusters),
+			indexed_groups, group_labels, group_totals, n_cdr3, clonotypes
+		)
+
+
+	def clonotypes_scatter(
+			self,
+			clonotypes,
+			key=VDJ_10X_COLUMNS.CDR3.value,
+			embedding_columns=['X_UMAP', 'Y_UMAP'],
+			clusters=None,
+		):
+		"""
+		VDJ rows of some clonotypes with the embedding of their cells
+
+		Parameters
+		----------
+		clonotypes : List[str]
+			Values of key
+		key : str
+			'cdr3', 'raw_clonotype_id', or fuzzy clusters: 'cdr3_cluster', 'clonotype_cluster'
+		clusters : Dict
+			Parameters of the fuzzy clusters, see cdr3_clusters
+		embedding_columns : List[str]
+			Embedding columns of the clinical metadata
+
+		Returns
+		----------
+		Pandas dataframe, columns: barcode, key, umis, embedding_columns
+		"""
+		positions = self.__vdj_dataset.view_positions(
+			self._inverted_index(key, clusters).rows(clonotypes)
+		)
+		clinical_pos = self._prepare_row_links()[positions]
+		positions = positions[clinical_pos >= 0]
+		clinical_pos = clinical_pos[clinical_pos >= 0]
+
+		vdj_columns = [key, VDJ_10X_COLUMNS.UMIS.value]
+		if key != VDJ_10X_COLUMNS.CDR3.value:
+			vdj_columns = [VDJ_10X_COLUMNS.CDR3.value] + vdj_columns
+		if key in CLUSTER_KEYS:
+			clonotype_df = self.__vdj_dataset.read_rows(
+				[i for i in vdj_columns if i != key], positions
+			)
+			cluster_df = self._prepare_cdr3_clusters({} if clusters is None else clusters)
+			clonotype_df.insert(1, key, cluster_df[key].values[positions])
+		else:
+			clonotype_df = self.__vdj_dataset.read_rows(vdj_columns, positions)
+		clinical_df = self.__clinical_dataset.read_rows(embedding_columns, clinical_pos)
+		return clonotypes_tracing.clonotypes_scatter(clonotype_df, clinical_df, embedding_columns)
+
+
+	def matplotlib_clonotype_tracing(self, meta_keys=[], n_cdr3=5, clonotypes=None, key=VDJ_10X_COLUMNS.CDR3.value, clusters=None):
+		"""
+		Stacked bar of the traced clonotypes in every group, see clonotype_tracing
+
+		Returns
+		----------
+		Matplotlib image
+		"""
+		tracing_df = self.clonotype_tracing(meta_keys, n_cdr3, clonotypes, key, clusters)
+		return clonotypes_tracing.visualize_clonotype_tracing_bar(tracing_df)
+
+
+	def plotly_clonotype_tracing(self, meta_keys=[], n_cdr3=5, clonotypes=None, key=VDJ_10X_COLUMNS.CDR3.value, clusters=None):
+		"""
+		Produce dataframe for plotly: traced clonotypes in every group, see clonotype_tracing
+
+		Returns
+		----------
+		Pandas dataframe using for plotly, columns: 'Groups', 'Clonotypes', 'Ratio'
+		"""
+		tracing_df = self.clonotype_tracing(meta_keys, n_cdr3, clonotypes, key, clusters)
+		return clonotypes_tracing.plotly_clonotype_tracing_bar(tracing_df)
+
+
+	def matplotlib_clonotype_tracing_embedding(
+			self,
+			meta_keys=[],
+			n_cdr3=5,
+			clonotypes=None,
+			key=VDJ_10X_COLUMNS.CDR3.value,
+			embedding_columns=['X_UMAP', 'Y_UMAP'],
+			clusters=None,
+		):
+		"""
+		Cells of the traced clonotypes on the embedding, all cells in gray
+
+		Returns
+		----------
+		Matplotlib image
+		"""
+		if clonotypes is None:
+			clonotypes = list(self.clonotype_tracing(meta_keys, n_cdr3, None, key, clusters).columns)
+		scatter_df = self.clonotypes_scatter(clonotypes, key, embedding_columns, clusters)
+		umap_df = pd.DataFrame({
+			i: self.__clinical_dataset.read_column(i) for i in embedding_columns
+		})
+		return clonotypes_tracing.visualize_clonotype_tracing_embedding(
+			scatter_df, umap_df, key, embedding_columns
+		)
+
+
+	def plotly_clonotype_tracing_embedding(
+			self,
+			meta_keys=[],
+			n_cdr3=5,
+			clonotypes=None,
+			key=VDJ_10X_COLUMNS.CDR3.value,
+			embedding_columns=['X_UMAP', 'Y_UMAP'],
+			clusters=None,
+		):
+		"""
+		Produce dataframe for plotly: embedding of the cells of the traced clonotypes
+
+		Returns
+		----------
+		Pandas dataframe using for plotly, columns: key, 'umis', embedding_columns
+		"""
+		if clonotypes is None:
+			clonotypes = list(self.clonotype_tracing(meta_keys, n_cdr3, None, key, clusters).columns)
+		scatter_df = self.clonotypes_scatter(clonotypes, key, embedding_columns, clusters)
+		return clonotypes_tracing.plotly_clonotype_tracing_embedding(
+			scatter_df, key, embedding_columns
+		)
+
+
+	def _prepare_indexed_cells(self, key, clusters=None):
+		return self._cached(
+			'indexed_cells',
+			{'key': key, 'clusters': self._tracing_clusters(key, clusters)},
+			self._compute_indexed_cells, key, clusters
+		)
+
+
+	def _compute_indexed_cells(self, key, clusters):
+		"""
+		Returns
+		----------
+		indexed_cells: cell code of every row of the inverted index of key, -1: other samples
+		indexed_umis: UMI of every row of the inverted index of key
+		"""
+		cell_idx, _ = pd.factorize(
+			self.__vdj_dataset.read([], index=self._join_index()).index.values
+		)
+		umis = self.__vdj_dataset.read_column(VDJ_10X_COLUMNS.UMIS.value)
+
+		index = self._inverted_index(key, clusters)
+		positions = self.__vdj_dataset.file_rows_to_view(index.indices)
+		indexed_cells = np.where(positions >= 0, cell_idx[positions], -1)
+		indexed_umis = np.where(positions >= 0, umis[positions], 0)
+		return indexed_cells, indexed_umis
+
+
+	def _iter_clonotype_batches(self, meta_keys, rank_by, key):
+		"""
+		Yield (values, weights) of every sample, one sample in memory at a time
+		"""
+		index = self._join_index()
+		for sample in self.__vdj_dataset.samples:
+			vdj_df = self.__vdj_dataset.select_samples([sample]).read(
+				[key, VDJ_10X_COLUMNS.UMIS.value], index=index
+			)
+			clinical_df = self.__clinical_dataset.select_samples([sample]).read(
+				meta_keys, index=index
+			)
+			_, clinical_idx = common.barcodes_indexer(
+				vdj_df.index.values, clinical_df.index.values
+			)
+			groups = np.full(len(vdj_df), -1, dtype=np.int64)
+			matched = np.flatnonzero(clinical_idx >= 0)
+			if len(matched):
+				groups[matched] = grouping.factorize_groups(
+					clinical_df, meta_keys, clinical_idx[matched]
+				).codes
+			yield clonotypes_tracing.batch_scores(
+				vdj_df[key].values,
+				rank_by,
+				groups=groups,
+				cells=pd.factorize(vdj_df.index.values)[0],
+				umis=vdj_df[VDJ_10X_COLUMNS.UMIS.value].values,
+			)
+
+
+	def public_clonotypes(
+			self,
+			meta_keys=[],
+			n_top=5,
+			rank_by='subjects',
+			key=VDJ_10X_COLUMNS.CDR3.value,
+			approximate=None,
+			capacity=10000,
+			clusters=None,
+		):
+		"""
+		Top n_top clonotypes shared by the most subjects / cells / UMIs
+
+		Parameters
+		----------
+		meta_keys : List[str]
+			Metadata keys defining a subject \n
+			Eg: ['Subject ID']
+		n_top : int
+		rank_by : str
+			'subjects': number of subjects having the clonotype\n
+			'cells': number of cells\n
+			'umis': sum of UMIs
+		key : str
+			'cdr3', 'raw_clonotype_id', or fuzzy clusters: 'cdr3_cluster', 'clonotype_cluster'
+		clusters : Dict
+			Parameters of the fuzzy clusters, see cdr3_clusters
+		approximate : str
+			None: exact ranking from the inverted index\n
+			'space_saving' or 'count_min': one streaming pass over the samples, memory bounded by capacity\n
+			With approximate, subjects are counted per sample: a subject spread over samples is counted once per sample
+		capacity : int
+			Number of values tracked by the approximate sketches
+
+		Returns
+		----------
+		Pandas dataframe, index: clonotypes, sorted by rank_by
+		"""
+		if not len(meta_keys):
+			raise Exception('Need at least one meta column to compare')
+
+		params = {
+			'meta_keys': list(meta_keys),
+			'n_top': n_top,
+			'rank_by': rank_by,
+			'key': key,
+			'approximate': approximate,
+			'capacity': capacity,
+			'clusters': self._tracing_clusters(key, clusters),
+		}
+		return self._cached(
+			'public_clonotypes', params,
+			self._compute_public_clonotypes, list(meta_keys), n_top, rank_by, key, approximate, capacity, clusters
+		)
+
+
+	def _compute_public_clonotypes(self, meta_keys, n_top, rank_by, key, approximate, capacity, clusters):
+		if approximate is not None:
+			if key in CLUSTER_KEYS:
+				raise Exception('approximate ranking reads stored columns only, not {}'.format(key))
+			return clonotypes_tracing.approximate_public_clonotypes(
+				self._iter_clonotype_batches(meta_keys, rank_by, key),
+				n_top, approximate, capacity
+			)
+
+		indexed_groups, _, _ = self._prepare_indexed_groups(meta_keys, key, clusters)
+		indexed_cells, indexed_umis = self._prepare_indexed_cells(key, clusters)
+		return clonotypes_tracing.rank_public_clonotypes(
+			self._inverted_index(key, clusters),
+			indexed_groups, n_top, rank_by,
+			np.where(indexed_groups >= 0, indexed_cells, -1),
+			indexed_umis,
+		)
+
+
+	def _prepare_embedding_grid(self, meta_keys, embedding_columns, fine_bins, clusters=None):
+		# bins are not part of the key: every resolution is re-binned from the same fine grid
+		return self._cached(
+			'embedding_grid',
+			{
+				'meta_keys': list(meta_keys),
+				'embedding_columns': list(embedding_columns),
+				'fine_bins': fine_bins,
+				'clusters': self._cluster_params(clusters),
+			},
+			self._compute_embedding_grid, list(meta_keys), list(embedding_columns), fine_bins, clusters
+		)
+
+
+	def _compute_embedding_grid(self, meta_keys, embedding_columns, fine_bins, clusters):
+		"""
+		One row per clinical cell, clonotype of the cell from its VDJ rows
+		"""
+		clinical_df = pd.DataFrame({
+			k: self.__clinical_dataset.read_column(k) for k in embedding_columns + meta_keys
+		})
+		group_key = grouping.factorize_groups(clinical_df, meta_keys) if len(meta_keys) else None
+
+		if clusters is None:
+			clonotype_values = self.__vdj_dataset.read_column(VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value)
+		else:
+			clonotype_values = self._prepare_cdr3_clusters(clusters)[CLONOTYPE_CLUSTER].values
+		clonotype_idx, _ = pd.factorize(clonotype_values)
+		clinical_pos = self._prepare_row_links()
+		matched = np.flatnonzero((clinical_pos >= 0) & (clonotype_idx >= 0))
+		clonotypes = np.full(len(clinical_df), -1, dtype=np.int64)
+		clonotypes[clinical_pos[matched]] = clonotype_idx[matched]
+
+		return analytics.create_embedding_grid(
+			clinical_df, embedding_columns, group_key, clonotypes, fine_bins
+		)
+
+
+	def embedding_composition(
+			self,
+			meta_keys=[],
+			bins=(40, 20),
+			embedding_columns=['X_UMAP', 'Y_UMAP'],
+			fine_bins=analytics.FINE_BINS,
+		):
+		"""
+		Number of cells and fraction of every group in every bin of the embedding\n
+		Cells are binned once on a fine grid, any bins is re-binned from it
+
+		Parameters
+		----------
+		meta_keys : List[str]
+			List of metadata keys for grouping \n
+			Eg: ['Condition']
+		bins : int or (int, int)
+			Number of bins along x and y, exact when it divides fine_bins
+		embedding_columns : List[str]
+			x, y columns of the clinical metadata
+		fine_bins : int or (int, int)
+			Resolution of the fine grid
+
+		Returns
+		----------
+		Pandas dataframe, one row per non-empty bin: X, Y (bin centers), n_cells, one fraction column per group
+		"""
+		if not len(meta_keys):
+			raise Exception('Need at least one meta column to compare')
+
+		grid = self._prepare_embedding_grid(meta_keys, embedding_columns, fine_bins)
+		return grid.composition(bins)
+
+
+	def embedding_diversity(
+			self,
+			bins=(40, 20),
+			embedding_columns=['X_UMAP', 'Y_UMAP'],
+			hill_orders=(0, 1, 2),
+			fine_bins=analytics.FINE_BINS,
+			clusters=None,
+		):
+		"""
+		Clonotype diversity of the cells of every bin of the embedding, one count per cell
+
+		Parameters
+		----------
+		bins : int or (int, int)
+			Number of bins along x and y, exact when it divides fine_bins
+		embedding_columns : List[str]
+			x, y columns of the clinical metadata
+		hill_orders : List[float]
+			Orders q of the Hill numbers
+		fine_bins : int or (int, int)
+			Resolution of the fine grid
+		clusters : Dict
+			Count fuzzy clonotypes instead of raw_clonotype_id, see cdr3_clusters
+
+		Returns
+		----------
+		Pandas dataframe, one row per bin having clonotypes: X, Y (bin centers), n_cells, n_clonotypes, diversity metrics
+		"""
+		grid = self._prepare_embedding_grid([], embedding_columns, fine_bins, clusters)
+		return grid.diversity(bins, hill_orders)
+
+
+	def matplotlib_embedding_composition(self, meta_keys=[], bins=(40, 20), embedding_columns=['X_UMAP', 'Y_UMAP']):
+		"""
+		One pie per bin of the embedding, see embedding_composition
+
+		Returns
+		----------
+		Matplotlib image
+		"""
+		composition_df = self.embedding_composition(meta_keys, bins, embedding_columns)
+		return analytics.visualize_embedding_composition(composition_df)
+
+
+	def plotly_embedding_composition(self, meta_keys=[], bins=(40, 20), embedding_columns=['X_UMAP', 'Y_UMAP']):
+		"""
+		Produce dataframe for plotly: fraction of every group in every bin, see embedding_composition
+
+		Returns
+		----------
+		Pandas dataframe using for plotly, columns: 'X', 'Y', 'n_cells', <group name>, 'Ratio'
+		"""
+		composition_df = self.embedding_composition(meta_keys, bins, embedding_columns)
+		return analytics.plotly_embedding_composition(
+			composition_df, grouping.GROUP_SEP.join(meta_keys)
+		)
+
+
+	def matplotlib_embedding_diversity(self, bins=(40, 20), embedding_columns=['X_UMAP', 'Y_UMAP'], metric='shannon'):
+		"""
+		Diversity metric of every bin of the embedding, see embedding_diversity
+
+		Returns
+		----------
+		Matplotlib image
+		"""
+		diversity_df = self.embedding_diversity(bins, embedding_columns)
+		return analytics.visualize_embedding_diversity(diversity_df, metric)
+
+
+	def export(self, analysis, path, **params):
+		"""
+		Save the plotly dataframe of an analysis as a typed artifact (see common.export.write_artifact)\n
+		Embedded metadata: analysis, params, samples and input files
+
+		Parameters
+		----------
+		analysis : str
+			Name of a plotly_ method without prefix, Eg: 'clonotypes_QC_fraction', 'clonotypes_expansion'
+		path : str
+			.parquet: Parquet, otherwise (eg: .arrow): Arrow IPC file, loaded memory-mapped by common.export.read_artifact
+		params :
+			Parameters of the plotly_ method, Eg: meta_keys=['Condition'], lower_n=5
+
+		Returns
+		----------
+		path
+		"""
+		func = getattr(self, 'plotly_{}'.format(analysis), None)
+		if func is None:
+			raise Exception('cannot find plotly_{}'.format(analysis))
+
+		return export.write_artifact(
+			func(**params),
+			path,
+			{
+				'analysis': analysis,
+				'params': params,
+				'samples': self.__samples,
+				'inputs': self._fingerprints(),
+				'layout_version': H5_LAYOUT_VERSION,
+			}
+		)
@@ -1,10 +1,12 @@
 import os
+import gzip
 import json
 import h5py
 import uuid
 import numpy as np
 import pandas as pd
 
+from .constants import BARCODE_ENCODING
 from .constants import VDJ_10X_COLUMNS
 
 
@@ -48,16 +50,68 @@ def read_json(path):
 	return data
 
 
-def read_csv(path, **kwargs):
-	df = pd.read_csv(filepath_or_buffer=path, sep="\t", **kwargs)
+def _open_text(path):
+	if str(path).endswith('.gz'):
+		return gzip.open(path, 'rt', encoding='utf-8')
+	return open(path, 'r', encoding='utf-8')
 
-	if "index_col" in kwargs:
-		if len(df.columns) == 0:
-			return pd.read_csv(filepath_or_buffer=path, sep=",", **kwargs)
-	else:
-		if len(df.columns) < 2:
-			return pd.read_csv(filepath_or_buffer=path, sep=",", **kwargs)
-	return df
+
+def read_header(path, n_bytes=1 << 16):
+	with _open_text(path) as f:
+		header = f.readline(n_bytes)
+	return header.rstrip('\r\n')
+
+
+def sniff_delimiter(path):
+	"""
+	Pick tab or comma from the header line (plain text or .gz)
+	"""
+	header = read_header(path)
+	if header.count(',') > header.count('\t'):
+		return ','
+	return '\t'
+
+
+def read_csv(path, **kwargs):
+	if 'sep' not in kwargs:
+		kwargs['sep'] = sniff_delimiter(path)
+	return pd.read_csv(filepath_or_buffer=path, **kwargs)
+
+
+def read_columns_csv(path, columns, dtype={}, **kwargs):
+	"""
+	Parse only the chosen columns, column names are matched case-insensitively
+
+	Parameters
+	----------
+	path : str
+		.csv / .tsv, optionally gzipped
+	columns : List[str]
+		lower-case column names
+	dtype : Dict
+		lower-case column name -> dtype
+
+	Returns
+	----------
+	Pandas dataframe with lower-case column names
+	"""
+	sep = sniff_delimiter(path)
+	header = [i.strip('"') for i in read_header(path).split(sep)]
+	lower_2_header = {i.lower(): i for i in header}
+
+	missing_columns = [i for i in columns if i not in lower_2_header]
+	if len(missing_columns):
+		raise Exception('cannot find columns {} in {}'.format(missing_columns, path))
+
+	df = pd.read_csv(
+		filepath_or_buffer=path,
+		sep=sep,
+		usecols=[lower_2_header[i] for i in columns],
+		dtype={lower_2_header[k]: v for k, v in dtype.items() if k in lower_2_header},
+		**kwargs
+	)
+	df.columns = [i.lower() for i in df.columns]
+	return df[columns]
 
 
 def write_csv(path, content, **kwargs):
@@ -90,10 +144,202 @@ class H5AtomicWriter(h5py.File):
 			os.remove(self._temp_path)
 
 
-# TODO: hashtable -> Optimize memory
+# 10X barcode: <sample prefix><16 nt>[-<GEM well>]
+# -> uint64: 0 (1 bit) | prefix code (23 bits) | GEM well + 1 (8 bits) | 2 bits per nucleotide (32 bits)
+# other barcodes -> 1 (1 bit) | 63 bits of hash: packed and hashed keys never collide
+BARCODE_N_NT = 16
+_MAX_PREFIX_CODE = 1 << 23
+_HASHED_BIT = np.uint64(1 << 63)
+_NT_LOOKUP = np.full(256, 255, dtype=np.uint8)
+for _i, _nt in enumerate(b'ACGT'):
+	_NT_LOOKUP[_nt] = _i
+
+
+def _to_byte_matrix(arr):
+	arr = np.asarray(arr)
+	if arr.dtype.kind != 'S':
+		arr = arr.astype('S')
+	width = max(arr.dtype.itemsize, 1)
+	arr = arr.astype('S{}'.format(width))
+	return arr.view(np.uint8).reshape(len(arr), width)
+
+
+def _is_digit(arr):
+	return (arr >= ord('0')) & (arr <= ord('9'))
+
+
+def _pack_10X_barcodes(arr):
+	"""
+	Returns packed uint64 barcodes, None if some barcodes are not 10X-like
+	"""
+	n = len(arr)
+	if n == 0:
+		return np.zeros(0, dtype=np.uint64)
+	try:
+		mat = _to_byte_matrix(arr)
+	except UnicodeEncodeError:
+		return None
+	width = mat.shape[1]
+	rows = np.arange(n)
+	lengths = np.count_nonzero(mat, axis=1)
+	if np.any(lengths < BARCODE_N_NT):
+		return None
+
+	# optional '-N' / '-NN' GEM well suffix, stored + 1 (0 = no suffix)
+	last_1 = mat[rows, lengths - 1].astype(np.uint64)
+	last_2 = mat[rows, lengths - 2].astype(np.uint64)
+	last_3 = mat[rows, np.maximum(lengths - 3, 0)].astype(np.uint64)
+	has_1_digit = (last_2 == ord('-')) & _is_digit(last_1)
+	# no leading zero, '-01' and '-1' must not collide
+	has_2_digits = (
+		~has_1_digit & (lengths >= 3) & (last_3 == ord('-'))
+		& _is_digit(last_2) & (last_2 != ord('0')) & _is_digit(last_1)
+	)
+	core_end = lengths - 2 * has_1_digit - 3 * has_2_digits
+	suffix = np.zeros(n, dtype=np.uint64)
+	suffix[has_1_digit] = last_1[has_1_digit] - ord('0') + 1
+	suffix[has_2_digits] = (last_2[has_2_digits] - ord('0')) * 10 + last_1[has_2_digits] - ord('0') + 1
+
+	core_start = core_end - BARCODE_N_NT
+	if np.any(core_start < 0):
+		return None
+	nt = _NT_LOOKUP[mat[rows[:, None], core_start[:, None] + np.arange(BARCODE_N_NT)]]
+	if np.any(nt == 255):
+		return None
+	packed = np.zeros(n, dtype=np.uint64)
+	for i in range(BARCODE_N_NT):
+		packed = (packed << np.uint64(2)) | nt[:, i].astype(np.uint64)
+
+	prefix_width = int(core_start.max())
+	prefix_codes = np.zeros(n, dtype=np.int64)
+	if prefix_width:
+		prefix = mat[:, :prefix_width].copy()
+		prefix[np.arange(prefix_width)[None, :] >= core_start[:, None]] = 0
+		prefix_codes, prefix_uniques = pd.factorize(
+			prefix.reshape(-1).view('S{}'.format(prefix_width))
+		)
+		if len(prefix_uniques) >= _MAX_PREFIX_CODE:
+			return None
+
+	return (
+		(prefix_codes.astype(np.uint64) << np.uint64(40))
+		| (suffix << np.uint64(32))
+		| packed
+	)
+
+
+def pack_barcodes(*arrs, prefix_code=None, return_encoding=False):
+	"""
+	uint64 keys of barcodes, stable across files\n
+	10X barcodes are packed: exact keys, same barcode <-> same key\n
+	If some barcodes cannot be packed, all arrays fall back to 64-bit hashes of the whole strings:
+	same barcode -> same key, different barcodes may collide\n
+	Hashed keys have their top bit set, packed keys do not (see barcode_encoding)
+
+	Parameters
+	----------
+	prefix_code : int
+		Replace the code of the (single) sample prefix, eg: the sample ordinal\n
+		Hashed keys are mixed with it: same barcode in 2 samples -> different keys
+	return_encoding : bool
+		Also return the BARCODE_ENCODING value of the keys
+
+	Returns
+	----------
+	List of uint64 arrays, one per input array (, encoding)
+	"""
+	arrs = [np.asarray(i, dtype='O') for i in arrs]
+	splits = np.cumsum([len(i) for i in arrs])[:-1]
+	all_barcodes = np.concatenate(arrs)
+
+	keys = _pack_10X_barcodes(all_barcodes)
+	if keys is not None and prefix_code is not None and len(keys):
+		if np.any((keys >> np.uint64(40)) != (keys[0] >> np.uint64(40))) or prefix_code >= _MAX_PREFIX_CODE:
+			keys = None
+		else:
+			keys = (keys & np.uint64((1 << 40) - 1)) | (np.uint64(prefix_code) << np.uint64(40))
+	encoding = BARCODE_ENCODING.PACKED.value
+	if keys is None:
+		encoding = BARCODE_ENCODING.HASHED.value
+		keys = pd.util.hash_array(all_barcodes)
+		if prefix_code is not None:
+			# multiplication wraps around 2^64 on purpose
+			with np.errstate(over='ignore'):
+				keys = keys ^ (np.uint64(prefix_code + 1) * np.uint64(0x9E3779B97F4A7C15))
+		keys = keys | _HASHED_BIT
+	if return_encoding:
+		return np.split(keys, splits), encoding
+	return np.split(keys, splits)
+
+
+def barcode_encoding(keys, previous=None):
+	"""
+	BARCODE_ENCODING value of pack_barcodes keys, merged with the previous encoding of the same column
+
+	Parameters
+	----------
+	keys : np.ndarray[uint64]
+	previous : str
+		Encoding of the keys saved before, None: no keys saved before
+	"""
+	keys = np.asarray(keys, dtype=np.uint64)
+	hashed = (keys & _HASHED_BIT) != 0
+	if not len(keys):
+		encoding = previous
+	elif np.all(hashed):
+		encoding = BARCODE_ENCODING.HASHED.value
+	elif not np.any(hashed):
+		encoding = BARCODE_ENCODING.PACKED.value
+	else:
+		encoding = BARCODE_ENCODING.MIXED.value
+	if previous is None or encoding == previous:
+		return encoding
+	return BARCODE_ENCODING.MIXED.value
+
+
+def encode_barcodes(*arrs):
+	"""
+	Encode barcode arrays to comparable integer keys (same barcode -> same key)\n
+	uint64 arrays (eg: pack_barcodes output) are used as they are,
+	strings are factorized together in one hash pass
+	"""
+	arrs = [np.asarray(i) for i in arrs]
+	if all(i.dtype == np.uint64 for i in arrs):
+		return arrs
+
+	splits = np.cumsum([len(i) for i in arrs])[:-1]
+	keys, _ = pd.factorize(np.concatenate(arrs))
+	return np.split(keys, splits)
+
+
+def barcodes_indexer(arr1, arr2):
+	"""
+	Sorted search of arr1 barcodes in arr2 (barcode strings or uint64 keys)
+
+	Returns
+	----------
+	chosen_idx_arr1 : np.ndarray[bool]
+		arr1 barcodes found in arr2
+	idx_arr2 : np.ndarray[int64]
+		For each arr1 barcode: position of the (first) matched barcode in arr2, -1 if not found
+	"""
+	keys1, keys2 = encode_barcodes(arr1, arr2)
+	order = np.argsort(keys2, kind='stable')
+	sorted_keys2 = keys2[order]
+
+	pos = np.searchsorted(sorted_keys2, keys1)
+	pos = np.minimum(pos, max(len(sorted_keys2) - 1, 0))
+	if len(sorted_keys2):
+		chosen_idx_arr1 = sorted_keys2[pos] == keys1
+	else:
+		chosen_idx_arr1 = np.zeros(len(keys1), dtype=np.bool_)
+	idx_arr2 = np.full(len(keys1), -1, dtype=np.int64)
+	idx_arr2[chosen_idx_arr1] = order[pos[chosen_idx_arr1]]
+	return chosen_idx_arr1, idx_arr2
+
+
 def matching_barcodes_idx(arr1, arr2):
-	tmp_dct = {i: j for j, i in enumerate(arr2)}
-	chosen_idx_arr1 = np.array([True if i in tmp_dct else False for i in arr1])
+	chosen_idx_arr1, _ = barcodes_indexer(arr1, arr2)
 	return chosen_idx_arr1
 
 
@@ -110,10 +356,7 @@ def extract_h5(h5_path, key):
 
 
 def concat_df(df_list, **kwargs):
-	final_df = None
-	for df in df_list:
-		if final_df is None:
-			final_df = df
-		else:
-			final_df = pd.concat([final_df, df], **kwargs)
-	return final_df
\ No newline at end of file
+	df_list = [df for df in df_list if df is not None]
+	if not len(df_list):
+		return None
+	return pd.concat(df_list, **kwargs)
@@ -0,0 +1,107 @@
+import os
+import json
+import uuid
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def file_fingerprint(path):
+	"""
+	Cheap identity of a file content: (absolute path, size, mtime)\n
+	Re-ingesting / appending to a h5 changes its size or mtime -> new cache keys
+	"""
+	stat = os.stat(path)
+	return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def make_key(*parts):
+	"""
+	Hash json-serializable parts (lists, dicts, str, numbers) into a cache key
+	"""
+	content = json.dumps(parts, sort_keys=True, default=str)
+	return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class ResultCache(object):
+	def __init__(self, max_size=32, cache_dir=None):
+		"""
+		In-memory LRU cache, optionally backed by pickles in cache_dir
+
+		Parameters
+		----------
+		max_size : int
+			Max number of results kept in memory, least recently used results are evicted first
+		cache_dir : str
+			If provided, results are also saved on disk and survive the process
+		"""
+		self._max_size = max_size
+		self._cache_dir = cache_dir
+		self._memory = OrderedDict()
+		self._lock = threading.RLock()
+		if cache_dir is not None and not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir, exist_ok=True)
+
+
+	def _disk_path(self, key):
+		return os.path.join(self._cache_dir, '{}.pkl'.format(key))
+
+
+	def _set_memory(self, key, value):
+		with self._lock:
+			self._memory[key] = value
+			self._memory.move_to_end(key)
+			while len(self._memory) > self._max_size:
+				self._memory.popitem(last=False)
+
+
+	def get(self, key, default=None):
+		with self._lock:
+			if key in self._memory:
+				self._memory.move_to_end(key)
+				return self._memory[key]
+
+		if self._cache_dir is not None and os.path.isfile(self._disk_path(key)):
+			try:
+				with open(self._disk_path(key), 'rb') as f:
+					value = pickle.load(f)
+			except (EOFError, pickle.UnpicklingError):
+				return default
+			self._set_memory(key, value)
+			return value
+		return default
+
+
+	def set(self, key, value):
+		self._set_memory(key, value)
+		if self._cache_dir is not None:
+			temp_path = '{}.TEMP{}'.format(self._disk_path(key), uuid.uuid4().hex)
+			with open(temp_path, 'wb') as f:
+				pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+			os.replace(temp_path, self._disk_path(key))
+		return value
+
+
+	def __contains__(self, key):
+		with self._lock:
+			if key in self._memory:
+				return True
+		return self._cache_dir is not None and os.path.isfile(self._disk_path(key))
+
+
+	def get_or_compute(self, key, func, *args, **kwargs):
+		_missing = object()
+		value = self.get(key, _missing)
+		if value is _missing:
+			value = self.set(key, func(*args, **kwargs))
+		return value
+
+
+	def clear(self, disk=False):
+		with self._lock:
+			self._memory.clear()
+		if disk and self._cache_dir is not None:
+			for i in os.listdir(self._cache_dir):
+				if i.endswith('.pkl'):
+					os.remove(os.path.join(self._cache_dir, i))
@@ -20,3 +20,87 @@ class VDJ_10X_COLUMNS(Enum):
 	EXACT_SUBCLONOTYPE_ID='exact_subclonotype_id'
 
 SAMPLE_NAME = 'sample_name'
+# packed uint64 barcode saved at ingest, see common.pack_barcodes
+BARCODE_KEY = 'barcode_key'
+# attribute of the BARCODE_KEY column: encoding of its keys, see common.barcode_encoding
+BARCODE_ENCODING_ATTR = 'barcode_encoding'
+# uint8 amino acid length of cdr3 saved at ingest, 0: missing cdr3
+CDR3_LENGTH = 'cdr3_length'
+# fuzzy CDR3 clusters, see compute.clonotypes_clustering
+CDR3_CLUSTER = 'cdr3_cluster'
+CLONOTYPE_CLUSTER = 'clonotype_cluster'
+
+
+# per-cell summary saved at ingest next to the contigs, see compute.processing.summarize_cells
+class CELL_COLUMNS(Enum):
+	N_TRA='n_TRA'
+	N_TRB='n_TRB'
+	N_TRG='n_TRG'
+	N_TRD='n_TRD'
+	PAIRING='pairing'
+	CDR3_TRA='cdr3_TRA'
+	CDR3_TRB='cdr3_TRB'
+	UMIS_MIN='umis_min'
+	UMIS_SUM='umis_sum'
+	UMIS_MAX='umis_max'
+	CONTIG_START='contig_start'
+	N_CONTIGS='n_contigs'
+
+# pairing category of a cell by its number of TRA / TRB contigs
+PAIRING_TYPES = (
+	'1 TRA - 1 TRB',
+	'2 TRA - 2 TRB',
+	'0 TRA - 1 TRB',
+	'0 TRA - 2 TRB',
+	'1 TRA - 0 TRB',
+	'2 TRA - 0 TRB',
+	'2 TRA - 1 TRB',
+	'1 TRA - 2 TRB',
+	'others',
+)
+
+# numeric / boolean fields are left to the parser
+VDJ_10X_DTYPES = {
+	VDJ_10X_COLUMNS.BARCODE.value: str,
+	VDJ_10X_COLUMNS.CHAIN.value: 'category',
+	VDJ_10X_COLUMNS.V_GENE.value: 'category',
+	VDJ_10X_COLUMNS.D_GENE.value: 'category',
+	VDJ_10X_COLUMNS.J_GENE.value: 'category',
+	VDJ_10X_COLUMNS.C_GENE.value: 'category',
+	VDJ_10X_COLUMNS.CDR3.value: str,
+	VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value: str,
+	VDJ_10X_COLUMNS.RAW_CONSENSUS_ID.value: str,
+}
+
+
+class ENCODING(Enum):
+	NUMERIC='numeric'
+	CATEGORICAL='categorical'
+	STRING='string'
+
+
+# BARCODE_KEY values: exact packed barcodes, or 64-bit hashes of barcodes that cannot be packed
+class BARCODE_ENCODING(Enum):
+	PACKED='packed'
+	HASHED='hashed'
+	MIXED='mixed'
+
+H5_LAYOUT_VERSION = 2
+
+# low-cardinality / repeated VDJ fields -> stored as integer codes + dictionary
+CATEGORICAL_COLUMNS = (
+	VDJ_10X_COLUMNS.CHAIN.value,
+	VDJ_10X_COLUMNS.V_GENE.value,
+	VDJ_10X_COLUMNS.D_GENE.value,
+	VDJ_10X_COLUMNS.J_GENE.value,
+	VDJ_10X_COLUMNS.C_GENE.value,
+	VDJ_10X_COLUMNS.CDR3.value,
+	VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value,
+	SAMPLE_NAME,
+)
+
+# categorical VDJ columns having an inverted index (value -> rows) saved at ingest
+INDEXED_COLUMNS = (
+	VDJ_10X_COLUMNS.CDR3.value,
+	VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value,
+)
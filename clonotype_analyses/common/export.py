@@ -0,0 +1,113 @@
+import os
+import json
+import uuid
+import numpy as np
+import pandas as pd
+
+
+# key of the json metadata embedded in the schema of every artifact
+ARTIFACT_METADATA_KEY = b'clonotype_analyses'
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+
+
+def normalize_rows(df, dtype=None):
+	"""
+	Every row divided by its sum in one pass, rows summing to 0 become NaN
+
+	Parameters
+	----------
+	dtype : np.dtype
+		Cast the values before normalizing, default: keep the dtype
+	"""
+	values = df.values if dtype is None else df.values.astype(dtype)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		values = values / values.sum(axis=1, keepdims=True)
+	return pd.DataFrame(values, index=df.index, columns=df.columns)
+
+
+def to_long(df, names, dropna=False):
+	"""
+	Matrix (index x columns) -> long format, one row per cell, row-major order
+
+	Parameters
+	----------
+	names : List[str]
+		[index column, column column, value column], Eg: ['Groups', 'Clonotypes size', 'Ratio']
+	dropna : bool
+		Drop cells with missing values (same as DataFrame.stack)
+
+	Returns
+	----------
+	pd.DataFrame
+	"""
+	n_rows, n_columns = df.shape
+	values = df.values.reshape(-1)
+	long_df = pd.DataFrame({
+		names[0]: np.repeat(df.index.values, n_columns),
+		names[1]: np.tile(df.columns.values, n_rows),
+		names[2]: values,
+	})
+	if dropna:
+		long_df = long_df.iloc[~pd.isna(values), :].reset_index(drop=True)
+	return long_df
+
+
+def _pyarrow():
+	try:
+		import pyarrow
+		import pyarrow.parquet
+	except ImportError:
+		raise Exception('pyarrow is required for artifacts: pip install pyarrow')
+	return pyarrow
+
+
+def _is_parquet(path):
+	return str(path).lower().endswith(PARQUET_EXTENSIONS)
+
+
+def write_artifact(df, path, metadata=None):
+	"""
+	Save a dataframe as a typed artifact, format from the extension:
+	.parquet / .pq: Parquet, otherwise (eg: .arrow): Arrow IPC file\n
+	Written aside then renamed: readers never see a half-written artifact
+
+	Parameters
+	----------
+	metadata : Dict
+		json-serializable, eg: analysis name and parameters, embedded in the schema
+	"""
+	pa = _pyarrow()
+	table = pa.Table.from_pandas(df)
+	schema_metadata = dict(table.schema.metadata or {})
+	schema_metadata[ARTIFACT_METADATA_KEY] = json.dumps(metadata or {}, default=str)
+	table = table.replace_schema_metadata(schema_metadata)
+
+	temp_path = '{}.TEMP{}'.format(path, uuid.uuid4().hex)
+	if _is_parquet(path):
+		pa.parquet.write_table(table, temp_path)
+	else:
+		with pa.OSFile(temp_path, 'wb') as sink:
+			with pa.ipc.new_file(sink, table.schema) as writer:
+				writer.write_table(table)
+	os.replace(temp_path, path)
+	return path
+
+
+def read_artifact(path, memory_map=True):
+	"""
+	Load an artifact saved by write_artifact\n
+	Arrow IPC files are memory-mapped: numeric columns without missing values are not copied
+
+	Returns
+	----------
+	df : pd.DataFrame
+	metadata : Dict
+	"""
+	pa = _pyarrow()
+	if _is_parquet(path):
+		table = pa.parquet.read_table(path, memory_map=memory_map)
+	else:
+		source = pa.memory_map(path, 'r') if memory_map else pa.OSFile(path, 'rb')
+		table = pa.ipc.open_file(source).read_all()
+	metadata = json.loads((table.schema.metadata or {}).get(ARTIFACT_METADATA_KEY, b'{}'))
+	return table.to_pandas(split_blocks=True), metadata
@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+
+
+GROUP_SEP = '<<>>'
+
+
+class GroupKey(object):
+	def __init__(self, codes, groups, meta_keys):
+		"""
+		Integer code of every row for a tuple of metadata columns
+
+		Parameters
+		----------
+		codes : np.ndarray[int64]
+			Group code of every row, codes are ordered by label
+		groups : pd.MultiIndex
+			Metadata values of every code
+		meta_keys : List[str]
+		"""
+		self.codes = codes
+		self.groups = groups
+		self.meta_keys = list(meta_keys)
+		self.__labels = None
+
+
+	@property
+	def n_groups(self):
+		return len(self.groups)
+
+
+	@property
+	def name(self):
+		"""
+		Display name of the grouping, Eg: 'Condition<<>>Subject ID'
+		"""
+		return GROUP_SEP.join(self.meta_keys)
+
+
+	@property
+	def labels(self):
+		"""
+		Display label of every code: the value itself for one key, '<<>>'-joined values otherwise\n
+		Only n_groups labels are built, never one per row
+		"""
+		if self.__labels is None:
+			self.__labels = _group_labels(self.groups)
+		return self.__labels
+
+
+	def level_values(self, meta_key):
+		"""
+		Value of meta_key for every code
+		"""
+		return self.groups.get_level_values(self.meta_keys.index(meta_key)).values
+
+
+	def row_labels(self):
+		return self.labels[self.codes]
+
+
+def _group_labels(groups):
+	if groups.nlevels == 1:
+		return np.asarray(groups.get_level_values(0), dtype='O')
+	return np.array([
+		GROUP_SEP.join(str(j) for j in i) for i in groups
+	], dtype='O')
+
+
+def _label_order(labels):
+	try:
+		return np.argsort(labels, kind='stable')
+	except TypeError:
+		# mixed types: compare as strings
+		return np.argsort(labels.astype('str'), kind='stable')
+
+
+def _observed_values(values):
+	# categorical columns of a sample subset keep the categories of every sample: only keep the observed ones
+	if isinstance(values, pd.Categorical):
+		return values.remove_unused_categories()
+	return values
+
+
+def factorize_groups(df, meta_keys, rows=None):
+	"""
+	Encode a tuple of metadata columns as one integer code per row, the input is never modified
+
+	Parameters
+	----------
+	df : pd.DataFrame
+	meta_keys : List[str]
+	rows : np.ndarray[int]
+		Only encode these rows (positions), default: all rows
+
+	Returns
+	----------
+	GroupKey
+		Codes follow the sorted order of the labels, missing values form their own group
+	"""
+	if not len(meta_keys):
+		raise Exception('Need at least one meta column to compare')
+
+	n_rows = len(df) if rows is None else len(rows)
+	codes = np.zeros(n_rows, dtype=np.int64)
+	for k in meta_keys:
+		values = df[k].values
+		if rows is not None:
+			values = values[rows]
+		col_codes, uniques = pd.factorize(values, use_na_sentinel=False)
+		# mixed radix then re-factorize -> codes stay < n_rows, no overflow for any number of keys
+		codes, _ = pd.factorize(codes * len(uniques) + col_codes)
+
+	# codes are numbered by first appearance -> first row of every code, in code order
+	first_rows = np.flatnonzero(~pd.Index(codes).duplicated())
+	if rows is not None:
+		first_rows = np.asarray(rows)[first_rows]
+	groups = pd.MultiIndex.from_arrays(
+		[_observed_values(df[k].values[first_rows]) for k in meta_keys],
+		names=meta_keys
+	)
+
+	n_codes = len(first_rows)
+	order = _label_order(_group_labels(groups))
+	new_codes = np.empty(n_codes, dtype=np.int64)
+	new_codes[order] = np.arange(n_codes)
+	return GroupKey(new_codes[codes], groups[order], meta_keys)
@@ -0,0 +1,1004 @@
+import json
+import h5py
+import numpy as np
+import pandas as pd
+from contextlib import contextmanager
+
+from .constants import ENCODING
+from .constants import CATEGORICAL_COLUMNS
+from .constants import H5_LAYOUT_VERSION
+
+
+# Each column is stored by its own encoding:
+# - numeric: one chunked, compressed dataset with the native dtype
+# - categorical: group with integer 'codes' (-1 = missing) and vlen-str 'categories'
+# - string: one chunked, compressed vlen-str dataset
+# -> only the needed columns are read, repeated gene names / metadata are stored once
+CHUNK_ROWS = 1 << 16
+CODES_DTYPE = np.int32
+CATEGORIES_CHUNK_ROWS = 1 << 10
+CATEGORICAL_MAX_RATIO = 0.5
+STR_DTYPE = h5py.string_dtype(encoding='utf-8')
+SAMPLES_GROUP = '__samples__'
+INDEX_GROUP = '__index__'
+# one row per cell, same layout as the contigs, attr 'n_contig_rows': number of contigs it summarizes
+CELLS_GROUP = '__cells__'
+# pending append_samples, see begin_append
+JOURNAL = '__journal__'
+# columns rewritten during a pending append (dtype promotion), restored by rollback_append
+JOURNAL_BACKUP = '__journal_backup__'
+TEMP_SUFFIX = '.TEMP'
+# below this number of rows, rows are read one by one (fancy indexing), above: the covering range is read
+MAX_FANCY_ROWS = 1 << 10
+
+
+def _compression_kwargs(compression):
+	if compression is None:
+		return {}
+	if compression == 'gzip':
+		return {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True}
+	return {'compression': compression}
+
+
+def _create_array(f, name, data, dtype, compression):
+	return f.create_dataset(
+		name,
+		data=data,
+		dtype=dtype,
+		chunks=(CHUNK_ROWS,),
+		maxshape=(None,),
+		**_compression_kwargs(compression)
+	)
+
+
+def _to_str_array(values):
+	values = np.asarray(values, dtype='O')
+	missing = pd.isna(values)
+	if np.any(missing):
+		values = values.copy()
+		values[missing] = ''
+	return values.astype('str').astype('O')
+
+
+def column_encoding(series, name=None):
+	"""
+	Pick the storage encoding of a pandas column
+	"""
+	if isinstance(series.dtype, pd.CategoricalDtype):
+		return ENCODING.CATEGORICAL.value
+	if (
+		pd.api.types.is_numeric_dtype(series.dtype)
+		and not pd.api.types.is_extension_array_dtype(series.dtype)
+	):
+		return ENCODING.NUMERIC.value
+	if name in CATEGORICAL_COLUMNS:
+		return ENCODING.CATEGORICAL.value
+
+	n_rows = len(series)
+	if n_rows and series.nunique(dropna=True) <= CATEGORICAL_MAX_RATIO * n_rows:
+		return ENCODING.CATEGORICAL.value
+	return ENCODING.STRING.value
+
+
+def encode_categorical(values):
+	"""
+	Returns
+	----------
+	codes: np.ndarray[int32], -1 for missing values
+	categories: np.ndarray[object] of str
+	"""
+	if isinstance(values, pd.Series):
+		values = values.array if isinstance(values.dtype, pd.CategoricalDtype) else values.to_numpy()
+	if isinstance(values, pd.Categorical):
+		codes = values.codes
+		categories = values.categories.values
+	else:
+		codes, categories = pd.factorize(values, use_na_sentinel=True)
+	return codes.astype(CODES_DTYPE), _to_str_array(categories)
+
+
+def missing_dtype(dtype):
+	"""
+	Numeric dtype able to hold missing values (NaN): floats are kept, anything else -> float64
+	"""
+	if np.issubdtype(dtype, np.floating):
+		return np.dtype(dtype)
+	return np.result_type(dtype, np.float64)
+
+
+def _missing_values(dtype, n_rows):
+	return np.full(n_rows, np.nan, dtype=missing_dtype(dtype))
+
+
+def _append_array(ds, values):
+	start = ds.shape[0]
+	ds.resize((start + len(values),))
+	ds[start:] = values
+	return ds
+
+
+def check_sample_names(sample_names):
+	"""
+	Row offsets are keyed by sample name: with several samples, names must be unique and non-empty
+	"""
+	if len(sample_names) <= 1:
+		return
+	empty_names = [i for i in sample_names if not len(i)]
+	duplicated_names = sorted(set([i for i in sample_names if len(i) and sample_names.count(i) > 1]))
+	if len(empty_names) or len(duplicated_names):
+		raise Exception('several samples need unique, non-empty sample names: {} empty, duplicated: {}'.format(
+			len(empty_names), duplicated_names
+		))
+
+
+class H5ColumnWriter(object):
+	"""
+	Append dataframes (eg: one per sample) to columnar datasets of an opened h5
+
+	Categorical dictionaries are merged across appends,
+	columns missing in some dataframes are filled with missing values (NaN for numeric columns)
+	and the row offsets of every appended dataframe are recorded in SAMPLES_GROUP.\n
+	Numeric columns are promoted to the common dtype of their values (np.result_type),
+	numeric columns receiving non-numeric values are rewritten as categorical columns.
+	"""
+	def __init__(self, f, index_name, compression='gzip'):
+		self._f = f
+		self._index_name = index_name
+		self._compression = compression
+		self._categories = {}
+		self._sample_names = []
+		self._sample_offsets = [0]
+
+		if 'layout_version' not in f.attrs:
+			f.attrs['layout_version'] = H5_LAYOUT_VERSION
+			f.attrs['n_rows'] = 0
+			f.attrs['index_name'] = index_name
+		elif f.attrs['layout_version'] != H5_LAYOUT_VERSION:
+			raise Exception('cannot append to h5 layout version {}'.format(f.attrs['layout_version']))
+
+		if SAMPLES_GROUP in f:
+			self._sample_names = list(f[SAMPLES_GROUP]['names'].asstr()[:])
+			self._sample_offsets = list(f[SAMPLES_GROUP]['offsets'][:])
+
+
+	@property
+	def n_rows(self):
+		return int(self._f.attrs['n_rows'])
+
+
+	def _get_categories(self, name):
+		if name not in self._categories:
+			self._categories[name] = pd.Index(
+				self._f[name]['categories'].asstr()[:]
+			)
+		return self._categories[name]
+
+
+	def _create_column(self, name, encoding, dtype=None, n_rows=None):
+		f = self._f
+		n_rows = self.n_rows if n_rows is None else n_rows
+		if encoding == ENCODING.NUMERIC.value:
+			# earlier rows are missing -> the column must hold NaN
+			if n_rows:
+				dtype = missing_dtype(dtype)
+				data = _missing_values(dtype, n_rows)
+			else:
+				data = np.zeros(0, dtype=dtype)
+			node = _create_array(f, name, data, dtype, self._compression)
+		elif encoding == ENCODING.CATEGORICAL.value:
+			node = f.create_group(name)
+			_create_array(
+				node, 'codes', np.full(n_rows, -1, dtype=CODES_DTYPE),
+				CODES_DTYPE, self._compression
+			)
+			node.create_dataset(
+				'categories',
+				shape=(0,),
+				dtype=STR_DTYPE,
+				chunks=(CATEGORIES_CHUNK_ROWS,),
+				maxshape=(None,),
+			)
+			self._categories[name] = pd.Index([], dtype='O')
+		elif encoding == ENCODING.STRING.value:
+			node = _create_array(f, name, np.full(n_rows, '', dtype='O'), STR_DTYPE, self._compression)
+		else:
+			raise Exception('unknown encoding: {}'.format(encoding))
+
+		node.attrs['encoding'] = encoding
+		return node
+
+
+	def _append_categorical(self, name, series):
+		codes, categories = encode_categorical(series)
+		all_categories = self._get_categories(name)
+
+		lookup = all_categories.get_indexer(categories)
+		is_new = lookup == -1
+		if np.any(is_new):
+			lookup[is_new] = len(all_categories) + np.arange(np.sum(is_new))
+			_append_array(self._f[name]['categories'], categories[is_new])
+			self._categories[name] = all_categories.append(pd.Index(categories[is_new], dtype='O'))
+
+		if len(lookup):
+			codes = np.where(codes >= 0, lookup[codes], -1).astype(CODES_DTYPE)
+		_append_array(self._f[name]['codes'], codes)
+
+
+	def _promote_numeric(self, name, dtype):
+		old_values = self._f[name][:]
+		backup_node(self._f, name)
+		del self._f[name]
+		node = _create_array(self._f, name, old_values.astype(dtype), dtype, self._compression)
+		node.attrs['encoding'] = ENCODING.NUMERIC.value
+		print ('NOTE: column {} promoted from {} to {}'.format(name, old_values.dtype, dtype))
+
+
+	def _rewrite_as_categorical(self, name):
+		old_values = self._f[name][:]
+		backup_node(self._f, name)
+		del self._f[name]
+		self._create_column(name, ENCODING.CATEGORICAL.value, n_rows=0)
+		# numbers -> str categories, NaN -> missing
+		self._append_categorical(name, pd.Series(old_values.astype('O')))
+		print ('WARNING: column {} has numeric and non-numeric values, saved as categorical'.format(name))
+
+
+	def _append_column(self, name, series):
+		if name not in self._f:
+			encoding = column_encoding(series, name)
+			self._create_column(name, encoding, dtype=series.values.dtype)
+		encoding = get_encoding(self._f, name)
+
+		if encoding == ENCODING.NUMERIC.value and column_encoding(series, name) != ENCODING.NUMERIC.value:
+			self._rewrite_as_categorical(name)
+			encoding = ENCODING.CATEGORICAL.value
+
+		if encoding == ENCODING.NUMERIC.value:
+			values = series.values
+			dtype = np.result_type(self._f[name].dtype, values.dtype)
+			if dtype != self._f[name].dtype:
+				self._promote_numeric(name, dtype)
+			_append_array(self._f[name], values.astype(dtype))
+		elif encoding == ENCODING.CATEGORICAL.value:
+			self._append_categorical(name, series)
+		else:
+			_append_array(self._f[name], _to_str_array(series.values))
+
+
+	def _append_missing(self, name, n_rows):
+		encoding = get_encoding(self._f, name)
+		if encoding == ENCODING.NUMERIC.value:
+			dtype = missing_dtype(self._f[name].dtype)
+			if n_rows and dtype != self._f[name].dtype:
+				self._promote_numeric(name, dtype)
+			_append_array(self._f[name], _missing_values(dtype, n_rows))
+		elif encoding == ENCODING.CATEGORICAL.value:
+			_append_array(self._f[name]['codes'], np.full(n_rows, -1, dtype=CODES_DTYPE))
+		else:
+			_append_array(self._f[name], np.full(n_rows, '', dtype='O'))
+
+
+	def append(self, df, sample_name=''):
+		"""
+		Append rows of df, index is saved as index_name column
+
+		Returns
+		----------
+		(start, end) row offsets of df in the h5
+		"""
+		f = self._f
+		check_sample_names(self._sample_names + [sample_name])
+		start = self.n_rows
+		if self._index_name not in f:
+			self._create_column(self._index_name, ENCODING.STRING.value)
+		_append_array(f[self._index_name], _to_str_array(df.index.values))
+
+		columns = [i for i in df.columns if i != self._index_name]
+		for col in columns:
+			self._append_column(col, df[col])
+		for col in self.columns():
+			if col not in columns:
+				self._append_missing(col, len(df))
+
+		end = start + len(df)
+		f.attrs['n_rows'] = end
+		self._sample_names.append(sample_name)
+		self._sample_offsets.append(end)
+		return start, end
+
+
+	def columns(self):
+		return [
+			i for i in self._f.keys()
+			if i != self._index_name and 'encoding' in self._f[i].attrs
+		]
+
+
+	def close(self):
+		"""
+		Save the per-sample row offsets
+		"""
+		f = self._f
+		if SAMPLES_GROUP in f:
+			del f[SAMPLES_GROUP]
+		samples_group = f.create_group(SAMPLES_GROUP)
+		samples_group.create_dataset(
+			'names', data=np.array(self._sample_names, dtype='O'), dtype=STR_DTYPE
+		)
+		samples_group.create_dataset(
+			'offsets', data=np.array(self._sample_offsets, dtype=np.int64)
+		)
+		return f
+
+
+def write_df(f, df, index_name, compression='gzip'):
+	writer = H5ColumnWriter(f, index_name, compression)
+	writer.append(df)
+	return writer.close()
+
+
+def read_sample_offsets(f):
+	"""
+	Returns
+	----------
+	Dict: sample_name -> (start, end) row offsets
+	"""
+	if SAMPLES_GROUP not in f:
+		return {'': (0, len(f[f.attrs.get('index_name', 'barcode')]))}
+	names = f[SAMPLES_GROUP]['names'].asstr()[:]
+	offsets = f[SAMPLES_GROUP]['offsets'][:]
+	return {
+		names[i]: (int(offsets[i]), int(offsets[i + 1]))
+		for i in range(len(names))
+	}
+
+
+def get_encoding(f, name):
+	if name not in f:
+		raise Exception('cannot find {} in h5'.format(name))
+	return f[name].attrs.get('encoding', None)
+
+
+def _read_legacy_column(node, sl):
+	# layout v1: numeric columns are native, strings are vlen / fixed-width bytes
+	if h5py.check_string_dtype(node.dtype) is not None:
+		return node.asstr()[sl]
+	return node[sl]
+
+
+def _slices_to_list(slices):
+	if isinstance(slices, slice):
+		return [slices]
+	return list(slices)
+
+
+def _read_rows(ds, rows):
+	if not len(rows):
+		return ds[0:0]
+	# h5py fancy indexing needs sorted, unique rows
+	uni_rows, inverse = np.unique(rows, return_inverse=True)
+	if len(uni_rows) <= MAX_FANCY_ROWS:
+		values = ds[uni_rows]
+	else:
+		values = ds[uni_rows[0]:uni_rows[-1] + 1][uni_rows - uni_rows[0]]
+	return values[inverse.reshape(-1)]
+
+
+def _read_ranges(ds, slices):
+	if isinstance(slices, np.ndarray):
+		# row positions
+		return _read_rows(ds, slices)
+	slices = _slices_to_list(slices)
+	if len(slices) == 1:
+		return ds[slices[0]]
+	return np.concatenate([ds[sl] for sl in slices])
+
+
+def read_column(f, name, sl=slice(None)):
+	"""
+	Read one column as numpy array / pandas Categorical
+
+	Parameters
+	----------
+	f : h5py.File
+	name : str
+	sl : slice or List[slice] or np.ndarray[int64]
+		Rows to read
+	"""
+	encoding = get_encoding(f, name)
+	node = f[name]
+
+	if encoding == ENCODING.NUMERIC.value:
+		return _read_ranges(node, sl)
+	if encoding == ENCODING.CATEGORICAL.value:
+		return pd.Categorical.from_codes(
+			_read_ranges(node['codes'], sl),
+			categories=node['categories'].asstr()[:]
+		)
+	if encoding == ENCODING.STRING.value:
+		return _read_ranges(node.asstr(), sl)
+	if isinstance(sl, np.ndarray):
+		return _read_legacy_column(node, slice(None))[sl]
+	return np.concatenate([
+		_read_legacy_column(node, i) for i in _slices_to_list(sl)
+	])
+
+
+def read_index(f, index_name, sl=slice(None)):
+	if get_encoding(f, index_name) is None:
+		if isinstance(sl, np.ndarray):
+			return _read_legacy_column(f[index_name], slice(None))[sl]
+		return np.concatenate([
+			_read_legacy_column(f[index_name], i) for i in _slices_to_list(sl)
+		])
+	return _read_ranges(f[index_name].asstr(), sl)
+
+
+class InvertedIndex(object):
+	def __init__(self, categories, indptr, indices):
+		"""
+		CSR inverted index: value -> sorted row positions
+
+		Parameters
+		----------
+		categories : np.ndarray[object]
+			Indexed values, value i has rows indices[indptr[i]:indptr[i + 1]]
+		indptr : np.ndarray[int64]
+		indices : np.ndarray[int64]
+		"""
+		self.categories = np.asarray(categories, dtype='O')
+		self.indptr = indptr
+		self.indices = indices
+		self.__lookup = None
+
+
+	@classmethod
+	def from_codes(cls, codes, categories):
+		"""
+		Build from integer codes of every row, -1: not indexed
+		"""
+		codes = np.asarray(codes, dtype=np.int64)
+		order = np.argsort(codes, kind='stable')
+		n_missing = np.searchsorted(codes[order], 0)
+		indptr = np.zeros(len(categories) + 1, dtype=np.int64)
+		np.cumsum(
+			np.bincount(codes[codes >= 0], minlength=len(categories)),
+			out=indptr[1:]
+		)
+		return cls(categories, indptr, order[n_missing:].astype(np.int64))
+
+
+	@classmethod
+	def from_values(cls, values):
+		codes, categories = pd.factorize(values)
+		return cls.from_codes(codes, np.asarray(categories, dtype='O'))
+
+
+	def codes_of(self, values):
+		"""
+		Code of every value, -1 for values never seen
+		"""
+		if self.__lookup is None:
+			self.__lookup = pd.Index(self.categories)
+		return self.__lookup.get_indexer(np.asarray(values, dtype='O'))
+
+
+	def row_codes(self):
+		"""
+		Code of every item of indices
+		"""
+		return np.repeat(
+			np.arange(len(self.categories), dtype=np.int64), np.diff(self.indptr)
+		)
+
+
+	def rows(self, values):
+		"""
+		Sorted row positions having any of values
+		"""
+		codes = self.codes_of(values)
+		codes = np.unique(codes[codes >= 0])
+		if not len(codes):
+			return np.zeros(0, dtype=np.int64)
+		return np.sort(np.concatenate([
+			self.indices[self.indptr[i]:self.indptr[i + 1]] for i in codes
+		]))
+
+
+	def append_rows(self, codes, n_categories, row_offset):
+		"""
+		New index with rows row_offset, row_offset + 1, .. of codes added after the current rows\n
+		Current rows must be < row_offset, categories can only grow
+		"""
+		codes = np.asarray(codes, dtype=np.int64)
+		old_counts = np.zeros(n_categories, dtype=np.int64)
+		old_counts[:len(self.indptr) - 1] = np.diff(self.indptr)
+		new_counts = np.bincount(codes[codes >= 0], minlength=n_categories)
+
+		indptr = np.zeros(n_categories + 1, dtype=np.int64)
+		np.cumsum(old_counts + new_counts, out=indptr[1:])
+		indices = np.empty(indptr[-1], dtype=np.int64)
+
+		# rows of a value: its current rows, then its new rows (already sorted)
+		old_codes = self.row_codes()
+		old_rank = np.arange(len(self.indices)) - self.indptr[old_codes]
+		indices[indptr[old_codes] + old_rank] = self.indices
+		added = InvertedIndex.from_codes(codes, np.zeros(n_categories))
+		added_codes = added.row_codes()
+		added_rank = np.arange(len(added.indices)) - added.indptr[added_codes]
+		indices[indptr[added_codes] + old_counts[added_codes] + added_rank] = added.indices + row_offset
+		return InvertedIndex(np.zeros(n_categories), indptr, indices)
+
+
+def write_inverted_index(f, name, compression='gzip'):
+	"""
+	Save the inverted index of a categorical column in INDEX_GROUP/<name>\n
+	Values are the categories of the column -> only indptr / indices are stored
+	"""
+	if get_encoding(f, name) != ENCODING.CATEGORICAL.value:
+		raise Exception('only categorical columns can be indexed: {}'.format(name))
+
+	node = f[name]
+	index = InvertedIndex.from_codes(node['codes'][:], np.zeros(len(node['categories'])))
+	return _save_inverted_index(f, name, index, len(node['codes']), compression)
+
+
+def _save_inverted_index(f, name, index, n_rows, compression):
+	# written aside then renamed: an interrupted write never leaves a half index
+	index_group = f.require_group(INDEX_GROUP)
+	temp_name = name + TEMP_SUFFIX
+	if temp_name in index_group:
+		del index_group[temp_name]
+	backup_node(index_group, name)
+	group = index_group.create_group(temp_name)
+	group.attrs['n_rows'] = n_rows
+	group.create_dataset('indptr', data=index.indptr)
+	_create_array(group, 'indices', index.indices, np.int64, compression)
+	if name in index_group:
+		del index_group[name]
+	index_group.move(temp_name, name)
+	return index_group[name]
+
+
+def update_inverted_index(f, name, compression='gzip'):
+	"""
+	Add the rows appended since the inverted index of name was saved, only these rows are read\n
+	Without index (or a broken one): the whole index is written
+	"""
+	node = f[name]
+	n_rows = len(node['codes'])
+	if INDEX_GROUP not in f or name not in f[INDEX_GROUP]:
+		return write_inverted_index(f, name, compression)
+	group = f[INDEX_GROUP][name]
+	old_n_rows = int(group.attrs['n_rows'])
+	if old_n_rows > n_rows:
+		return write_inverted_index(f, name, compression)
+
+	index = InvertedIndex(np.zeros(len(group['indptr']) - 1), group['indptr'][:], group['indices'][:])
+	index = index.append_rows(node['codes'][old_n_rows:], len(node['categories']), old_n_rows)
+	return _save_inverted_index(f, name, index, n_rows, compression)
+
+
+def read_inverted_index(f, name):
+	"""
+	Returns
+	----------
+	InvertedIndex, None if the column has no index or rows were added after the index was built
+	"""
+	if INDEX_GROUP not in f or name not in f[INDEX_GROUP]:
+		return None
+	group = f[INDEX_GROUP][name]
+	if group.attrs['n_rows'] != len(f[name]['codes']):
+		return None
+	return InvertedIndex(
+		f[name]['categories'].asstr()[:], group['indptr'][:], group['indices'][:]
+	)
+
+
+def has_cells_table(f):
+	"""
+	True if the h5 has a cells table summarizing all its contigs
+	"""
+	return (
+		CELLS_GROUP in f
+		and f[CELLS_GROUP].attrs.get('n_contig_rows', -1) == len(f[f.attrs.get('index_name', 'barcode')])
+	)
+
+
+def backup_key(table, name):
+	"""
+	Name of the backup of column name of table (root or a group, eg: CELLS_GROUP) in JOURNAL_BACKUP
+	"""
+	return '|'.join([i for i in table.name.split('/') if len(i)] + [name])
+
+
+def backup_node(group, name):
+	"""
+	During a pending append (see begin_append): keep group[name] as it was before its first rewrite,
+	restored by rollback_append
+	"""
+	root = group.file
+	if JOURNAL not in root or name not in group:
+		return
+	key = backup_key(group, name)
+	backup_group = root.require_group(JOURNAL_BACKUP)
+	if key not in backup_group:
+		root.copy(group[name], backup_group, name=key)
+
+
+def _restore_backups(f, group):
+	if JOURNAL_BACKUP not in f:
+		return
+	for name in list(f[JOURNAL_BACKUP].keys()):
+		path = name.split('|')
+		if '/'.join(path[:-1]) != group.name.strip('/'):
+			continue
+		if path[-1] in group:
+			del group[path[-1]]
+		f.move('{}/{}'.format(JOURNAL_BACKUP, name), '{}/{}'.format(group.name.rstrip('/'), path[-1]))
+
+
+def _tables(f):
+	# root table and tables saved in groups, eg: CELLS_GROUP
+	return [f] + [f[i] for i in (CELLS_GROUP,) if i in f]
+
+
+def begin_append(f, samples):
+	"""
+	Save the state of every table before appending samples, flushed before anything is written\n
+	Lengths of datasets only grow during an append -> truncating them restores the previous state
+	"""
+	if JOURNAL in f:
+		raise Exception('{} has a pending append, see recover_append'.format(f.filename))
+
+	journal = {'samples': list(samples), 'done': False, 'tables': {}}
+	for table in _tables(f):
+		datasets = {}
+		def _record(name, node):
+			if isinstance(node, h5py.Dataset) and not name.startswith(SAMPLES_GROUP):
+				datasets[name] = node.shape[0]
+		table.visititems(_record)
+		offsets = read_sample_offsets(table) if SAMPLES_GROUP in table else {}
+		journal['tables'][table.name] = {
+			'datasets': {k: v for k, v in datasets.items() if not k.startswith('__')},
+			'attrs': {k: int(table.attrs[k]) for k in ('n_rows', 'n_contig_rows') if k in table.attrs},
+			'sample_names': list(offsets),
+			'sample_offsets': [0] + [int(i[1]) for i in offsets.values()],
+		}
+	f.create_dataset(JOURNAL, data=json.dumps(journal), dtype=STR_DTYPE)
+	f.flush()
+	return journal
+
+
+def append_state(f):
+	"""
+	None: no pending append, 'pending': interrupted while writing, 'done': written, not committed yet
+	"""
+	if JOURNAL not in f:
+		return None
+	journal = json.loads(f[JOURNAL].asstr()[()])
+	return 'done' if journal['done'] else 'pending'
+
+
+def mark_append_done(f):
+	journal = json.loads(f[JOURNAL].asstr()[()])
+	journal['done'] = True
+	del f[JOURNAL]
+	f.create_dataset(JOURNAL, data=json.dumps(journal), dtype=STR_DTYPE)
+	f.flush()
+
+
+def commit_append(f):
+	if JOURNAL_BACKUP in f:
+		del f[JOURNAL_BACKUP]
+	if JOURNAL in f:
+		del f[JOURNAL]
+	f.flush()
+
+
+def rollback_append(f):
+	"""
+	Restore the state saved by begin_append: rewritten columns and inverted indexes are restored from their backup,
+	new columns are dropped, datasets truncated, offsets restored\n
+	Other inverted indexes covering dropped rows are removed (rebuilt in memory when read)
+	"""
+	if JOURNAL not in f:
+		return
+	journal = json.loads(f[JOURNAL].asstr()[()])
+	for table_name, state in journal['tables'].items():
+		if table_name not in f:
+			continue
+		table = f[table_name]
+		_restore_backups(f, table)
+		for name in list(table.keys()):
+			if name.startswith('__'):
+				continue
+			node = table[name]
+			paths = [name] if isinstance(node, h5py.Dataset) else [name + '/' + i for i in node.keys()]
+			if not any(i in state['datasets'] for i in paths):
+				del table[name]
+		for name, length in state['datasets'].items():
+			if name in table:
+				table[name].resize((length,))
+		for k, v in state['attrs'].items():
+			table.attrs[k] = v
+
+		if SAMPLES_GROUP in table:
+			del table[SAMPLES_GROUP]
+		if len(state['sample_names']):
+			samples_group = table.create_group(SAMPLES_GROUP)
+			samples_group.create_dataset(
+				'names', data=np.array(state['sample_names'], dtype='O'), dtype=STR_DTYPE
+			)
+			samples_group.create_dataset(
+				'offsets', data=np.array(state['sample_offsets'], dtype=np.int64)
+			)
+
+	if INDEX_GROUP in f:
+		index_group = f[INDEX_GROUP]
+		_restore_backups(f, index_group)
+		for name in list(index_group.keys()):
+			if (
+				name.endswith(TEMP_SUFFIX)
+				or name not in f
+				or index_group[name].attrs['n_rows'] != len(f[name]['codes'])
+			):
+				del index_group[name]
+	if JOURNAL_BACKUP in f:
+		del f[JOURNAL_BACKUP]
+	del f[JOURNAL]
+	f.flush()
+
+
+def recover_append(*h5_paths):
+	"""
+	Finish or undo an interrupted append_samples over h5 files appended together\n
+	Committed only if every pending file was fully written, otherwise every pending file is rolled back
+
+	Returns
+	----------
+	'committed', 'rolled back' or None (nothing pending)
+	"""
+	states = {}
+	for path in h5_paths:
+		with h5py.File(path, 'r') as f:
+			states[path] = append_state(f)
+	pending = [i for i in h5_paths if states[i] is not None]
+	if not len(pending):
+		return None
+
+	# a file without journal was committed -> all files were written
+	all_done = all(states[i] == 'done' for i in pending)
+	for path in pending:
+		with h5py.File(path, 'r+') as f:
+			if all_done:
+				commit_append(f)
+			else:
+				rollback_append(f)
+	return 'committed' if all_done else 'rolled back'
+
+
+class H5Dataset(object):
+	"""
+	Lazy view of a columnar h5 written by H5ColumnWriter (or the legacy layout)\n
+	Nothing is read until read() / read_column() is called,
+	then only the requested columns and sample row ranges are read
+	"""
+	def __init__(self, h5_path, samples=None, group=None):
+		"""
+		Parameters
+		----------
+		h5_path : str
+		samples : List[str]
+			Restrict every read to the rows of these samples (stored offsets), default: all rows
+		group : str
+			Read a table saved in a group of the h5, eg: CELLS_GROUP, default: the root table
+		"""
+		self.h5_path = h5_path
+		self.group = group
+		with self._open() as f:
+			self.index_name = f.attrs.get('index_name', 'barcode')
+			self.sample_offsets = read_sample_offsets(f)
+			self.encodings = {
+				i: f[i].attrs.get('encoding', None)
+				for i in f.keys()
+				if i not in (SAMPLES_GROUP, self.index_name) and not i.startswith('__')
+			}
+			if JOURNAL in f:
+				raise Exception('{} has a pending append, see h5_store.recover_append'.format(h5_path))
+			self.n_rows = len(f[self.index_name])
+			self.has_cells = has_cells_table(f)
+		self.samples = list(self.sample_offsets) if samples is None else list(samples)
+		self._selected_samples = samples
+		self._slices = self._samples_to_slices(samples)
+		self._inverted_indexes = {}
+
+
+	@contextmanager
+	def _open(self):
+		with h5py.File(self.h5_path, 'r') as f:
+			yield f if self.group is None else f[self.group]
+
+
+	def _samples_to_slices(self, samples):
+		if samples is None:
+			return [slice(0, self.n_rows)]
+		missing_samples = [i for i in samples if i not in self.sample_offsets]
+		if len(missing_samples):
+			raise Exception('cannot find samples {} in {}'.format(missing_samples, self.h5_path))
+		return [slice(*self.sample_offsets[i]) for i in samples]
+
+
+	@property
+	def columns(self):
+		return list(self.encodings.keys())
+
+
+	def label_columns(self):
+		"""
+		Categorical / string columns (not numeric), eg: usable as groups
+		"""
+		with self._open() as f:
+			return [
+				k for k, v in self.encodings.items()
+				if v in (ENCODING.CATEGORICAL.value, ENCODING.STRING.value) or (
+					v is None
+					and isinstance(f[k], h5py.Dataset)
+					and h5py.check_string_dtype(f[k].dtype) is not None
+				)
+			]
+
+
+	def column_attrs(self, name):
+		"""
+		Attributes saved with a column, eg: its encoding
+		"""
+		if name not in self.encodings:
+			raise Exception('cannot find {} in {}'.format(name, self.h5_path))
+		with self._open() as f:
+			return {
+				k: (v.decode() if isinstance(v, bytes) else v)
+				for k, v in f[name].attrs.items()
+			}
+
+
+	def select_samples(self, samples):
+		"""
+		New lazy view restricted to samples
+		"""
+		return H5Dataset(self.h5_path, samples, self.group)
+
+
+	def cells(self):
+		"""
+		Lazy view of the cells table of the same samples, None if the h5 has no up-to-date cells table
+		"""
+		if not self.has_cells:
+			return None
+		return H5Dataset(self.h5_path, self._selected_samples, CELLS_GROUP)
+
+
+	def read_column(self, name):
+		if name not in self.encodings:
+			raise Exception('cannot find {} in {}'.format(name, self.h5_path))
+		with self._open() as f:
+			return read_column(f, name, self._slices)
+
+
+	def read_index(self):
+		with self._open() as f:
+			return read_index(f, self.index_name, self._slices)
+
+
+	@property
+	def n_view_rows(self):
+		return sum(sl.stop - sl.start for sl in self._slices)
+
+
+	def file_rows_to_view(self, rows):
+		"""
+		File rows -> positions in this view, -1 for rows of unselected samples
+		"""
+		rows = np.asarray(rows, dtype=np.int64)
+		positions = np.full(len(rows), -1, dtype=np.int64)
+		offset = 0
+		for sl in self._slices:
+			chosen = (rows >= sl.start) & (rows < sl.stop)
+			positions[chosen] = rows[chosen] - sl.start + offset
+			offset += sl.stop - sl.start
+		return positions
+
+
+	def view_positions(self, rows):
+		"""
+		File rows -> sorted positions in this view, rows of unselected samples are dropped
+		"""
+		positions = self.file_rows_to_view(rows)
+		return np.sort(positions[positions >= 0])
+
+
+	def file_rows(self, positions):
+		"""
+		Positions in this view -> file rows
+		"""
+		positions = np.asarray(positions, dtype=np.int64)
+		starts = np.array([sl.start for sl in self._slices], dtype=np.int64)
+		view_starts = np.cumsum([0] + [sl.stop - sl.start for sl in self._slices])
+		slice_idx = np.searchsorted(view_starts, positions, side='right') - 1
+		return positions - view_starts[slice_idx] + starts[slice_idx]
+
+
+	def inverted_index(self, name):
+		"""
+		InvertedIndex of a column over file rows\n
+		Stored index if any, otherwise built in memory once
+		"""
+		if name not in self._inverted_indexes:
+			with self._open() as f:
+				index = read_inverted_index(f, name)
+				if index is None:
+					index = InvertedIndex.from_values(read_column(f, name))
+			self._inverted_indexes[name] = index
+		return self._inverted_indexes[name]
+
+
+	def lookup(self, name, values):
+		"""
+		Sorted positions (in this view) of rows whose column name has any of values
+		"""
+		return self.view_positions(
+			self.inverted_index(name).rows(values)
+		)
+
+
+	def read_rows(self, columns, positions, index=None):
+		"""
+		Same as read(), for some positions of this view only
+		"""
+		rows = self.file_rows(positions)
+		meta_dct = {}
+		with self._open() as f:
+			for i in columns:
+				if i == self.index_name or i in meta_dct:
+					continue
+				if i not in self.encodings:
+					raise Exception('cannot find {} in {}'.format(i, self.h5_path))
+				meta_dct[i] = read_column(f, i, rows)
+
+			if index is None:
+				index_values = read_index(f, self.index_name, rows)
+			elif index in meta_dct:
+				index_values = meta_dct.pop(index)
+			else:
+				index_values = read_column(f, index, rows)
+		return pd.DataFrame(meta_dct, index=pd.Index(index_values))
+
+
+	def read(self, columns, index=None):
+		"""
+		Parameters
+		----------
+		columns : List[str]
+		index : str
+			None: barcodes as index (decoded strings)\n
+			column name: use this column as index, eg: BARCODE_KEY -> no barcode decoding
+
+		Returns
+		----------
+		Pandas dataframe, categorical columns as pandas Categoricals
+		"""
+		meta_dct = {}
+		for i in columns:
+			if i == self.index_name or i in meta_dct:
+				continue
+			meta_dct[i] = self.read_column(i)
+
+		if index is None:
+			index_values = self.read_index()
+		elif index in meta_dct:
+			index_values = meta_dct.pop(index)
+		else:
+			index_values = self.read_column(index)
+		return pd.DataFrame(meta_dct, index=pd.Index(index_values))
+
+
@@ -0,0 +1,106 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Job(object):
+	def __init__(self, key, future):
+		"""
+		One computation of the JobQueue, shared by every client waiting for the same key
+		"""
+		self.key = key
+		self.future = future
+		self.n_waiters = 1
+
+
+	@property
+	def status(self):
+		"""
+		'pending', 'running', 'done', 'error' or 'cancelled'
+		"""
+		if self.future.cancelled():
+			return 'cancelled'
+		if not self.future.done():
+			return 'running' if self.future.running() else 'pending'
+		if self.future.exception() is not None:
+			return 'error'
+		return 'done'
+
+
+	def result(self):
+		return self.future.result()
+
+
+	def error(self):
+		return self.future.exception()
+
+
+class JobQueue(object):
+	def __init__(self, n_workers=2, max_finished=64):
+		"""
+		Background jobs keyed by their parameters: long computations never block the caller\n
+		Coalescing: submitting a key already pending / running / done returns the same job\n
+		Cancellation: a job nobody waits for anymore is dropped if it has not started yet,
+		a running job cannot be interrupted, it finishes and is kept like any finished job
+
+		Parameters
+		----------
+		n_workers : int
+			Number of threads running jobs\n
+			Threads share the memory caches of ClonotypeToolkits, heavy analyses use their own process pools
+		max_finished : int
+			Number of finished jobs kept for late pollers, least recently submitted first out
+		"""
+		self._executor = ThreadPoolExecutor(max_workers=n_workers)
+		self._jobs = OrderedDict()
+		self._max_finished = max_finished
+		self._lock = threading.Lock()
+
+
+	def submit(self, key, func, *args):
+		"""
+		Job computing func(*args), or the job already submitted with key\n
+		Failed and cancelled jobs are submitted again
+		"""
+		with self._lock:
+			job = self._jobs.get(key)
+			if job is not None and job.status not in ('error', 'cancelled'):
+				job.n_waiters += 1
+				self._jobs.move_to_end(key)
+				return job
+
+			job = Job(key, self._executor.submit(func, *args))
+			self._jobs[key] = job
+			self._evict()
+			return job
+
+
+	def get(self, key):
+		"""
+		Job of key, None if never submitted, cancelled or evicted
+		"""
+		with self._lock:
+			return self._jobs.get(key)
+
+
+	def release(self, key):
+		"""
+		One waiter of key is gone, the job is cancelled if it was the last one and the job has not started
+		"""
+		with self._lock:
+			job = self._jobs.get(key)
+			if job is None:
+				return
+			job.n_waiters -= 1
+			if job.n_waiters <= 0 and job.future.cancel():
+				del self._jobs[key]
+
+
+	def _evict(self):
+		finished = [k for k, v in self._jobs.items() if v.future.done()]
+		for k in finished[:max(0, len(finished) - self._max_finished)]:
+			del self._jobs[k]
+
+
+	def shutdown(self):
+		self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,89 @@
+import os
+import json
+import uuid
+
+from .constants import H5_LAYOUT_VERSION
+
+
+# sharded layout: one pair of h5 per sample (see ClonotypePreprocessing.ingest_shards)
+# + a manifest listing the shards, rewritten atomically after every shard
+MANIFEST = 'manifest.json'
+
+
+def manifest_path(shard_dir):
+	return os.path.join(shard_dir, MANIFEST)
+
+
+def is_shard_dir(path):
+	return os.path.isfile(manifest_path(path))
+
+
+def shard_file_names(sample_idx):
+	"""
+	File names of the VDJ / clinical shards of a sample, from its ordinal (sample names may not be valid file names)
+	"""
+	return (
+		'{:05d}_vdj.h5'.format(sample_idx),
+		'{:05d}_clinical.h5'.format(sample_idx),
+	)
+
+
+def read_manifest(shard_dir):
+	"""
+	Returns
+	----------
+	Dict
+		'layout_version': int\n
+		'shards': List[Dict], one per sample: 'sample_name', 'sample_idx', '10X_VDJ', 'clinical_meta' (file names), 'n_contigs', 'n_cells'
+	"""
+	if not is_shard_dir(shard_dir):
+		return {'layout_version': H5_LAYOUT_VERSION, 'shards': []}
+	with open(manifest_path(shard_dir), 'r', encoding='utf-8') as f:
+		manifest = json.load(f)
+	if manifest.get('layout_version') != H5_LAYOUT_VERSION:
+		raise Exception('{} has layout version {}, expected {}'.format(
+			shard_dir, manifest.get('layout_version'), H5_LAYOUT_VERSION
+		))
+	return manifest
+
+
+def write_manifest(shard_dir, manifest):
+	# readers never see a half-written manifest
+	temp_path = '{}.TEMP{}'.format(manifest_path(shard_dir), uuid.uuid4().hex)
+	with open(temp_path, 'w', encoding='utf-8') as f:
+		json.dump(manifest, f, indent=1)
+	os.replace(temp_path, manifest_path(shard_dir))
+
+
+def next_sample_idx(manifest):
+	"""
+	First unused sample ordinal: ordinals are never reused, packed barcodes stay unique across shards
+	"""
+	return max([i['sample_idx'] for i in manifest['shards']], default=-1) + 1
+
+
+def shard_paths(shard_dir, samples=None):
+	"""
+	Parameters
+	----------
+	samples : List[str]
+		Only these samples, default: all shards in manifest order
+
+	Returns
+	----------
+	List of (sample_name, vdj_h5_path, clinical_h5_path)
+	"""
+	shards = {i['sample_name']: i for i in read_manifest(shard_dir)['shards']}
+	if samples is None:
+		samples = list(shards)
+	missing_samples = [i for i in samples if i not in shards]
+	if len(missing_samples):
+		raise Exception('cannot find samples {} in {}'.format(missing_samples, shard_dir))
+	return [
+		(
+			i,
+			os.path.join(shard_dir, shards[i]['10X_VDJ']),
+			os.path.join(shard_dir, shards[i]['clinical_meta']),
+		)
+		for i in samples
+	]
@@ -0,0 +1,304 @@
+import numpy as np
+import pandas as pd
+
+from .clonotypes_diversity_rate import diversity_from_counts
+
+from matplotlib import pyplot as plt
+
+
+# cells are quantized once on a FINE_BINS x FINE_BINS grid
+# every resolution dividing FINE_BINS (1..6, 8, 10, 12, 15, 16, 20, 24, 30, 40, 48, 60, 80, 120, 240) is re-binned exactly
+FINE_BINS = 240
+
+
+def _as_pair(bins):
+	if np.ndim(bins) == 0:
+		return int(bins), int(bins)
+	return int(bins[0]), int(bins[1])
+
+
+def quantize(values, n_bins, value_range=None):
+	"""
+	Bin of every value over n_bins equal-width bins, the last bin includes its right edge (same as np.histogram)
+
+	Returns
+	----------
+	bin_idx : np.ndarray[int64]
+	edges : np.ndarray[float64], n_bins + 1 edges
+	"""
+	values = np.asarray(values, dtype=np.float64)
+	if value_range is None:
+		value_range = (values.min(), values.max()) if len(values) else (0.0, 1.0)
+	lower, upper = value_range
+	if upper <= lower:
+		upper = lower + 1.0
+	edges = np.linspace(lower, upper, n_bins + 1)
+	bin_idx = np.floor((values - lower) / (upper - lower) * n_bins).astype(np.int64)
+	return np.clip(bin_idx, 0, n_bins - 1), edges
+
+
+def downsample_embedding(x, y, max_points=50000, n_bins=200, seed=0):
+	"""
+	Random subsample of at most ~max_points cells for rendering, proportional to the density\n
+	Cells are quantized on a n_bins x n_bins grid, every non-empty bin keeps 1 cell
+	+ the same fraction of its other cells: relative abundances of populations are kept,
+	rare populations and outliers are never dropped\n
+	With more than max_points non-empty bins, one cell per non-empty bin is kept
+
+	Returns
+	----------
+	np.ndarray[int64]
+		Sorted positions of the kept cells, cells with NaN coordinates are dropped
+	"""
+	x = np.asarray(x, dtype=np.float64)
+	y = np.asarray(y, dtype=np.float64)
+	positions = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+	if len(positions) <= max_points:
+		return positions
+
+	x_idx, _ = quantize(x[positions], n_bins)
+	y_idx, _ = quantize(y[positions], n_bins)
+	bin_idx = x_idx * n_bins + y_idx
+	counts = np.bincount(bin_idx, minlength=n_bins * n_bins)
+
+	# quota: 1 + floor((count - 1) * ratio) <= count, sum of quotas <= max_points
+	n_bins_used = np.count_nonzero(counts)
+	ratio = max(max_points - n_bins_used, 0) / (len(positions) - n_bins_used)
+	quota = np.where(counts > 0, 1 + np.floor((counts - 1) * ratio), 0).astype(np.int64)
+
+	# random rank of every cell inside its bin
+	shuffled = np.random.default_rng(seed).permutation(len(positions))
+	order = shuffled[np.argsort(bin_idx[shuffled], kind='stable')]
+	bin_starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+	rank = np.arange(len(order)) - bin_starts[bin_idx[order]]
+	return np.sort(positions[order[rank < quota[bin_idx[order]]]])
+
+
+class EmbeddingGrid(object):
+	def __init__(self, x, y, groups=None, clonotypes=None, group_labels=None, group_name='groups', fine_bins=FINE_BINS):
+		"""
+		Cells quantized once on a fine grid, aggregated in one grouped pass over (fine bin, group, clonotype)\n
+		Coarser grids are re-binned from the fine aggregates, the cells are never scanned again
+
+		Parameters
+		----------
+		x, y : np.ndarray[float]
+			Embedding coordinates of every cell, cells with NaN coordinates are dropped
+		groups : np.ndarray[int]
+			Group code of every cell (see GroupKey.codes), default: one group
+		clonotypes : np.ndarray[int]
+			Clonotype code of every cell, -1: no clonotype, default: no clonotype
+		group_labels : np.ndarray
+			Label of every group code
+		group_name : str
+		fine_bins : int or (int, int)
+			Number of fine bins along x and y
+		"""
+		x = np.asarray(x, dtype=np.float64)
+		y = np.asarray(y, dtype=np.float64)
+		groups = np.zeros(len(x), dtype=np.int64) if groups is None else np.asarray(groups, dtype=np.int64)
+		clonotypes = np.full(len(x), -1, dtype=np.int64) if clonotypes is None else np.asarray(clonotypes, dtype=np.int64)
+		self.group_labels = np.array(['all'], dtype='O') if group_labels is None else np.asarray(group_labels, dtype='O')
+		self.group_name = group_name
+
+		chosen = np.isfinite(x) & np.isfinite(y)
+		x, y, groups, clonotypes = x[chosen], y[chosen], groups[chosen], clonotypes[chosen]
+
+		self.fine_bins = _as_pair(fine_bins)
+		fine_x, x_edges = quantize(x, self.fine_bins[0])
+		fine_y, y_edges = quantize(y, self.fine_bins[1])
+		self.x_range = (x_edges[0], x_edges[-1])
+		self.y_range = (y_edges[0], y_edges[-1])
+
+		# one grouped pass: number of cells of every (fine bin, group, clonotype)
+		n_groups = len(self.group_labels)
+		n_clonotypes = clonotypes.max() + 2 if len(clonotypes) else 1
+		fine_bin = fine_x * self.fine_bins[1] + fine_y
+		key = (fine_bin * n_groups + groups) * n_clonotypes + clonotypes + 1
+		uni_key, count = np.unique(key, return_counts=True)
+		self._fine_bin = uni_key // n_clonotypes // n_groups
+		self._group = uni_key // n_clonotypes % n_groups
+		self._clonotype = uni_key % n_clonotypes - 1
+		self._count = count
+
+
+	def rebin(self, bins=(40, 20)):
+		"""
+		Coarse bin of every fine aggregate: the bin holding the center of its fine bin
+
+		Returns
+		----------
+		coarse_x, coarse_y : np.ndarray[int64]
+		"""
+		n_x, n_y = _as_pair(bins)
+		fine_x = self._fine_bin // self.fine_bins[1]
+		fine_y = self._fine_bin % self.fine_bins[1]
+		coarse_x = ((2 * fine_x + 1) * n_x) // (2 * self.fine_bins[0])
+		coarse_y = ((2 * fine_y + 1) * n_y) // (2 * self.fine_bins[1])
+		return coarse_x, coarse_y
+
+
+	def _bins_df(self, bins, coarse_bin, columns):
+		n_x, n_y = _as_pair(bins)
+		x_edges = np.linspace(self.x_range[0], self.x_range[1], n_x + 1)
+		y_edges = np.linspace(self.y_range[0], self.y_range[1], n_y + 1)
+		x_idx, y_idx = coarse_bin // n_y, coarse_bin % n_y
+		bins_df = pd.DataFrame(
+			{
+				'X': (x_edges[x_idx] + x_edges[x_idx + 1]) / 2,
+				'Y': (y_edges[y_idx] + y_edges[y_idx + 1]) / 2,
+			},
+			index=pd.MultiIndex.from_arrays([x_idx, y_idx], names=['x_bin', 'y_bin'])
+		)
+		for k, v in columns.items():
+			bins_df[k] = v
+		return bins_df
+
+
+	def composition(self, bins=(40, 20)):
+		"""
+		Number of cells and fraction of every group in every non-empty bin
+
+		Parameters
+		----------
+		bins : int or (int, int)
+			Number of bins along x and y
+
+		Returns
+		----------
+		pd.DataFrame
+			Index: (x_bin, y_bin)\n
+			Columns: X, Y (bin centers), n_cells, one fraction column per group label
+		"""
+		n_x, n_y = _as_pair(bins)
+		n_groups = len(self.group_labels)
+		coarse_x, coarse_y = self.rebin(bins)
+		counts = np.bincount(
+			(coarse_x * n_y + coarse_y) * n_groups + self._group,
+			weights=self._count,
+			minlength=n_x * n_y * n_groups
+		).reshape(n_x * n_y, n_groups)
+
+		n_cells = counts.sum(axis=1)
+		coarse_bin = np.flatnonzero(n_cells)
+		columns = {'n_cells': n_cells[coarse_bin].astype(np.int64)}
+		fractions = counts[coarse_bin] / n_cells[coarse_bin, None]
+		for i, label in enumerate(self.group_labels):
+			columns[label] = fractions[:, i]
+		return self._bins_df(bins, coarse_bin, columns)
+
+
+	def diversity(self, bins=(40, 20), hill_orders=(0, 1, 2)):
+		"""
+		Clonotype diversity of the cells of every bin having clonotypes, see diversity_from_counts
+
+		Returns
+		----------
+		pd.DataFrame
+			Index: (x_bin, y_bin)\n
+			Columns: X, Y (bin centers), n_cells, n_clonotypes, diversity metrics
+		"""
+		n_x, n_y = _as_pair(bins)
+		coarse_x, coarse_y = self.rebin(bins)
+		chosen = self._clonotype >= 0
+		n_clonotypes = self._clonotype.max() + 1 if chosen.any() else 1
+
+		# fine aggregates of the same (coarse bin, clonotype) are summed, groups are pooled
+		pair_key = (coarse_x * n_y + coarse_y)[chosen] * n_clonotypes + self._clonotype[chosen]
+		uni_key, pair_idx = np.unique(pair_key, return_inverse=True)
+		pair_count = np.bincount(
+			pair_idx.reshape(-1), weights=self._count[chosen], minlength=len(uni_key)
+		)
+		pair_bin = uni_key // n_clonotypes
+
+		coarse_bin, pair_bin = np.unique(pair_bin, return_inverse=True)
+		metrics = diversity_from_counts(
+			pair_bin.reshape(-1), pair_count, len(coarse_bin), hill_orders
+		)
+		return self._bins_df(bins, coarse_bin, metrics)
+
+
+def create_embedding_grid(
+		clinical_df,
+		embedding_columns=['X_UMAP', 'Y_UMAP'],
+		group_key=None,
+		clonotypes=None,
+		fine_bins=FINE_BINS,
+	):
+	"""
+	Parameters
+	----------
+	clinical_df : pd.DataFrame
+		One row per cell, with embedding_columns
+	group_key : GroupKey
+		Groups of the rows of clinical_df, default: one group
+	clonotypes : np.ndarray[int]
+		Clonotype code of every row of clinical_df, -1: no clonotype
+
+	Returns
+	----------
+	EmbeddingGrid
+	"""
+	x_col, y_col = embedding_columns
+	if group_key is None:
+		return EmbeddingGrid(
+			clinical_df[x_col].values, clinical_df[y_col].values,
+			clonotypes=clonotypes, fine_bins=fine_bins
+		)
+	return EmbeddingGrid(
+		clinical_df[x_col].values, clinical_df[y_col].values,
+		group_key.codes, clonotypes, group_key.labels, group_key.name, fine_bins
+	)
+
+
+def plotly_embedding_composition(composition_df, group_name='groups'):
+	"""
+	Columns: 'X', 'Y', 'n_cells', group_name, 'Ratio', only groups present in the bin
+	"""
+	plotly_df = composition_df.melt(
+		id_vars=['X', 'Y', 'n_cells'],
+		var_name=group_name,
+		value_name='Ratio'
+	)
+	return plotly_df.iloc[plotly_df['Ratio'].values > 0, :].reset_index(drop=True)
+
+
+def visualize_embedding_composition(composition_df, size=0.2):
+	"""
+	One pie per bin, radius proportional to its number of cells
+	"""
+	labels = composition_df.columns[3:]
+	colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+	colors = [colors[i % len(colors)] for i in range(len(labels))]
+
+	fig, ax = plt.subplots(nrows=1, ncols=1)
+	radius = size * composition_df['n_cells'].values / composition_df['n_cells'].values.max()
+	for x, y, fractions, r in zip(
+			composition_df['X'].values,
+			composition_df['Y'].values,
+			composition_df[labels].values,
+			radius
+		):
+		ax.pie(fractions, center=(x, y), radius=r, colors=colors, frame=True)
+	ax.autoscale()
+	ax.set_aspect('auto')
+	ax.set_title('Proportion of groups on embedding')
+	ax.legend(labels, loc='upper left', bbox_to_anchor=(1, 1))
+	plt.show()
+	return
+
+
+def visualize_embedding_diversity(diversity_df, metric='shannon'):
+	fig, ax = plt.subplots(nrows=1, ncols=1)
+	points = ax.scatter(
+		diversity_df['X'].values,
+		diversity_df['Y'].values,
+		c=diversity_df[metric].values,
+		s=20 + 80 * diversity_df['n_cells'].values / diversity_df['n_cells'].values.max(),
+		marker='s',
+		cmap='viridis'
+	)
+	fig.colorbar(points, ax=ax, label=metric)
+	ax.set_title('Clonotype diversity on embedding')
+	plt.show()
+	return
@@ -2,91 +2,83 @@ import numpy as np
 import pandas as pd
 
 from .. import common
+from ..common import export
+from ..common import grouping
+from ..common.constants import CELL_COLUMNS
+from ..common.constants import PAIRING_TYPES
+from .processing import first_row_of_cells
+from .processing import is_cells_table
+from .processing import pairing_codes
 
 from matplotlib import pyplot as plt
 
 
-def _merge_metadata_fields(VDJ_10X, keys=['Condition']):
-	if len(keys) == 1 and keys[0] in VDJ_10X.columns:
-		return VDJ_10X, keys[0]
-
-	meta_key = '<<>>'.join(keys)
-	VDJ_10X[meta_key] = [
-		'<<>>'.join(i)
-		for i in VDJ_10X[keys].values.astype('str')
-	]
-	return VDJ_10X, meta_key
-
-
-def _count_TRA_TRB(chain_names, chain_counts):
-	if 'TRA' not in chain_names:
-		n_TRA = 0
-	else:
-		n_TRA = chain_counts[chain_names=='TRA'][0]
-
-	if 'TRB' not in chain_names:
-		n_TRB = 0
-	else:
-		n_TRB = chain_counts[chain_names=='TRB'][0]
-
-	return n_TRA, n_TRB
+def _merge_metadata_fields(VDJ_10X, keys=['Condition'], rows=None):
+	group_key = grouping.factorize_groups(VDJ_10X, keys, rows)
+	return group_key, group_key.name
 
 
 def _init_clonotypes_types(all_cells, meta_key):
 	n_cells = len(all_cells)
-	fraction_clo_dct = {
-		'barcode': all_cells,
-		'1 TRA - 1 TRB': np.zeros(n_cells, dtype=np.bool_),
-		'2 TRA - 2 TRB': np.zeros(n_cells, dtype=np.bool_),
-		'0 TRA - 1 TRB': np.zeros(n_cells, dtype=np.bool_),
-		'0 TRA - 2 TRB': np.zeros(n_cells, dtype=np.bool_),
-		'1 TRA - 0 TRB': np.zeros(n_cells, dtype=np.bool_),
-		'2 TRA - 0 TRB': np.zeros(n_cells, dtype=np.bool_),
-		'2 TRA - 1 TRB': np.zeros(n_cells, dtype=np.bool_),
-		'1 TRA - 2 TRB': np.zeros(n_cells, dtype=np.bool_),
-		'others': np.zeros(n_cells, dtype=np.bool_),
-		meta_key: np.array([''] * n_cells, dtype='O'),
-	}
+	fraction_clo_dct = {'barcode': all_cells}
+	fraction_clo_dct.update({
+		k: np.zeros(n_cells, dtype=np.bool_)
+		for k in PAIRING_TYPES
+	})
+	fraction_clo_dct[meta_key] = np.array([''] * n_cells, dtype='O')
 
 	return fraction_clo_dct
 
 
 def _grouping_ratio_clonotype_types(fraction_clo_df, meta_key):
-	visualize_fraction_clo_df = fraction_clo_df.groupby(meta_key).sum()
-	visualize_fraction_clo_df = visualize_fraction_clo_df.astype(np.float32)
-
-	for i in range(len(visualize_fraction_clo_df)):
-		visualize_fraction_clo_df.iloc[i, :] /= np.sum(visualize_fraction_clo_df.iloc[i, :].values)
-
+	visualize_fraction_clo_df = export.normalize_rows(
+		fraction_clo_df.groupby(meta_key).sum(), np.float32
+	)
 	visualize_fraction_clo_df = visualize_fraction_clo_df.sort_index(ascending=False)
 	return visualize_fraction_clo_df
 
 
-## TODO: optimize, remove for loop!
-def create_clonotype_fraction_df(VDJ_10X, keys=['Condition']):
-	VDJ_10X, meta_key = _merge_metadata_fields(VDJ_10X, keys=keys)
-	all_cells = VDJ_10X.index.unique()
-	n_cells = len(all_cells)
+def _count_chains_per_cell(cell_idx, chains, n_cells, chain_name):
+	return np.bincount(
+		cell_idx[chains == chain_name],
+		minlength=n_cells
+	)
+
+
+def _assign_clonotypes_types(fraction_clo_dct, chosen_key):
+	for i, k in enumerate(PAIRING_TYPES):
+		fraction_clo_dct[k] = chosen_key == i
+	return fraction_clo_dct
 
-	fraction_clo_dct = _init_clonotypes_types(all_cells, meta_key)
-	for i in range(n_cells):
-		bc = all_cells[i]
-		tmp_df = VDJ_10X.iloc[
-			VDJ_10X.index.values == bc,
-			:
-		]
 
-		all_chains = tmp_df['chain'].values
-		chain_names, chain_counts = np.unique(all_chains, return_counts=True)
-		n_TRA, n_TRB = _count_TRA_TRB(chain_names, chain_counts)
+def create_clonotype_fraction_df(VDJ_10X, keys=['Condition']):
+	"""
+	Parameters
+	----------
+	VDJ_10X : pd.DataFrame
+		Merged contigs (chain column), or merged cells table (pairing column, see processing.summarize_cells)
+	"""
+	if is_cells_table(VDJ_10X):
+		all_cells = VDJ_10X.index.values
+		group_key, meta_key = _merge_metadata_fields(VDJ_10X, keys=keys)
+		chosen_key = pd.Categorical(
+			VDJ_10X[CELL_COLUMNS.PAIRING.value].values, categories=list(PAIRING_TYPES)
+		).codes
+	else:
+		# one hash pass: contig -> cell index, ordered by first appearance
+		cell_idx, all_cells = pd.factorize(VDJ_10X.index.values)
+		n_cells = len(all_cells)
+		first_idx = first_row_of_cells(cell_idx)
+		group_key, meta_key = _merge_metadata_fields(VDJ_10X, keys=keys, rows=first_idx)
 
-		tmp_key = '{} TRA - {} TRB'.format(n_TRA, n_TRB)
-		if tmp_key not in fraction_clo_dct:
-			fraction_clo_dct['others'][i] = True
-		else:
-			fraction_clo_dct[tmp_key][i] = True
+		chains = VDJ_10X['chain'].values
+		n_TRA = _count_chains_per_cell(cell_idx, chains, n_cells, 'TRA')
+		n_TRB = _count_chains_per_cell(cell_idx, chains, n_cells, 'TRB')
+		chosen_key = pairing_codes(n_TRA, n_TRB)
 
-		fraction_clo_dct[meta_key][i] = tmp_df[meta_key].values[0]
+	fraction_clo_dct = _init_clonotypes_types(pd.Index(all_cells), meta_key)
+	fraction_clo_dct = _assign_clonotypes_types(fraction_clo_dct, chosen_key)
+	fraction_clo_dct[meta_key][:] = group_key.row_labels()
 
 	fraction_clo_df = pd.DataFrame(fraction_clo_dct)
 	fraction_clo_df = fraction_clo_df.set_index('barcode')
@@ -94,21 +86,16 @@ def create_clonotype_fraction_df(VDJ_10X, keys=['Condition']):
 	return fraction_clo_df, meta_key
 
 
+def merge_clonotype_fraction_dfs(fraction_clo_dfs, keys=['Condition']):
+	"""
+	Concatenate per-cell outputs of create_clonotype_fraction_df of several partitions, eg: one per sample
+	"""
+	return pd.concat(fraction_clo_dfs), grouping.GROUP_SEP.join(keys)
+
+
 def plotly_ratio_clonotype_types(fraction_clo_df, meta_key):
 	fraction_clo_df = _grouping_ratio_clonotype_types(fraction_clo_df, meta_key)
-	reformated_dct = {
-		'Groups': [],
-		'Clonotypes types': [],
-		'Ratio': []
-	}
-	for i in fraction_clo_df.index:
-		for j in fraction_clo_df.columns:
-			reformated_dct['Groups'].append(i)
-			reformated_dct['Clonotypes types'].append(j)
-			reformated_dct['Ratio'].append(
-				fraction_clo_df.loc[i, j]
-			)
-	reformated_df = pd.DataFrame(reformated_dct)
+	reformated_df = export.to_long(fraction_clo_df, ['Groups', 'Clonotypes types', 'Ratio'])
 	reformated_df = reformated_df.set_index('Groups')
 	return reformated_df
 
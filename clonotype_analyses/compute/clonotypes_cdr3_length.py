@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+
+from ..common import export
+from ..common.grouping import factorize_groups
+from ..common.constants import CDR3_LENGTH
+from ..common.constants import VDJ_10X_COLUMNS
+from .processing import cdr3_lengths
+
+from matplotlib import pyplot as plt
+
+
+def create_cdr3_length_hist(VDJ_10X, meta_keys=['Condition']):
+	"""
+	Number of contigs of every (chain, group, cdr3 length), one bincount for all chains and groups
+
+	Parameters
+	----------
+	VDJ_10X : pd.DataFrame
+		Merged VDJ + clinical dataframe\n
+		cdr3 lengths are taken from CDR3_LENGTH column, or measured on cdr3 column if missing
+
+	Returns
+	----------
+	pd.DataFrame
+		Index: (chain, group label)\n
+		Columns: cdr3 length 0..max length, 0: missing cdr3
+	"""
+	if CDR3_LENGTH in VDJ_10X.columns:
+		lengths = VDJ_10X[CDR3_LENGTH].values.astype(np.int64)
+	else:
+		lengths = cdr3_lengths(VDJ_10X[VDJ_10X_COLUMNS.CDR3.value].values).astype(np.int64)
+
+	chain_idx, chains = pd.factorize(VDJ_10X[VDJ_10X_COLUMNS.CHAIN.value].values)
+	group_key = factorize_groups(VDJ_10X, meta_keys)
+	chosen = chain_idx >= 0
+	chain_idx = chain_idx[chosen]
+	group_idx = group_key.codes[chosen]
+	lengths = lengths[chosen]
+
+	n_chains = len(chains)
+	n_groups = group_key.n_groups
+	n_lengths = lengths.max() + 1 if len(lengths) else 1
+	hist = np.bincount(
+		(chain_idx * n_groups + group_idx) * n_lengths + lengths,
+		minlength=n_chains * n_groups * n_lengths
+	).reshape(n_chains * n_groups, n_lengths)
+
+	hist_df = pd.DataFrame(
+		hist,
+		index=pd.MultiIndex.from_product(
+			[np.asarray(chains, dtype='O'), group_key.labels],
+			names=[VDJ_10X_COLUMNS.CHAIN.value, group_key.name]
+		),
+		columns=np.arange(n_lengths),
+	)
+	return hist_df.sort_index(level=0, sort_remaining=False)
+
+
+def merge_cdr3_length_hists(hist_dfs):
+	"""
+	Sum partial histograms (see create_cdr3_length_hist) of several partitions, eg: one per sample\n
+	Same rows as the single pass: every chain x every group, zero-filled
+	"""
+	hist_df = pd.concat(hist_dfs).fillna(0)
+	hist_df = hist_df.groupby(level=[0, 1], sort=False).sum()
+	n_lengths = int(hist_df.columns.max()) + 1 if len(hist_df.columns) else 1
+	hist_df = hist_df.reindex(
+		index=pd.MultiIndex.from_product(
+			[
+				hist_df.index.get_level_values(0).unique().sort_values(),
+				hist_df.index.get_level_values(1).unique().sort_values(),
+			],
+			names=hist_dfs[0].index.names
+		),
+		columns=np.arange(n_lengths),
+		fill_value=0
+	)
+	return hist_df.astype(np.int64)
+
+
+def cdr3_length_ratio(hist_df, chain='TRB'):
+	"""
+	Distribution of cdr3 lengths of one chain in every group
+
+	Returns
+	----------
+	pd.DataFrame
+		Index: groups having this chain\n
+		Columns: cdr3 length, from min to max length of this chain
+	"""
+	if chain not in hist_df.index.get_level_values(0):
+		raise Exception('No {} contig'.format(chain))
+
+	chain_hist = hist_df.xs(chain, level=0).iloc[:, 1:]
+	chain_hist = chain_hist.iloc[chain_hist.values.sum(axis=1) > 0, :]
+	nonzero_lengths = np.flatnonzero(chain_hist.values.sum(axis=0))
+	# contigs of this chain, none with a cdr3
+	if not len(nonzero_lengths):
+		raise Exception('No {} contig'.format(chain))
+	chain_hist = chain_hist.iloc[:, nonzero_lengths[0]:nonzero_lengths[-1] + 1]
+	return chain_hist.div(chain_hist.sum(axis=1), axis=0)
+
+
+def plotly_cdr3_length(cdr3_length_df):
+	"""
+	Columns: <group name>, 'CDR3 length', 'Ratio'
+	"""
+	return export.to_long(
+		cdr3_length_df, [cdr3_length_df.index.name, 'CDR3 length', 'Ratio'], dropna=True
+	)
+
+
+def visualize_cdr3_length(cdr3_length_df, chain='TRB'):
+	bin_edge = np.arange(
+		0,
+		cdr3_length_df.columns.max(),
+		2
+	).astype('int')
+
+	ax = cdr3_length_df.T.plot(
+		kind='area',
+		stacked=False,
+		alpha=0.5,
+		xticks=bin_edge,
+		style='.-'
+	)
+	ax.set_title('CDR3-{} length'.format(chain))
+	ax.grid('on', linestyle='--', axis='x')
+	plt.show()
+	return
@@ -0,0 +1,391 @@
+import itertools
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+
+from .. import common
+from ..common.grouping import factorize_groups
+from ..common.constants import CDR3_CLUSTER
+from ..common.constants import CLONOTYPE_CLUSTER
+from ..common.constants import VDJ_10X_COLUMNS
+
+
+METRICS = ('hamming', 'levenshtein')
+LABEL_SEP = '|'
+
+# random 64-bit weights of the polynomial hashes, fixed -> same keys in every process
+_rng = np.random.default_rng(0x5EED)
+_MAX_HASH_LENGTH = 256
+_POS_WEIGHTS = _rng.integers(1, 1 << 63, size=_MAX_HASH_LENGTH, dtype=np.uint64)
+_MASK_WEIGHTS = _rng.integers(1, 1 << 63, size=_MAX_HASH_LENGTH, dtype=np.uint64)
+_LENGTH_WEIGHT, _PARTITION_WEIGHT, _MASK_FAMILY, _DELETION_FAMILY = _rng.integers(
+	1, 1 << 63, size=4, dtype=np.uint64
+)
+
+
+def _byte_matrix(seqs):
+	if not len(seqs):
+		return np.zeros((0, 1), dtype=np.uint64)
+	return common._to_byte_matrix(seqs).astype(np.uint64)
+
+
+def _masked_keys(mat, length, partitions, n_masked):
+	"""
+	One key per (sequence, set of n_masked masked positions)\n
+	Same key <=> same partition, same length, Hamming distance <= n_masked
+	"""
+	base = (mat[:, :length] * _POS_WEIGHTS[:length]).sum(axis=1) \
+		+ np.uint64(length) * _LENGTH_WEIGHT \
+		+ partitions * _PARTITION_WEIGHT + _MASK_FAMILY
+	all_keys = []
+	for combo in itertools.combinations(range(length), min(n_masked, length)):
+		combo = list(combo)
+		all_keys.append(
+			base
+			- (mat[:, combo] * _POS_WEIGHTS[combo]).sum(axis=1)
+			+ _MASK_WEIGHTS[combo].sum()
+		)
+	return all_keys
+
+
+def _deletion_keys(mat, length, partitions, n_deleted):
+	"""
+	One key per (sequence, set of n_deleted deleted positions): hash of the remaining sequence
+	"""
+	base = partitions * _PARTITION_WEIGHT + _DELETION_FAMILY \
+		+ np.uint64(length - n_deleted) * _LENGTH_WEIGHT
+	all_keys = []
+	for combo in itertools.combinations(range(length), n_deleted):
+		kept = [i for i in range(length) if i not in combo]
+		all_keys.append(
+			base + (mat[:, kept] * _POS_WEIGHTS[:len(kept)]).sum(axis=1)
+		)
+	return all_keys
+
+
+def _group_sorted_keys(keys):
+	order = np.argsort(keys, kind='stable')
+	sorted_keys = keys[order]
+	group_id = np.concatenate([[0], np.cumsum(sorted_keys[1:] != sorted_keys[:-1])]) \
+		if len(keys) else np.zeros(0, dtype=np.int64)
+	return order, group_id
+
+
+def _star_edges(seq_idx, group_id):
+	"""
+	Link every member of a key group to the first member
+	"""
+	first_of_group = np.flatnonzero(np.diff(group_id, prepend=-1))
+	first_seq = seq_idx[first_of_group][group_id]
+	chosen = first_seq != seq_idx
+	return first_seq[chosen], seq_idx[chosen]
+
+
+def _all_pairs(seq_idx, group_id):
+	"""
+	All pairs of members of every key group
+	"""
+	n = len(seq_idx)
+	group_end = np.searchsorted(group_id, group_id, side='right')
+	n_pairs = group_end - np.arange(n) - 1
+	first = np.repeat(np.arange(n), n_pairs)
+	offset = np.arange(len(first)) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+	second = first + 1 + offset
+	a, b = seq_idx[first], seq_idx[second]
+	pair_key = np.unique(np.minimum(a, b) * n + np.maximum(a, b))
+	pair_key = pair_key[pair_key // n != pair_key % n]
+	return pair_key // n, pair_key % n
+
+
+def levenshtein_distance(seqs_a, seqs_b):
+	"""
+	Edit distance of every (seqs_a[i], seqs_b[i]) pair, one vectorized DP for all pairs
+	"""
+	mat_a, mat_b = _byte_matrix(seqs_a), _byte_matrix(seqs_b)
+	len_a = np.array([len(i) for i in seqs_a], dtype=np.int64)
+	len_b = np.array([len(i) for i in seqs_b], dtype=np.int64)
+	n_pairs, width_b = mat_b.shape
+	rows = np.arange(n_pairs)
+
+	prev = np.tile(np.arange(width_b + 1, dtype=np.int64), (n_pairs, 1))
+	res = np.where(len_a == 0, len_b, 0)
+	for i in range(1, mat_a.shape[1] + 1):
+		cur = np.empty_like(prev)
+		cur[:, 0] = i
+		best = np.minimum(
+			prev[:, :-1] + (mat_a[:, i - 1, None] != mat_b),
+			prev[:, 1:] + 1
+		)
+		for j in range(1, width_b + 1):
+			cur[:, j] = np.minimum(best[:, j - 1], cur[:, j - 1] + 1)
+		done = len_a == i
+		res[done] = cur[rows[done], len_b[done]]
+		prev = cur
+	return res
+
+
+def connected_components(n, edges_a, edges_b):
+	"""
+	Component of every node (numbered by first appearance), label propagation + pointer jumping
+	"""
+	labels = np.arange(n, dtype=np.int64)
+	while len(edges_a):
+		label_a, label_b = labels[edges_a], labels[edges_b]
+		if np.array_equal(label_a, label_b):
+			break
+		min_label = np.minimum(label_a, label_b)
+		np.minimum.at(labels, label_a, min_label)
+		np.minimum.at(labels, label_b, min_label)
+		while True:
+			jumped = labels[labels]
+			if np.array_equal(jumped, labels):
+				break
+			labels = jumped
+	return pd.factorize(labels)[0]
+
+
+def _cluster_chunk(seqs, partitions, k, metric):
+	"""
+	Cluster of every sequence, sequences only match within their partition
+	"""
+	# hashes wrap around 2^64 on purpose
+	with np.errstate(over='ignore'):
+		return _cluster_chunk_keys(
+			np.asarray(seqs, dtype='O'), np.asarray(partitions, dtype=np.uint64), k, metric
+		)
+
+
+def _cluster_chunk_keys(seqs, partitions, k, metric):
+	lengths = np.array([len(i) for i in seqs], dtype=np.int64)
+	all_edges = []
+
+	def add_edges(key_lists, seq_lists, linker, extra=None):
+		if not len(key_lists):
+			return
+		keys = np.concatenate(key_lists)
+		seq_idx = np.concatenate(seq_lists)
+		order, group_id = _group_sorted_keys(keys)
+		if extra is None:
+			all_edges.append(linker(seq_idx[order], group_id))
+		else:
+			all_edges.append(linker(seq_idx[order], group_id, np.concatenate(extra)[order]))
+
+	by_length = {
+		length: np.flatnonzero(lengths == length)
+		for length in np.unique(lengths)
+		if length < _MAX_HASH_LENGTH
+	}
+
+	# substitutions: same length, masked positions -> exact for any k
+	if metric == 'hamming' or k == 1:
+		key_lists, seq_lists = [], []
+		for length, idx in by_length.items():
+			mat = _byte_matrix(seqs[idx])
+			for keys in _masked_keys(mat, length, partitions[idx], k):
+				key_lists.append(keys)
+				seq_lists.append(idx)
+		add_edges(key_lists, seq_lists, _star_edges)
+
+	if metric == 'levenshtein' and k == 1:
+		# indels: longer sequence minus 1 position == shorter sequence -> exact
+		key_lists, seq_lists, n_deleted = [], [], []
+		for length, idx in by_length.items():
+			mat = _byte_matrix(seqs[idx])
+			for n_del in (0, 1):
+				for keys in _deletion_keys(mat, length, partitions[idx], n_del):
+					key_lists.append(keys)
+					seq_lists.append(idx)
+					n_deleted.append(np.full(len(idx), n_del))
+
+		def link_to_original(seq_idx, group_id, n_del):
+			original_of_group = np.full(group_id[-1] + 1 if len(group_id) else 0, -1, dtype=np.int64)
+			original_of_group[group_id[n_del == 0]] = seq_idx[n_del == 0]
+			original = original_of_group[group_id]
+			chosen = (n_del == 1) & (original >= 0)
+			return original[chosen], seq_idx[chosen]
+
+		add_edges(key_lists, seq_lists, link_to_original, n_deleted)
+
+	elif metric == 'levenshtein':
+		# symmetric deletion neighborhoods: distance <= k -> some shared key, then verify
+		key_lists, seq_lists = [], []
+		for length, idx in by_length.items():
+			mat = _byte_matrix(seqs[idx])
+			for n_del in range(min(k, length) + 1):
+				for keys in _deletion_keys(mat, length, partitions[idx], n_del):
+					key_lists.append(keys)
+					seq_lists.append(idx)
+
+		def verified_pairs(seq_idx, group_id):
+			a, b = _all_pairs(seq_idx, group_id)
+			close = levenshtein_distance(seqs[a], seqs[b]) <= k
+			return a[close], b[close]
+
+		add_edges(key_lists, seq_lists, verified_pairs)
+
+	if len(all_edges):
+		edges_a = np.concatenate([i[0] for i in all_edges])
+		edges_b = np.concatenate([i[1] for i in all_edges])
+	else:
+		edges_a = edges_b = np.zeros(0, dtype=np.int64)
+	return connected_components(len(seqs), edges_a, edges_b)
+
+
+def cluster_sequences(seqs, partitions=None, k=1, metric='levenshtein', n_workers=1):
+	"""
+	Single-linkage clusters of sequences within distance k, no all-pairs comparison
+
+	Parameters
+	----------
+	seqs : np.ndarray[str]
+		Unique sequences (within a partition)
+	partitions : np.ndarray[int]
+		Sequences only match within the same partition, eg: chain / V / J code
+	k : int
+		Max distance
+	metric : str
+		'hamming': substitutions only\n
+		'levenshtein': substitutions, insertions, deletions\n
+		k = 1 (or hamming) -> candidate keys are exact matches, k > 1 (levenshtein) -> candidates are verified\n
+		Sequences of _MAX_HASH_LENGTH characters or more are not hashed: each one is its own cluster
+	n_workers : int
+		Partitions are spread across a process pool when > 1
+
+	Returns
+	----------
+	np.ndarray[int64]: cluster of every sequence
+	"""
+	if metric not in METRICS:
+		raise Exception('metric must be one of {}'.format(METRICS))
+
+	seqs = np.asarray(seqs, dtype='O')
+	if partitions is None:
+		partitions = np.zeros(len(seqs), dtype=np.int64)
+	partitions = np.asarray(partitions, dtype=np.int64)
+	n_long = sum(len(i) >= _MAX_HASH_LENGTH for i in seqs)
+	if n_long:
+		print ('WARNING: {} sequences of {} characters or more are not clustered'.format(n_long, _MAX_HASH_LENGTH))
+
+	if n_workers is None or n_workers <= 1 or len(seqs) == 0:
+		return _cluster_chunk(seqs, partitions, k, metric)
+
+	# whole partitions per chunk, chunks of similar sizes
+	partition_codes, partition_sizes = np.unique(partitions, return_counts=True)
+	chunk_of_partition = np.zeros(len(partition_codes), dtype=np.int64)
+	chunk_sizes = np.zeros(n_workers, dtype=np.int64)
+	for i in np.argsort(-partition_sizes, kind='stable'):
+		chunk_of_partition[i] = np.argmin(chunk_sizes)
+		chunk_sizes[chunk_of_partition[i]] += partition_sizes[i]
+	seq_chunk = chunk_of_partition[np.searchsorted(partition_codes, partitions)]
+	chunks = [np.flatnonzero(seq_chunk == i) for i in range(n_workers)]
+	chunks = [i for i in chunks if len(i)]
+
+	with ProcessPoolExecutor(max_workers=n_workers) as executor:
+		results = list(executor.map(
+			_cluster_chunk,
+			[seqs[i] for i in chunks],
+			[partitions[i] for i in chunks],
+			itertools.repeat(k),
+			itertools.repeat(metric),
+		))
+
+	clusters = np.zeros(len(seqs), dtype=np.int64)
+	offset = 0
+	for idx, chunk_clusters in zip(chunks, results):
+		clusters[idx] = chunk_clusters + offset
+		offset += chunk_clusters.max() + 1
+	return pd.factorize(clusters)[0]
+
+
+def _cell_clusters(cell_idx, row_clusters, n_clusters):
+	"""
+	Clonotype of every cell: the multiset of the clusters of its contigs
+	"""
+	# order-free hash of the contig clusters of every cell
+	weights = np.random.default_rng(0x5EED).integers(1, 1 << 63, size=n_clusters + 1, dtype=np.uint64)
+	chosen = row_clusters >= 0
+	cell_hash = np.zeros(cell_idx.max() + 1 if len(cell_idx) else 0, dtype=np.uint64)
+	np.add.at(cell_hash, cell_idx[chosen], weights[row_clusters[chosen]])
+
+	has_cluster = np.bincount(cell_idx[chosen], minlength=len(cell_hash)) > 0
+	cell_clusters = np.full(len(cell_hash), -1, dtype=np.int64)
+	cell_clusters[has_cluster] = pd.factorize(cell_hash[has_cluster])[0]
+	return cell_clusters
+
+
+def create_cdr3_clusters(VDJ_10X, k=1, metric='levenshtein', by_genes=True, n_workers=1):
+	"""
+	Fuzzy CDR3 clusters, per chain (and per V / J gene)
+
+	Parameters
+	----------
+	VDJ_10X : pd.DataFrame
+		Columns: chain, cdr3 (+ v_gene, j_gene), index: barcodes
+	k, metric, n_workers :
+		See cluster_sequences
+	by_genes : bool
+		Only cluster CDR3s having the same V and J genes
+
+	Returns
+	----------
+	pd.DataFrame, same rows as VDJ_10X
+		CDR3_CLUSTER: cluster of the contig, '<representative cdr3>|<chain>(|<v_gene>|<j_gene>)'\n
+		CLONOTYPE_CLUSTER: clonotype of the cell, '<cluster>;<cluster>' over its contigs\n
+		Representative cdr3: the most frequent cdr3 of the cluster
+	"""
+	partition_columns = [VDJ_10X_COLUMNS.CHAIN.value]
+	if by_genes:
+		partition_columns += [VDJ_10X_COLUMNS.V_GENE.value, VDJ_10X_COLUMNS.J_GENE.value]
+	partition_key = factorize_groups(VDJ_10X, partition_columns)
+
+	cdr3_idx, cdr3_uniques = pd.factorize(VDJ_10X[VDJ_10X_COLUMNS.CDR3.value].values)
+	cdr3_uniques = np.asarray(cdr3_uniques, dtype='O')
+	valid = cdr3_idx >= 0
+	n_cdr3 = max(len(cdr3_uniques), 1)
+
+	# unique (partition, cdr3) pairs are clustered, not rows
+	pair_key = partition_key.codes[valid] * n_cdr3 + cdr3_idx[valid]
+	uni_pairs, pair_idx = np.unique(pair_key, return_inverse=True)
+	pair_idx = pair_idx.reshape(-1)
+	pair_clusters = cluster_sequences(
+		cdr3_uniques[uni_pairs % n_cdr3], uni_pairs // n_cdr3, k, metric, n_workers
+	)
+	n_clusters = pair_clusters.max() + 1 if len(pair_clusters) else 0
+
+	# representative: most frequent pair of every cluster
+	pair_counts = np.bincount(pair_idx, minlength=len(uni_pairs))
+	order = np.lexsort((-pair_counts, pair_clusters))
+	representative = order[np.flatnonzero(np.diff(pair_clusters[order], prepend=-1))]
+	partition_values = [
+		partition_key.level_values(i)[uni_pairs[representative] // n_cdr3]
+		for i in partition_columns
+	]
+	cluster_labels = np.array([
+		LABEL_SEP.join(str(j) for j in i)
+		for i in zip(cdr3_uniques[uni_pairs[representative] % n_cdr3], *partition_values)
+	], dtype='O')
+
+	row_clusters = np.full(len(VDJ_10X), -1, dtype=np.int64)
+	row_clusters[valid] = pair_clusters[pair_idx]
+
+	cell_idx, _ = pd.factorize(VDJ_10X.index.values)
+	cell_clusters = _cell_clusters(cell_idx, row_clusters, n_clusters)
+	row_cell_clusters = cell_clusters[cell_idx]
+
+	# label of every cell clonotype: from one cell having it
+	n_cell_clusters = cell_clusters.max() + 1 if len(cell_clusters) else 0
+	first_cells = np.full(n_cell_clusters, -1, dtype=np.int64)
+	has_cluster = np.flatnonzero(cell_clusters >= 0)
+	first_cells[cell_clusters[has_cluster][::-1]] = has_cluster[::-1]
+	rep_rows = np.flatnonzero(np.isin(cell_idx, first_cells) & (row_clusters >= 0))
+	rep_df = pd.DataFrame({
+		'cell_cluster': row_cell_clusters[rep_rows],
+		'label': cluster_labels[row_clusters[rep_rows]],
+	}).sort_values(['cell_cluster', 'label'])
+	cell_cluster_labels = rep_df.groupby('cell_cluster')['label'].agg(';'.join).values
+
+	return pd.DataFrame({
+		CDR3_CLUSTER: pd.Categorical.from_codes(row_clusters, categories=cluster_labels),
+		CLONOTYPE_CLUSTER: pd.Categorical.from_codes(row_cell_clusters, categories=cell_cluster_labels),
+	}, index=VDJ_10X.index)
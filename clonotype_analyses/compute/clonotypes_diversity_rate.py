@@ -0,0 +1,521 @@
+import warnings
+import numpy as np
+import pandas as pd
+
+from pandas.api.types import union_categoricals
+
+from concurrent.futures import ProcessPoolExecutor
+
+from ..common.constants import CELL_COLUMNS
+from ..common.constants import VDJ_10X_COLUMNS
+from ..common.grouping import factorize_groups
+from .processing import first_row_of_cells
+from .processing import is_cells_table
+
+from matplotlib import pyplot as plt
+
+
+def _has_paired_chains(cell_idx, chains, n_cells):
+	n_chains = {
+		k: np.bincount(cell_idx[chains == k], minlength=n_cells)
+		for k in ['TRA', 'TRB', 'TRG', 'TRD']
+	}
+	return (
+		((n_chains['TRA'] > 0) & (n_chains['TRB'] > 0))
+		| ((n_chains['TRG'] > 0) & (n_chains['TRD'] > 0))
+	)
+
+
+def _min_per_cell(cell_idx, values, n_cells):
+	order = np.argsort(cell_idx, kind='stable')
+	starts = np.searchsorted(cell_idx[order], np.arange(n_cells))
+	return np.minimum.reduceat(values[order], starts)
+
+
+def _collapse_contigs(VDJ_10X, abundance, paired_only):
+	"""
+	Returns
+	----------
+	first_idx: first contig of every cell, counts: abundance of every cell, chosen_cells: cells kept
+	"""
+	cell_idx, all_cells = pd.factorize(VDJ_10X.index.values)
+	n_cells = len(all_cells)
+	first_idx = first_row_of_cells(cell_idx)
+
+	if abundance == 'umis':
+		counts = _min_per_cell(
+			cell_idx, VDJ_10X[VDJ_10X_COLUMNS.UMIS.value].values, n_cells
+		)
+	else:
+		counts = np.ones(n_cells, dtype=np.int64)
+
+	chosen_cells = np.ones(n_cells, dtype=np.bool_)
+	if paired_only:
+		chosen_cells = _has_paired_chains(
+			cell_idx, np.asarray(VDJ_10X[VDJ_10X_COLUMNS.CHAIN.value].values), n_cells
+		)
+	return first_idx, counts, chosen_cells
+
+
+def _collapse_cells_table(cells_df, abundance, paired_only):
+	"""
+	Same as _collapse_contigs, from the per-cell columns saved at ingest
+	"""
+	n_cells = len(cells_df)
+	if abundance == 'umis':
+		counts = cells_df[CELL_COLUMNS.UMIS_MIN.value].values.astype(np.int64)
+	else:
+		counts = np.ones(n_cells, dtype=np.int64)
+
+	chosen_cells = np.ones(n_cells, dtype=np.bool_)
+	if paired_only:
+		has_chain = {
+			k: cells_df[k.value].values > 0
+			for k in [CELL_COLUMNS.N_TRA, CELL_COLUMNS.N_TRB, CELL_COLUMNS.N_TRG, CELL_COLUMNS.N_TRD]
+		}
+		chosen_cells = (
+			(has_chain[CELL_COLUMNS.N_TRA] & has_chain[CELL_COLUMNS.N_TRB])
+			| (has_chain[CELL_COLUMNS.N_TRG] & has_chain[CELL_COLUMNS.N_TRD])
+		)
+	return np.arange(n_cells), counts, chosen_cells
+
+
+def preprocess_diversity_df(
+		VDJ_10X,
+		meta_keys=['Condition'],
+		abundance='cells',
+		paired_only=True,
+		clonotype_key=VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value,
+	):
+	"""
+	Collapse contigs to cells: one clonotype and one count per cell, cells without clonotype are dropped
+
+	Parameters
+	----------
+	VDJ_10X : pd.DataFrame
+		Merged VDJ + clinical dataframe, index: barcodes\n
+		Or merged cells table (see processing.summarize_cells): cells are not collapsed again
+	meta_keys : List[str]
+	abundance : str
+		'cells': each cell counts 1\n
+		'umis': each cell counts its min UMI over its contigs
+	paired_only : bool
+		Only keep cells having both TRA and TRB (or TRG and TRD) contigs
+	clonotype_key : str
+		Column defining clonotypes, e.g. CLONOTYPE_CLUSTER for fuzzy clonotypes
+
+	Returns
+	----------
+	cells_df : pd.DataFrame
+		Columns: group, clonotype (codes >= 0), count, index: position of the first contig of the cell
+	group_key : GroupKey
+		Labels and metadata values of each group code
+	"""
+	if abundance not in ('cells', 'umis'):
+		raise Exception('abundance must be cells or umis')
+
+	if is_cells_table(VDJ_10X):
+		first_idx, counts, chosen_cells = _collapse_cells_table(VDJ_10X, abundance, paired_only)
+	else:
+		first_idx, counts, chosen_cells = _collapse_contigs(VDJ_10X, abundance, paired_only)
+
+	chosen_rows = first_idx[chosen_cells]
+	clonotype_idx, _ = pd.factorize(
+		VDJ_10X[clonotype_key].values[chosen_rows]
+	)
+	# cells without clonotype (eg: missing cdr3 -> no CLONOTYPE_CLUSTER) are dropped
+	has_clonotype = clonotype_idx >= 0
+	chosen_rows = chosen_rows[has_clonotype]
+	group_key = factorize_groups(VDJ_10X, meta_keys, chosen_rows)
+
+	cells_df = pd.DataFrame({
+		'group': group_key.codes,
+		'clonotype': clonotype_idx[has_clonotype],
+		'count': counts[chosen_cells][has_clonotype],
+	}, index=chosen_rows)
+	return cells_df, group_key
+
+
+def count_clonotypes(cells_df, n_groups):
+	"""
+	One grouped count: abundance of every (group, clonotype) pair
+
+	Parameters
+	----------
+	cells_df : pd.DataFrame
+		Columns: group, clonotype, count, see preprocess_diversity_df\n
+		Clonotype codes must be >= 0 (cells without clonotype dropped)
+
+	Returns
+	----------
+	pair_group : np.ndarray[int64]
+		group code of each (group, clonotype) pair
+	pair_count : np.ndarray[float64]
+		abundance of each pair
+	"""
+	n_clonotypes = cells_df['clonotype'].max() + 1 if len(cells_df) else 1
+	pair_key = cells_df['group'].values.astype(np.int64) * n_clonotypes + cells_df['clonotype'].values
+	uni_key, pair_idx = np.unique(pair_key, return_inverse=True)
+	pair_count = np.bincount(
+		pair_idx.reshape(-1), weights=cells_df['count'].values, minlength=len(uni_key)
+	)
+	return uni_key // n_clonotypes, pair_count
+
+
+def diversity_from_counts(pair_group, pair_count, n_groups, hill_orders=(0, 1, 2), abundance='cells'):
+	"""
+	Diversity indices of all groups at once from (group, clonotype) abundances
+
+	Parameters
+	----------
+	abundance : str
+		Unit of pair_count, 'cells' or 'umis': the total of every group is n_<abundance>
+
+	Returns
+	----------
+	Dict: metric name -> np.ndarray of n_groups values
+	"""
+	total = np.bincount(pair_group, weights=pair_count, minlength=n_groups)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		p = pair_count / total[pair_group]
+	richness = np.bincount(pair_group, minlength=n_groups)
+
+	p_log_p = np.where(p > 0, p * np.log(np.where(p > 0, p, 1)), 0)
+	shannon = -np.bincount(pair_group, weights=p_log_p, minlength=n_groups)
+	simpson_lambda = np.bincount(pair_group, weights=p ** 2, minlength=n_groups)
+
+	with np.errstate(divide='ignore', invalid='ignore'):
+		# a single clonotype is fully clonal
+		clonality = np.where(
+			richness > 1,
+			1 - shannon / np.log(np.maximum(richness, 2)),
+			1.0
+		)
+		res = {
+			'n_{}'.format(abundance): total,
+			'n_clonotypes': richness,
+			'shannon': shannon,
+			'simpson': 1 - simpson_lambda,
+			'inverse_simpson': 1 / simpson_lambda,
+			'clonality': clonality,
+		}
+		for q in hill_orders:
+			if q == 1:
+				res['hill_{}'.format(q)] = np.exp(shannon)
+			else:
+				res['hill_{}'.format(q)] = np.bincount(
+					pair_group, weights=p ** q, minlength=n_groups
+				) ** (1 / (1 - q))
+	return res
+
+
+def create_diversity_df(
+		VDJ_10X,
+		meta_keys=['Condition'],
+		abundance='cells',
+		hill_orders=(0, 1, 2),
+		paired_only=True,
+		clonotype_key=VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value,
+	):
+	"""
+	Clonotype diversity (Shannon, Simpson, inverse Simpson, Hill numbers, clonality) of every group
+
+	Returns
+	----------
+	pd.DataFrame
+		Index: group labels (see GroupKey.labels), sorted\n
+		Columns: meta_keys, n_cells (n_umis if abundance is 'umis'), n_clonotypes, diversity metrics
+	"""
+	cells_df, group_key = preprocess_diversity_df(
+		VDJ_10X, meta_keys, abundance, paired_only, clonotype_key
+	)
+	n_groups = group_key.n_groups
+	pair_group, pair_count = count_clonotypes(cells_df, n_groups)
+	metrics = diversity_from_counts(pair_group, pair_count, n_groups, hill_orders, abundance)
+	return _diversity_df(metrics, group_key, meta_keys)
+
+
+def _diversity_df(metrics, group_key, meta_keys):
+	diversity_df = pd.DataFrame(metrics, index=pd.Index(group_key.labels, name=group_key.name))
+	for i, k in enumerate(meta_keys):
+		diversity_df.insert(i, k, group_key.level_values(k))
+	return diversity_df
+
+
+def create_clonotype_abundance_df(
+		VDJ_10X,
+		meta_keys=['Condition'],
+		abundance='cells',
+		paired_only=True,
+		clonotype_key=VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value,
+	):
+	"""
+	Partial aggregate of one partition (eg: one sample) for the map-reduce path:
+	abundance of every (group, clonotype) pair, cells without clonotype are dropped\n
+	Abundances of all partitions are summed by merge_clonotype_abundances
+
+	Returns
+	----------
+	pd.DataFrame
+		Columns: meta_keys, 'clonotype' (value of clonotype_key), 'count'
+	"""
+	cells_df, group_key = preprocess_diversity_df(
+		VDJ_10X, meta_keys, abundance, paired_only, clonotype_key
+	)
+	n_clonotypes = cells_df['clonotype'].max() + 1 if len(cells_df) else 1
+	pair_key = cells_df['group'].values.astype(np.int64) * n_clonotypes + cells_df['clonotype'].values
+	uni_key, first_idx, pair_idx = np.unique(pair_key, return_index=True, return_inverse=True)
+	pair_count = np.bincount(
+		pair_idx.reshape(-1), weights=cells_df['count'].values, minlength=len(uni_key)
+	)
+
+	pair_group = uni_key // n_clonotypes
+	abundance_df = pd.DataFrame({
+		k: group_key.level_values(k)[pair_group] for k in meta_keys
+	})
+	abundance_df['clonotype'] = VDJ_10X[clonotype_key].values[cells_df.index.values[first_idx]]
+	abundance_df['count'] = pair_count
+	return abundance_df
+
+
+def merge_clonotype_abundances(abundance_dfs, meta_keys=['Condition']):
+	"""
+	Sum partial abundances (see create_clonotype_abundance_df) of the same (group, clonotype)\n
+	Clonotypes are matched by value, same as the single pass over all partitions
+	"""
+	abundance_df = pd.concat(abundance_dfs, ignore_index=True)
+	for k in meta_keys:
+		# partitions have their own categories: keep a categorical column, as the single pass does
+		if all(isinstance(i[k].dtype, pd.CategoricalDtype) for i in abundance_dfs):
+			abundance_df[k] = union_categoricals([i[k] for i in abundance_dfs])
+	return abundance_df.groupby(
+		list(meta_keys) + ['clonotype'], sort=False, dropna=False, observed=True
+	)['count'].sum().reset_index()
+
+
+def diversity_from_abundances(abundance_df, meta_keys=['Condition'], hill_orders=(0, 1, 2), abundance='cells'):
+	"""
+	Same output as create_diversity_df, from merged abundances
+	"""
+	group_key = factorize_groups(abundance_df, meta_keys)
+	metrics = diversity_from_counts(
+		group_key.codes, abundance_df['count'].values.astype(np.float64),
+		group_key.n_groups, hill_orders, abundance
+	)
+	return _diversity_df(metrics, group_key, meta_keys)
+
+
+def _resample_batch(counts, depth, n_samples, method, seed, hill_orders, abundance):
+	"""
+	Draw n_samples resampled count vectors of one group at once and compute their diversity
+
+	Returns
+	----------
+	Dict: metric name -> np.ndarray of n_samples values
+	"""
+	rng = np.random.default_rng(seed)
+	if method == 'rarefaction':
+		samples = rng.multivariate_hypergeometric(counts, depth, size=n_samples)
+	else:
+		samples = rng.multinomial(depth, counts / counts.sum(), size=n_samples)
+
+	# each replicate is a "group" of (replicate, clonotype) pairs
+	pair_group, pair_clonotype = np.nonzero(samples)
+	return diversity_from_counts(
+		pair_group, samples[pair_group, pair_clonotype].astype(np.float64),
+		n_samples, hill_orders, abundance
+	)
+
+
+def resample_diversity(
+		pair_group,
+		pair_count,
+		n_groups,
+		depth=None,
+		n_iter=1000,
+		method='rarefaction',
+		seed=0,
+		n_workers=1,
+		batch_size=100,
+		hill_orders=(0, 1, 2),
+		abundance='cells',
+	):
+	"""
+	Rarefaction / bootstrap of the diversity of every group
+
+	Parameters
+	----------
+	pair_group, pair_count :
+		Output of count_clonotypes, abundances must be integers
+	depth : int
+		Number of cells drawn per replicate, default: size of the smallest group\n
+		rarefaction: groups smaller than depth are skipped (NaN)
+	n_iter : int
+		Number of replicates per group
+	method : str
+		'rarefaction': subsample without replacement (multivariate hypergeometric)\n
+		'bootstrap': resample with replacement (multinomial)
+	seed : int
+		Every (group, batch) gets its own child seed -> results do not depend on n_workers
+	n_workers : int
+		Batches are spread across a process pool when > 1
+	batch_size : int
+		Number of replicates drawn at once
+	abundance : str
+		Unit of pair_count, 'cells' or 'umis', see diversity_from_counts
+
+	Returns
+	----------
+	Dict: metric name -> np.ndarray (n_groups, n_iter)
+	"""
+	if method not in ('rarefaction', 'bootstrap'):
+		raise Exception('method must be rarefaction or bootstrap')
+
+	pair_count = np.round(pair_count).astype(np.int64)
+	order = np.argsort(pair_group, kind='stable')
+	group_starts = np.searchsorted(pair_group[order], np.arange(n_groups + 1))
+	all_counts = [
+		pair_count[order[group_starts[g]:group_starts[g + 1]]]
+		for g in range(n_groups)
+	]
+	totals = np.array([i.sum() for i in all_counts])
+	if not np.any(totals > 0):
+		raise Exception('no cells to resample')
+	if depth is None:
+		depth = int(totals[totals > 0].min())
+
+	batch_starts = range(0, n_iter, batch_size)
+	# one child seed per (group, batch), spawned for all groups -> skipping a group does not shift the others
+	seeds = np.random.SeedSequence(seed).spawn(n_groups * len(batch_starts))
+	batches = [
+		(g, j, start, min(batch_size, n_iter - start))
+		for g in range(n_groups)
+		if totals[g] > 0 and (method == 'bootstrap' or totals[g] >= depth)
+		for j, start in enumerate(batch_starts)
+	]
+	tasks = [
+		(all_counts[g], depth, size, method, seeds[g * len(batch_starts) + j], hill_orders, abundance)
+		for g, j, start, size in batches
+	]
+
+	if n_workers is None or n_workers <= 1:
+		results = [_resample_batch(*i) for i in tasks]
+	else:
+		with ProcessPoolExecutor(max_workers=n_workers) as executor:
+			results = list(executor.map(_resample_batch, *zip(*tasks)))
+
+	res = {}
+	for (g, _, start, size), batch_res in zip(batches, results):
+		for k, v in batch_res.items():
+			if k not in res:
+				res[k] = np.full((n_groups, n_iter), np.nan)
+			res[k][g, start:start + size] = v
+	return res
+
+
+def create_resampled_diversity_df(
+		VDJ_10X,
+		meta_keys=['Condition'],
+		depth=None,
+		n_iter=1000,
+		method='rarefaction',
+		abundance='cells',
+		seed=0,
+		n_workers=1,
+		hill_orders=(0, 1, 2),
+		paired_only=True,
+		clonotype_key=VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value,
+	):
+	"""
+	Diversity of every group after resampling all groups to a common depth
+
+	Returns
+	----------
+	pd.DataFrame
+		Index: group labels (see GroupKey.labels), sorted\n
+		Columns: meta_keys, depth, and for every metric: <metric>_mean, <metric>_std, <metric>_lower, <metric>_upper (95% interval)
+	"""
+	cells_df, group_key = preprocess_diversity_df(
+		VDJ_10X, meta_keys, abundance, paired_only, clonotype_key
+	)
+	n_groups = group_key.n_groups
+	pair_group, pair_count = count_clonotypes(cells_df, n_groups)
+	if not len(pair_count):
+		# eg: paired_only and no paired cell
+		raise Exception('no cells to resample')
+	if depth is None:
+		depth = int(np.round(np.bincount(pair_group, weights=pair_count, minlength=n_groups).min()))
+
+	replicates = resample_diversity(
+		pair_group, pair_count, n_groups,
+		depth=depth, n_iter=n_iter, method=method, seed=seed,
+		n_workers=n_workers, hill_orders=hill_orders, abundance=abundance
+	)
+
+	summary = {'depth': np.full(n_groups, depth)}
+	with warnings.catch_warnings():
+		# skipped groups are all-NaN
+		warnings.simplefilter('ignore', category=RuntimeWarning)
+		for k, v in replicates.items():
+			summary['{}_mean'.format(k)] = np.nanmean(v, axis=1)
+			summary['{}_std'.format(k)] = np.nanstd(v, axis=1)
+			summary['{}_lower'.format(k)] = np.nanpercentile(v, 2.5, axis=1)
+			summary['{}_upper'.format(k)] = np.nanpercentile(v, 97.5, axis=1)
+
+	resampled_df = pd.DataFrame(summary, index=pd.Index(group_key.labels, name=group_key.name))
+	for i, k in enumerate(meta_keys):
+		resampled_df.insert(i, k, group_key.level_values(k))
+	return resampled_df
+
+
+def plotly_diversity(diversity_df, meta_keys, metric='shannon'):
+	"""
+	Eg: meta_keys = ['Condition', 'Subject ID']
+	-> columns: 'Condition', 'shannon per Subject ID'
+	"""
+	value_column = metric
+	if len(meta_keys) > 1:
+		value_column = '{} per {}'.format(metric, meta_keys[-1])
+	return pd.DataFrame({
+		meta_keys[0]: diversity_df[meta_keys[0]].values,
+		value_column: diversity_df[metric].values,
+	})
+
+
+def _calculate_pvalue(all_data_arr):
+	try:
+		from scipy import stats
+	except ImportError:
+		return None
+	if len(all_data_arr) < 2:
+		return None
+	if len(all_data_arr) == 2:
+		return stats.mannwhitneyu(all_data_arr[0], all_data_arr[1]).pvalue
+	return stats.f_oneway(*all_data_arr).pvalue
+
+
+def visualize_diversity(diversity_df, meta_keys, metric='shannon'):
+	group_names, group_indices = np.unique(
+		diversity_df[meta_keys[0]].values, return_inverse=True
+	)
+	values = diversity_df[metric].values
+	all_data_arr = [values[group_indices == i] for i in range(len(group_names))]
+
+	fig, ax = plt.subplots(nrows=1, ncols=1)
+	ax.boxplot(all_data_arr)
+	for i in range(len(all_data_arr)):
+		ax.scatter(x=[i + 1] * len(all_data_arr[i]), y=all_data_arr[i])
+	ax.set_xticklabels(group_names)
+	ax.set_title('Clonotypes diversity: {}'.format(metric))
+
+	pvalue = _calculate_pvalue(all_data_arr)
+	if pvalue is not None:
+		plt.text(
+			x=len(group_names) / 2 + 0.5,
+			y=np.max(values),
+			s='p_value={}'.format(np.round(pvalue, 5)),
+			horizontalalignment='center',
+			verticalalignment='top',
+		)
+	plt.show()
+	return
@@ -0,0 +1,164 @@
+import numpy as np
+import pandas as pd
+
+from ..common import export
+from ..common.constants import VDJ_10X_COLUMNS
+from ..common.grouping import factorize_groups
+from .processing import first_row_of_cells
+from .processing import is_cells_table
+from .clonotypes_diversity_rate import count_clonotypes
+
+from matplotlib import pyplot as plt
+
+
+def create_clone_size_df(VDJ_10X, meta_keys=['Condition'], clonotype_key=VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value):
+	"""
+	Histogram of clone sizes of every group, computed once for all lower_n
+
+	Parameters
+	----------
+	VDJ_10X : pd.DataFrame
+		Merged VDJ + clinical dataframe, index: barcodes\n
+		Or merged cells table (see processing.summarize_cells): cells are not collapsed again
+	meta_keys : List[str]
+	clonotype_key : str
+		Column defining clonotypes, e.g. CLONOTYPE_CLUSTER for fuzzy clonotypes
+
+	Returns
+	----------
+	pd.DataFrame
+		Index: group labels (see GroupKey.labels), sorted\n
+		Columns: clone size 1..max size, values: number of clonotypes having this size
+	"""
+	if is_cells_table(VDJ_10X):
+		first_idx = np.arange(len(VDJ_10X))
+	else:
+		cell_idx, _ = pd.factorize(VDJ_10X.index.values)
+		first_idx = first_row_of_cells(cell_idx)
+
+	clonotype_idx, _ = pd.factorize(
+		VDJ_10X[clonotype_key].values[first_idx]
+	)
+	chosen = clonotype_idx >= 0
+	chosen_rows = first_idx[chosen]
+	group_key = factorize_groups(VDJ_10X, meta_keys, chosen_rows)
+	n_groups = group_key.n_groups
+
+	# (group, clonotype) count -> size of every clone
+	pair_group, clone_size = count_clonotypes(
+		pd.DataFrame({
+			'group': group_key.codes,
+			'clonotype': clonotype_idx[chosen],
+			'count': np.ones(len(chosen_rows), dtype=np.int64),
+		}),
+		n_groups
+	)
+	return _clone_size_df(pair_group, clone_size.astype(np.int64), group_key)
+
+
+def clone_sizes_from_abundances(abundance_df, meta_keys=['Condition']):
+	"""
+	Same output as create_clone_size_df, from merged cell abundances (see clonotypes_diversity_rate.merge_clonotype_abundances)
+	"""
+	group_key = factorize_groups(abundance_df, meta_keys)
+	return _clone_size_df(
+		group_key.codes, abundance_df['count'].values.astype(np.int64), group_key
+	)
+
+
+def _clone_size_df(pair_group, clone_size, group_key):
+	n_groups = group_key.n_groups
+	# (group, size) count -> number of clonotypes of every size
+	n_sizes = clone_size.max() + 1 if len(clone_size) else 1
+	size_hist = np.bincount(
+		pair_group * n_sizes + clone_size, minlength=n_groups * n_sizes
+	).reshape(n_groups, n_sizes)
+
+	clone_size_df = pd.DataFrame(
+		size_hist[:, 1:],
+		index=pd.Index(group_key.labels, name=group_key.name),
+		columns=np.arange(1, n_sizes),
+	)
+	return clone_size_df
+
+
+def expansion_from_clone_sizes(clone_size_df, lower_n=5):
+	"""
+	Proportion of clonotypes of size 1, 2, .., lower_n and > lower_n in every group
+
+	Returns
+	----------
+	pd.DataFrame
+		Index: groups\n
+		Columns: 'n = 1', .., 'n = <lower_n>', 'n > <lower_n>'
+	"""
+	size_hist = clone_size_df.values
+	total = size_hist.sum(axis=1)
+	# sizes above the largest clone are empty
+	size_hist = np.pad(
+		size_hist, ((0, 0), (0, max(0, lower_n - size_hist.shape[1])))
+	)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		ratio = np.column_stack([
+			size_hist[:, :lower_n],
+			size_hist[:, lower_n:].sum(axis=1),
+		]) / total[:, None]
+
+	return pd.DataFrame(
+		ratio,
+		index=pd.Index(clone_size_df.index.values, name='groups'),
+		columns=['n = {}'.format(i) for i in range(1, lower_n + 1)] + ['n > {}'.format(lower_n)],
+	)
+
+
+def create_clonotypes_expansion_df(
+		VDJ_10X,
+		meta_keys=['Condition'],
+		lower_n=5,
+		clonotype_key=VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value,
+	):
+	"""
+	Clonal expansion of every group
+
+	Parameters
+	----------
+	lower_n : int or List[int]
+		Clones larger than lower_n are pooled together\n
+		A list of lower_n reuses the same clone size histogram
+
+	Returns
+	----------
+	pd.DataFrame (see expansion_from_clone_sizes), or Dict: lower_n -> pd.DataFrame when lower_n is a list
+	"""
+	clone_size_df = create_clone_size_df(VDJ_10X, meta_keys, clonotype_key)
+	if np.ndim(lower_n) == 0:
+		return expansion_from_clone_sizes(clone_size_df, lower_n)
+	return {
+		n: expansion_from_clone_sizes(clone_size_df, n)
+		for n in lower_n
+	}
+
+
+def plotly_clonotypes_expansion(expansion_df):
+	"""
+	Columns: 'Groups', 'Clonotypes size', 'Ratio'
+	"""
+	return export.to_long(expansion_df, ['Groups', 'Clonotypes size', 'Ratio'], dropna=True)
+
+
+def visualize_clonotypes_expansion(expansion_df):
+	ax = expansion_df.sort_index(ascending=False).plot(
+		kind='bar',
+		stacked=True,
+		title='Clonal expansion',
+		xlabel=''
+	)
+	ax.legend(
+		loc='center left',
+		bbox_to_anchor=(1.04, 0.5),
+		fancybox=True,
+		shadow=True,
+		ncol=1
+	)
+	plt.show()
+	return
@@ -0,0 +1,446 @@
+import numpy as np
+import pandas as pd
+
+from ..common import export
+from ..common.grouping import factorize_groups
+from ..common.h5_store import InvertedIndex
+from ..common.constants import VDJ_10X_COLUMNS
+
+from matplotlib import pyplot as plt
+
+
+RANK_BY = ('subjects', 'cells', 'umis')
+
+
+def _count_distinct(value_codes, other_codes, n_values):
+	"""
+	Number of distinct other_codes of every value code, -1: ignored
+	"""
+	chosen = (value_codes >= 0) & (other_codes >= 0)
+	n_other = other_codes[chosen].max() + 1 if np.any(chosen) else 1
+	return np.bincount(
+		np.unique(value_codes[chosen] * n_other + other_codes[chosen]) // n_other,
+		minlength=n_values
+	)
+
+
+def score_clonotypes(index, indexed_groups, indexed_cells=None, indexed_umis=None):
+	"""
+	Publicity scores of every indexed value
+
+	Parameters
+	----------
+	index : InvertedIndex
+	indexed_groups : np.ndarray[int64]
+		Group (subject) of every row of index.indices, -1: ignored
+	indexed_cells : np.ndarray[int64]
+		Cell code of every row of index.indices
+	indexed_umis : np.ndarray
+		UMI of every row of index.indices
+
+	Returns
+	----------
+	pd.DataFrame
+		Index: values, columns: subjects, n_rows (+ cells, umis)
+	"""
+	n_values = len(index.categories)
+	value_codes = np.where(indexed_groups >= 0, index.row_codes(), -1)
+	chosen = value_codes >= 0
+
+	scores = {
+		'subjects': _count_distinct(value_codes, indexed_groups, n_values),
+		'n_rows': np.bincount(value_codes[chosen], minlength=n_values),
+	}
+	if indexed_cells is not None:
+		scores['cells'] = _count_distinct(value_codes, indexed_cells, n_values)
+	if indexed_umis is not None:
+		scores['umis'] = np.bincount(
+			value_codes[chosen], weights=indexed_umis[chosen], minlength=n_values
+		)
+	return pd.DataFrame(scores, index=pd.Index(index.categories, name='clonotype'))
+
+
+def top_k(scores, k, *tie_scores):
+	"""
+	Positions of the k largest scores, sorted; ties: tie_scores (larger first), then position\n
+	Partial selection: only values reaching the k-th score are sorted
+	"""
+	scores = np.asarray(scores)
+	k = min(k, len(scores))
+	if k <= 0:
+		return np.zeros(0, dtype=np.int64)
+	threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+	candidates = np.flatnonzero(scores >= threshold)
+	order = np.lexsort(
+		[candidates]
+		+ [-np.asarray(i)[candidates] for i in reversed(tie_scores)]
+		+ [-scores[candidates]]
+	)
+	return candidates[order[:k]]
+
+
+def find_common_clonotypes(index, indexed_groups, n_groups, n_top=5):
+	"""
+	Codes of the n_top values found in the most groups, ties: most rows first
+
+	Returns
+	----------
+	np.ndarray[int64]
+	"""
+	scores_df = score_clonotypes(index, indexed_groups)
+	return top_k(scores_df['subjects'].values, n_top, scores_df['n_rows'].values)
+
+
+def rank_public_clonotypes(index, indexed_groups, n_top=5, rank_by='subjects', indexed_cells=None, indexed_umis=None):
+	"""
+	Exact top n_top public clonotypes
+
+	Parameters
+	----------
+	rank_by : str
+		'subjects': number of groups having the clonotype\n
+		'cells': number of cells, needs indexed_cells\n
+		'umis': sum of UMIs, needs indexed_umis
+
+	Returns
+	----------
+	pd.DataFrame, sorted by rank_by, see score_clonotypes
+	"""
+	if rank_by not in RANK_BY:
+		raise Exception('rank_by must be one of {}'.format(RANK_BY))
+
+	scores_df = score_clonotypes(index, indexed_groups, indexed_cells, indexed_umis)
+	if rank_by not in scores_df.columns:
+		raise Exception('missing data to rank by {}'.format(rank_by))
+
+	# ties: the other scores, in RANK_BY order
+	tie_columns = [i for i in RANK_BY if i != rank_by and i in scores_df.columns] + ['n_rows']
+	top_idx = top_k(
+		scores_df[rank_by].values, n_top, *[scores_df[i].values for i in tie_columns]
+	)
+	return scores_df.iloc[top_idx, :]
+
+
+class SpaceSaving(object):
+	def __init__(self, capacity=10000):
+		"""
+		Weighted SpaceSaving summary: keeps at most capacity values\n
+		Every value with a true total > (total weight / capacity) is kept,
+		counts overestimate the true totals by at most error
+
+		Parameters
+		----------
+		capacity : int
+			Number of tracked values
+		"""
+		self.capacity = capacity
+		self.values = np.zeros(0, dtype='O')
+		self.counts = np.zeros(0, dtype=np.float64)
+		self.errors = np.zeros(0, dtype=np.float64)
+
+
+	def update(self, values, weights):
+		"""
+		Merge one batch, values must be unique within the batch
+		"""
+		values = np.asarray(values, dtype='O')
+		weights = np.asarray(weights, dtype=np.float64)
+		# untracked values may have had up to min count before
+		min_count = self.counts.min() if len(self.counts) >= self.capacity else 0.0
+
+		tracked_idx = pd.Index(self.values).get_indexer(values)
+		counts = self.counts.copy()
+		np.add.at(counts, tracked_idx[tracked_idx >= 0], weights[tracked_idx >= 0])
+
+		new = tracked_idx < 0
+		all_values = np.concatenate([self.values, values[new]])
+		all_counts = np.concatenate([counts, weights[new] + min_count])
+		all_errors = np.concatenate([self.errors, np.full(np.sum(new), min_count)])
+
+		kept = top_k(all_counts, self.capacity)
+		self.values = all_values[kept]
+		self.counts = all_counts[kept]
+		self.errors = all_errors[kept]
+		return self
+
+
+	def top(self, k=5):
+		kept = top_k(self.counts, k, -self.errors)
+		return pd.DataFrame({
+			'score': self.counts[kept],
+			'error': self.errors[kept],
+		}, index=pd.Index(self.values[kept], name='clonotype'))
+
+
+class CountMinSketch(object):
+	def __init__(self, width=1 << 16, depth=4, capacity=10000, seed=0):
+		"""
+		Count-Min sketch of the value totals, plus the capacity values with the largest estimates\n
+		Estimates never underestimate, memory: depth * width counters + capacity values
+
+		Parameters
+		----------
+		width, depth : int
+			Size of the counter table
+		capacity : int
+			Number of candidate values kept for top()
+		"""
+		self.width = width
+		self.depth = depth
+		self.capacity = capacity
+		self.table = np.zeros((depth, width), dtype=np.float64)
+		# odd multipliers of the multiply-shift hashes, one per row
+		self._multipliers = (
+			np.random.default_rng(seed).integers(1, 1 << 62, size=depth, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+		)
+		self.values = np.zeros(0, dtype='O')
+
+
+	def _buckets(self, values):
+		hashes = pd.util.hash_array(np.asarray(values, dtype='O'))
+		with np.errstate(over='ignore'):
+			return [
+				((hashes * i) >> np.uint64(32)) % np.uint64(self.width)
+				for i in self._multipliers
+			]
+
+
+	def estimate(self, values):
+		if not len(values):
+			return np.zeros(0, dtype=np.float64)
+		return np.min([
+			self.table[i][buckets] for i, buckets in enumerate(self._buckets(values))
+		], axis=0)
+
+
+	def update(self, values, weights):
+		"""
+		Add one batch, values must be unique within the batch
+		"""
+		values = np.asarray(values, dtype='O')
+		weights = np.asarray(weights, dtype=np.float64)
+		for i, buckets in enumerate(self._buckets(values)):
+			self.table[i] += np.bincount(
+				buckets.astype(np.int64), weights=weights, minlength=self.width
+			)
+
+		candidates = pd.unique(np.concatenate([self.values, values]))
+		kept = top_k(self.estimate(candidates), self.capacity)
+		self.values = candidates[kept]
+		return self
+
+
+	def top(self, k=5):
+		estimates = self.estimate(self.values)
+		kept = top_k(estimates, k)
+		return pd.DataFrame({
+			'score': estimates[kept],
+		}, index=pd.Index(self.values[kept], name='clonotype'))
+
+
+def batch_scores(values, rank_by='subjects', groups=None, cells=None, umis=None):
+	"""
+	Weights of the values of one batch (eg: one sample)
+
+	Parameters
+	----------
+	values : np.ndarray
+		Value of every row
+	groups : np.ndarray[int64]
+		Group code of every row, -1: row ignored
+	cells : np.ndarray[int64]
+		Cell code of every row
+	umis : np.ndarray
+		UMI of every row
+
+	Returns
+	----------
+	(unique values, weights)
+	"""
+	if rank_by not in RANK_BY:
+		raise Exception('rank_by must be one of {}'.format(RANK_BY))
+
+	value_codes, uniques = pd.factorize(values)
+	value_codes = np.where(groups >= 0, value_codes, -1)
+	if rank_by == 'subjects':
+		weights = _count_distinct(value_codes, groups, len(uniques))
+	elif rank_by == 'cells':
+		weights = _count_distinct(value_codes, cells, len(uniques))
+	else:
+		chosen = value_codes >= 0
+		weights = np.bincount(value_codes[chosen], weights=umis[chosen], minlength=len(uniques))
+	chosen = weights > 0
+	return np.asarray(uniques, dtype='O')[chosen], weights[chosen]
+
+
+def approximate_public_clonotypes(batches, n_top=5, method='space_saving', capacity=10000, width=1 << 16, depth=4, seed=0):
+	"""
+	One pass top n_top public clonotypes, only the sketch is kept in memory
+
+	Parameters
+	----------
+	batches : Iterable[(values, weights)]
+		Eg: one batch per sample, values unique within the batch
+	method : str
+		'space_saving' or 'count_min'
+
+	Returns
+	----------
+	pd.DataFrame
+		Index: clonotypes, columns: score (+ error for space_saving)
+	"""
+	if method == 'space_saving':
+		sketch = SpaceSaving(capacity)
+	elif method == 'count_min':
+		sketch = CountMinSketch(width, depth, capacity, seed)
+	else:
+		raise Exception('method must be space_saving or count_min')
+
+	for values, weights in batches:
+		sketch.update(values, weights)
+	return sketch.top(n_top)
+
+
+def tracing_ratio(index, indexed_groups, chosen_codes, group_totals):
+	"""
+	Fraction of the rows of every group having each chosen value\n
+	Only the index slices of the chosen values are read
+
+	Parameters
+	----------
+	group_totals : np.ndarray
+		Number of rows of every group
+
+	Returns
+	----------
+	np.ndarray (n_groups, len(chosen_codes))
+	"""
+	n_groups = len(group_totals)
+	counts = np.zeros((n_groups, len(chosen_codes)), dtype=np.int64)
+	for j, code in enumerate(chosen_codes):
+		groups = indexed_groups[index.indptr[code]:index.indptr[code + 1]]
+		counts[:, j] = np.bincount(groups[groups >= 0], minlength=n_groups)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		return counts / group_totals[:, None]
+
+
+def create_tracing_df(index, indexed_groups, group_labels, group_totals, n_top=5, clonotypes=None):
+	"""
+	Parameters
+	----------
+	index : InvertedIndex
+	indexed_groups : np.ndarray[int64]
+		Group of every row of index.indices, -1: ignored
+	group_labels : np.ndarray
+	group_totals : np.ndarray
+		Number of rows of every group, indexed or not
+	clonotypes : List[str]
+		Values to trace, default: the n_top values shared by the most groups
+
+	Returns
+	----------
+	pd.DataFrame
+		Index: Groups, columns: traced values, values: fraction of the rows of the group
+	"""
+	if clonotypes is None:
+		chosen_codes = find_common_clonotypes(
+			index, indexed_groups, len(group_labels), n_top
+		)
+	else:
+		chosen_codes = index.codes_of(clonotypes)
+		if np.any(chosen_codes < 0):
+			raise Exception('cannot find {}'.format(
+				list(np.asarray(clonotypes, dtype='O')[chosen_codes < 0])
+			))
+
+	return pd.DataFrame(
+		tracing_ratio(index, indexed_groups, chosen_codes, group_totals),
+		index=pd.Index(group_labels, name='Groups'),
+		columns=index.categories[chosen_codes],
+	)
+
+
+def clonotype_tracing(VDJ_10X, meta_keys=['Condition'], n_cdr3=5, key=VDJ_10X_COLUMNS.CDR3.value):
+	"""
+	In-memory version: trace the values of key (cdr3, raw_clonotype_id) shared by the most groups
+	"""
+	index = InvertedIndex.from_values(VDJ_10X[key].values)
+	group_key = factorize_groups(VDJ_10X, meta_keys)
+	return create_tracing_df(
+		index,
+		group_key.codes[index.indices],
+		group_key.labels,
+		np.bincount(group_key.codes, minlength=group_key.n_groups),
+		n_cdr3
+	)
+
+
+def clonotypes_scatter(clonotype_df, clinical_df, embedding_columns=['X_UMAP', 'Y_UMAP']):
+	"""
+	Parameters
+	----------
+	clonotype_df : pd.DataFrame
+		VDJ rows of the traced clonotypes
+	clinical_df : pd.DataFrame
+		Clinical rows of the same cells, same order
+
+	Returns
+	----------
+	pd.DataFrame
+		Columns: barcode, columns of clonotype_df, embedding_columns
+	"""
+	scatter_df = clonotype_df.reset_index()
+	scatter_df = scatter_df.rename(columns={scatter_df.columns[0]: VDJ_10X_COLUMNS.BARCODE.value})
+	for col in embedding_columns:
+		scatter_df[col] = clinical_df[col].values
+	return scatter_df
+
+
+def plotly_clonotype_tracing_bar(tracing_df):
+	"""
+	Columns: 'Groups', 'Clonotypes', 'Ratio'
+	"""
+	return export.to_long(tracing_df, ['Groups', 'Clonotypes', 'Ratio'], dropna=True)
+
+
+def plotly_clonotype_tracing_embedding(
+		clonotype_umap_df,
+		key=VDJ_10X_COLUMNS.CDR3.value,
+		embedding_columns=['X_UMAP', 'Y_UMAP'],
+	):
+	return clonotype_umap_df[[key, VDJ_10X_COLUMNS.UMIS.value] + list(embedding_columns)]
+
+
+def visualize_clonotype_tracing_bar(tracing_df):
+	fig, ax = plt.subplots(1, facecolor='white')
+	tracing_df.plot(kind='bar', stacked=True, ax=ax)
+	plt.show()
+	return
+
+
+def visualize_clonotype_tracing_embedding(
+		clonotype_umap_df,
+		umap_df,
+		key=VDJ_10X_COLUMNS.CDR3.value,
+		embedding_columns=['X_UMAP', 'Y_UMAP'],
+	):
+	x_col, y_col = embedding_columns
+	fig, ax = plt.subplots(nrows=1, ncols=1)
+	ax.scatter(umap_df[x_col].values, umap_df[y_col].values, s=0.1, color='gray')
+
+	umis = clonotype_umap_df[VDJ_10X_COLUMNS.UMIS.value].values.astype(np.float64)
+	sizes = 30 + 270 * (umis - umis.min()) / max(np.ptp(umis), 1) if len(umis) else umis
+	for value in pd.unique(clonotype_umap_df[key].values):
+		chosen = clonotype_umap_df[key].values == value
+		ax.scatter(
+			clonotype_umap_df[x_col].values[chosen],
+			clonotype_umap_df[y_col].values[chosen],
+			s=sizes[chosen],
+			alpha=0.7,
+			label=value
+		)
+	ax.set_xlabel(x_col)
+	ax.set_ylabel(y_col)
+	ax.legend(loc='upper left', bbox_to_anchor=(1, 1))
+	plt.show()
+	return
@@ -0,0 +1,219 @@
+import os
+import gzip
+import uuid
+import argparse
+import numpy as np
+import pandas as pd
+
+from ..common.constants import VDJ_10X_COLUMNS
+
+
+# outputs of the Parse Biosciences TCR pipeline, one folder per sample
+TCR_ANNOTATION = 'tcr_annotation_airr.tsv'
+BARCODE_REPORT = 'barcode_report.tsv'
+CLONOTYPE_FREQUENCY = 'clonotype_frequency.tsv'
+UNASSIGNED = 'Unassigned'
+# contigs parsed at once from tcr_annotation_airr.tsv
+CHUNKSIZE = 200000
+
+# 10X contig column <- AIRR column of tcr_annotation_airr.tsv
+AIRR_2_10X = {
+	VDJ_10X_COLUMNS.BARCODE.value: 'cell_barcode',
+	VDJ_10X_COLUMNS.CHAIN.value: 'locus',
+	VDJ_10X_COLUMNS.V_GENE.value: 'v_call',
+	VDJ_10X_COLUMNS.D_GENE.value: 'd_call',
+	VDJ_10X_COLUMNS.J_GENE.value: 'j_call',
+	VDJ_10X_COLUMNS.C_GENE.value: 'c_call',
+	VDJ_10X_COLUMNS.PRODUCTIVE.value: 'productive',
+	'cdr1_nt': 'cdr1',
+	'cdr2_nt': 'cdr2',
+	VDJ_10X_COLUMNS.CDR3.value: 'cdr3_aa',
+	'cdr3_nt': 'cdr3',
+	'reads': 'read_count',
+	VDJ_10X_COLUMNS.UMIS.value: 'transcript_count',
+}
+AIRR_NUMERIC_COLUMNS = ('read_count', 'transcript_count')
+# 10X count columns, parsed as float (missing values) then saved as int64
+COUNT_COLUMNS = ('reads', VDJ_10X_COLUMNS.UMIS.value)
+
+# 10X columns not reported by Parse
+CONSTANT_COLUMNS = {
+	VDJ_10X_COLUMNS.IS_CELL.value: True,
+	VDJ_10X_COLUMNS.HIGH_CONFIDENCE.value: True,
+	VDJ_10X_COLUMNS.LENGTH.value: 0,
+	VDJ_10X_COLUMNS.FULL_LENGTH.value: True,
+	VDJ_10X_COLUMNS.RAW_CONSENSUS_ID.value: UNASSIGNED,
+	VDJ_10X_COLUMNS.EXACT_SUBCLONOTYPE_ID.value: UNASSIGNED,
+}
+for _i in ('fwr1', 'fwr1_nt', 'cdr1', 'fwr2', 'fwr2_nt', 'cdr2', 'fwr3', 'fwr3_nt', 'fwr4', 'fwr4_nt'):
+	CONSTANT_COLUMNS[_i] = UNASSIGNED
+
+# column order of 10X filtered_contig_annotations.csv
+OUTPUT_COLUMNS = [
+	'barcode', 'is_cell', 'contig_id', 'high_confidence', 'length', 'chain',
+	'v_gene', 'd_gene', 'j_gene', 'c_gene', 'full_length', 'productive',
+	'fwr1', 'fwr1_nt', 'cdr1', 'cdr1_nt', 'fwr2', 'fwr2_nt', 'cdr2', 'cdr2_nt',
+	'fwr3', 'fwr3_nt', 'cdr3', 'cdr3_nt', 'fwr4', 'fwr4_nt', 'reads', 'umis',
+	'raw_clonotype_id', 'raw_consensus_id', 'exact_subclonotype_id',
+]
+
+
+def parsebio_paths(parse_dir):
+	"""
+	Returns
+	----------
+	Dict: TCR_ANNOTATION, BARCODE_REPORT, CLONOTYPE_FREQUENCY -> path in parse_dir
+	"""
+	paths = {i: os.path.join(parse_dir, i) for i in (TCR_ANNOTATION, BARCODE_REPORT, CLONOTYPE_FREQUENCY)}
+	missing_files = [k for k, v in paths.items() if not os.path.isfile(v)]
+	if len(missing_files):
+		raise Exception('cannot find {} in {}'.format(missing_files, parse_dir))
+	return paths
+
+
+def barcode_clonotypes(barcode_report_path, clonotype_frequency_path):
+	"""
+	Clonotype of every barcode: its (TRA, TRB) cdr3 pair joined on clonotype_frequency.tsv,
+	cells without a clonotype -> UNASSIGNED
+
+	Returns
+	----------
+	pd.Series
+		Index: barcodes, values: clonotype_id
+	"""
+	barcodes_df = pd.read_csv(
+		barcode_report_path, sep='\t', dtype=str,
+		usecols=['Barcode', 'TRA_cdr3_aa', 'TRB_cdr3_aa']
+	).drop_duplicates('Barcode', keep='last')
+	clonotypes_df = pd.read_csv(
+		clonotype_frequency_path, sep='\t', dtype=str,
+		usecols=['TRA', 'TRB', 'clonotype_id']
+	).drop_duplicates(['TRA', 'TRB'], keep='last')
+
+	# missing TRA / TRB cdr3 match missing values: beta-only and alpha-only clonotypes are kept
+	merged_df = barcodes_df.merge(
+		clonotypes_df, how='left',
+		left_on=['TRA_cdr3_aa', 'TRB_cdr3_aa'],
+		right_on=['TRA', 'TRB']
+	)
+	return pd.Series(
+		merged_df['clonotype_id'].fillna(UNASSIGNED).values,
+		index=merged_df['Barcode'].values
+	)
+
+
+def _iter_annotation(tcr_annotation_path, chunksize):
+	header = pd.read_csv(tcr_annotation_path, sep='\t', nrows=0).columns
+	missing_columns = [i for i in AIRR_2_10X.values() if i not in header]
+	if len(missing_columns):
+		raise Exception('cannot find columns {} in {}'.format(missing_columns, tcr_annotation_path))
+
+	return pd.read_csv(
+		tcr_annotation_path, sep='\t',
+		usecols=list(AIRR_2_10X.values()),
+		dtype={i: (np.float64 if i in AIRR_NUMERIC_COLUMNS else str) for i in AIRR_2_10X.values()},
+		chunksize=chunksize
+	)
+
+
+def iter_10X_chunks(parse_dir, chunksize=CHUNKSIZE):
+	"""
+	Stream tcr_annotation_airr.tsv of a Parse output folder as 10X contig annotations\n
+	contig_id: <barcode>_contig_<n>, n-th contig of the barcode in the file (the counters span chunks)
+
+	Parameters
+	----------
+	parse_dir : str
+		Folder with tcr_annotation_airr.tsv, barcode_report.tsv, clonotype_frequency.tsv
+	chunksize : int
+		Number of contigs per chunk
+
+	Returns
+	----------
+	Iterator[pd.DataFrame]
+		Columns: OUTPUT_COLUMNS
+	"""
+	paths = parsebio_paths(parse_dir)
+	barcode_2_clonotype = barcode_clonotypes(paths[BARCODE_REPORT], paths[CLONOTYPE_FREQUENCY])
+	# number of contigs already seen per barcode
+	n_seen = pd.Series(dtype=np.int64)
+
+	for chunk in _iter_annotation(paths[TCR_ANNOTATION], chunksize):
+		barcodes = chunk['cell_barcode'].values
+		codes, uniques = pd.factorize(barcodes)
+		contig_number = (
+			n_seen.reindex(uniques, fill_value=0).values[codes]
+			+ pd.Series(codes).groupby(codes).cumcount().values
+			+ 1
+		)
+		n_seen = n_seen.add(
+			pd.Series(np.bincount(codes, minlength=len(uniques)), index=uniques),
+			fill_value=0
+		).astype(np.int64)
+
+		out_df = pd.DataFrame({k: chunk[v].values for k, v in AIRR_2_10X.items()})
+		out_df[VDJ_10X_COLUMNS.PRODUCTIVE.value] = out_df[VDJ_10X_COLUMNS.PRODUCTIVE.value].values == 'T'
+		# integer counts, same as the 10X and AIRR readers, missing -> 0
+		for col in COUNT_COLUMNS:
+			out_df[col] = np.nan_to_num(out_df[col].values).astype(np.int64)
+		out_df['contig_id'] = pd.Series(barcodes, dtype='O') + '_contig_' + pd.Series(contig_number).astype(str)
+		out_df[VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value] = barcode_2_clonotype.reindex(barcodes).fillna(UNASSIGNED).values
+		for k, v in CONSTANT_COLUMNS.items():
+			out_df[k] = v
+		yield out_df[OUTPUT_COLUMNS]
+
+
+def read_vdj(parse_dir, columns, dtype={}, chunksize=CHUNKSIZE):
+	"""
+	Chosen 10X columns of a Parse output folder, same output as common.read_columns_csv on a 10X file\n
+	Only the chosen columns of every chunk are kept in memory
+
+	Parameters
+	----------
+	columns : List[str]
+		10X column names, see OUTPUT_COLUMNS
+	dtype : Dict
+		10X column name -> dtype
+	"""
+	# string columns are already parsed as str, astype(str) would turn missing values into 'nan'
+	dtype = {k: v for k, v in dtype.items() if k in columns and v is not str}
+	chunks = [
+		chunk[columns].astype(dtype)
+		for chunk in iter_10X_chunks(parse_dir, chunksize)
+	]
+	if not len(chunks):
+		return pd.DataFrame({i: [] for i in columns}).astype(dtype)
+	# categories differ between chunks -> concat gives object columns
+	return pd.concat(chunks, axis=0, ignore_index=True).astype(dtype)
+
+
+def convert_to_10X(parse_dir, output_csv_path, chunksize=CHUNKSIZE):
+	"""
+	Write a Parse output folder as a 10X filtered_contig_annotations csv (gzipped if output_csv_path ends with .gz),
+	chunk by chunk
+	"""
+	temp_path = '{}.TEMP{}'.format(output_csv_path, uuid.uuid4().hex)
+	open_func = gzip.open if str(output_csv_path).endswith('.gz') else open
+	try:
+		with open_func(temp_path, 'wt', encoding='utf-8', newline='') as f:
+			for i, chunk in enumerate(iter_10X_chunks(parse_dir, chunksize)):
+				chunk.to_csv(f, header=(i == 0), index=False)
+	except BaseException:
+		if os.path.isfile(temp_path):
+			os.remove(temp_path)
+		raise
+	os.replace(temp_path, output_csv_path)
+	return output_csv_path
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Convert Parse Biosciences TCR outputs to 10X contig annotations')
+	parser.add_argument('parse_dir', help='Folder with {}, {}, {}'.format(TCR_ANNOTATION, BARCODE_REPORT, CLONOTYPE_FREQUENCY))
+	parser.add_argument('output_csv_path', help='.csv or .csv.gz')
+	parser.add_argument('--chunksize', type=int, default=CHUNKSIZE)
+	args = parser.parse_args()
+	convert_to_10X(args.parse_dir, args.output_csv_path, args.chunksize)
+
+
+if __name__ == '__main__':
+	main()
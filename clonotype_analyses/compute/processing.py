@@ -1,9 +1,21 @@
+import re
 import h5py
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 
+from . import parsebio
 from .. import common
+from ..common import h5_store
+from ..common.constants import BARCODE_ENCODING
+from ..common.constants import BARCODE_KEY
+from ..common.constants import CDR3_LENGTH
+from ..common.constants import CELL_COLUMNS
+from ..common.constants import PAIRING_TYPES
+from ..common.constants import SAMPLE_NAME
 from ..common.constants import VDJ_10X_COLUMNS
+from ..common.constants import VDJ_10X_DTYPES
 
 
 def _preprocessing_clonotypes(df):
@@ -15,17 +27,171 @@ def _preprocessing_clonotypes(df):
 	return df
 
 
-def reformat_clonotypes(vdj_path, preprocessing=True):
-	chosen_columns = [i.value for i in VDJ_10X_COLUMNS]
+# AIRR rearrangement.tsv (MiXCR, TRUST4, Cell Ranger airr_rearrangement.tsv, ...)
+# -> 10X column <- first AIRR column found, see read_airr
+AIRR_2_10X = {
+	VDJ_10X_COLUMNS.BARCODE.value: ('cell_id',),
+	VDJ_10X_COLUMNS.CHAIN.value: ('locus',),
+	VDJ_10X_COLUMNS.V_GENE.value: ('v_call',),
+	VDJ_10X_COLUMNS.D_GENE.value: ('d_call',),
+	VDJ_10X_COLUMNS.J_GENE.value: ('j_call',),
+	VDJ_10X_COLUMNS.C_GENE.value: ('c_call',),
+	VDJ_10X_COLUMNS.FULL_LENGTH.value: ('complete_vdj',),
+	VDJ_10X_COLUMNS.PRODUCTIVE.value: ('productive',),
+	VDJ_10X_COLUMNS.CDR3.value: ('junction_aa',),
+	VDJ_10X_COLUMNS.UMIS.value: ('umi_count', 'duplicate_count'),
+	VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value: ('clone_id',),
+}
+AIRR_REQUIRED_COLUMNS = ('cell_id', 'locus', 'v_call', 'j_call', 'junction_aa')
+AIRR_NUMERIC_COLUMNS = ('umi_count', 'duplicate_count')
+AIRR_BOOLEAN_COLUMNS = (VDJ_10X_COLUMNS.FULL_LENGTH.value, VDJ_10X_COLUMNS.PRODUCTIVE.value)
+# 10X columns not reported by AIRR (or missing optional AIRR columns)
+AIRR_DEFAULTS = {
+	VDJ_10X_COLUMNS.IS_CELL.value: True,
+	VDJ_10X_COLUMNS.HIGH_CONFIDENCE.value: True,
+	VDJ_10X_COLUMNS.LENGTH.value: 0,
+	VDJ_10X_COLUMNS.FULL_LENGTH.value: True,
+	VDJ_10X_COLUMNS.PRODUCTIVE.value: True,
+	VDJ_10X_COLUMNS.UMIS.value: 1,
+	VDJ_10X_COLUMNS.RAW_CONSENSUS_ID.value: 'Unassigned',
+	VDJ_10X_COLUMNS.EXACT_SUBCLONOTYPE_ID.value: 'Unassigned',
+}
+# contigs parsed at once from AIRR files
+AIRR_CHUNKSIZE = 200000
+
+
+def _read_10X(vdj_path, columns, dtype={}):
+	return common.read_columns_csv(vdj_path, columns, dtype=dtype)
+
+
+def _airr_bool(arr):
+	# AIRR booleans: T / F, TRUE / FALSE, True / False
+	return pd.Series(arr, dtype='O').str.upper().isin(['T', 'TRUE']).values
+
+
+def airr_clonotypes(barcodes, chains, cdr3):
+	"""
+	Clonotype of every contig when the AIRR file has no clone_id:
+	cells sharing the same set of (locus, junction_aa) share a clonotype, named clonotype<n> by order of appearance
+	"""
+	cell_idx, _ = pd.factorize(barcodes)
+	contig_key = pd.Series(chains, dtype='O').fillna('') + ':' + pd.Series(cdr3, dtype='O').fillna('')
+	order = np.lexsort((contig_key.values, cell_idx))
+	cell_key = contig_key.iloc[order].groupby(cell_idx[order], sort=True).agg(';'.join)
+	clonotype_idx, _ = pd.factorize(cell_key.values)
+	clonotype_names = np.char.add('clonotype', (clonotype_idx + 1).astype(str)).astype('O')
+	return clonotype_names[cell_idx]
+
+
+def read_airr(vdj_path, columns, dtype={}, chunksize=AIRR_CHUNKSIZE):
+	"""
+	Contigs of an AIRR rearrangement tsv (optionally gzipped) mapped on the 10X columns (see AIRR_2_10X), parsed in chunks\n
+	Only the AIRR columns of AIRR_2_10X are parsed, only the chosen columns of every chunk are kept in memory\n
+	umis: umi_count, else duplicate_count, else 1 per contig\n
+	raw_clonotype_id: clone_id, else from the (locus, junction_aa) of every cell (see airr_clonotypes)
+
+	Parameters
+	----------
+	columns : List[str]
+		10X column names
+	dtype : Dict
+		10X column name -> dtype
+	"""
+	header = common.read_header(vdj_path).split('\t')
+	missing_columns = [i for i in AIRR_REQUIRED_COLUMNS if i not in header]
+	if len(missing_columns):
+		raise Exception('cannot find columns {} in {}'.format(missing_columns, vdj_path))
+
+	airr_columns = {}
+	for k, v in AIRR_2_10X.items():
+		found = [i for i in v if i in header]
+		if len(found):
+			airr_columns[k] = found[0]
+	derive_clonotypes = (
+		VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value in columns
+		and VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value not in airr_columns
+	)
+	chunk_columns = list(columns)
+	if derive_clonotypes:
+		chunk_columns = [i for i in columns if i != VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value]
+		for i in (VDJ_10X_COLUMNS.BARCODE.value, VDJ_10X_COLUMNS.CHAIN.value, VDJ_10X_COLUMNS.CDR3.value):
+			if i not in chunk_columns:
+				chunk_columns.append(i)
+
+	# string columns are parsed as str, astype(str) would turn missing values into 'nan'
+	dtype = {k: v for k, v in dtype.items() if k in chunk_columns and v is not str}
+	reader = pd.read_csv(
+		vdj_path, sep='\t',
+		usecols=[airr_columns[i] for i in chunk_columns if i in airr_columns],
+		dtype={v: (np.float64 if v in AIRR_NUMERIC_COLUMNS else str) for v in airr_columns.values()},
+		chunksize=chunksize
+	)
+	chunks = []
+	for chunk in reader:
+		chunk_df = pd.DataFrame(index=pd.RangeIndex(len(chunk)))
+		for col in chunk_columns:
+			if col in airr_columns:
+				values = chunk[airr_columns[col]].values
+				if col in AIRR_BOOLEAN_COLUMNS:
+					values = _airr_bool(values)
+				elif col == VDJ_10X_COLUMNS.UMIS.value:
+					values = np.nan_to_num(values.astype(np.float64)).astype(np.int64)
+				chunk_df[col] = values
+			elif col in AIRR_DEFAULTS:
+				chunk_df[col] = AIRR_DEFAULTS[col]
+			else:
+				raise Exception('cannot map column {} from {}'.format(col, vdj_path))
+		chunks.append(chunk_df.astype(dtype))
+
+	if not len(chunks):
+		vdj_df = pd.DataFrame({i: [] for i in chunk_columns})
+	else:
+		# categories differ between chunks -> concat gives object columns
+		vdj_df = pd.concat(chunks, axis=0, ignore_index=True)
+
+	if derive_clonotypes:
+		vdj_df[VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value] = airr_clonotypes(
+			vdj_df[VDJ_10X_COLUMNS.BARCODE.value].values,
+			vdj_df[VDJ_10X_COLUMNS.CHAIN.value].values,
+			vdj_df[VDJ_10X_COLUMNS.CDR3.value].values,
+		)
+	return vdj_df[columns].astype(dtype)
+
+
+# vdj_format of batch_info -> reader(vdj_path, columns, dtype): dataframe with the chosen 10X columns (lower-case)
+VDJ_READERS = {
+	'10X': _read_10X,
+	'parsebio': parsebio.read_vdj,
+	'airr': read_airr,
+}
 
-	vdj_df = common.read_csv(vdj_path)
-	vdj_df.columns = [i.lower() for i in vdj_df.columns]
 
-	try:
-		vdj_df = vdj_df[chosen_columns]
-	except Exception as e:
-		raise (e)
+def register_vdj_reader(vdj_format, reader):
+	"""
+	Add a VDJ input format, usable as 'vdj_format' in batch_info\n
+	reader(vdj_path, columns, dtype={}) -> pd.DataFrame of the chosen 10X columns (see read_airr)\n
+	Register it at import time of a module: worker processes of iter_samples must see it too
+	"""
+	VDJ_READERS[vdj_format] = reader
 
+
+def reformat_clonotypes(vdj_path, preprocessing=True, vdj_format='10X'):
+	"""
+	Parameters
+	----------
+	vdj_format : str
+		Key of VDJ_READERS:\n
+		'10X': vdj_path is a contig annotations csv\n
+		'parsebio': vdj_path is a Parse Biosciences output folder, converted while streaming (see parsebio.read_vdj)\n
+		'airr': vdj_path is an AIRR rearrangement tsv (see read_airr)
+	"""
+	chosen_columns = [i.value for i in VDJ_10X_COLUMNS]
+
+	if vdj_format not in VDJ_READERS:
+		raise Exception('unknown vdj_format {}, expected one of {}'.format(vdj_format, list(VDJ_READERS)))
+	vdj_df = VDJ_READERS[vdj_format](
+		vdj_path, chosen_columns, dtype=VDJ_10X_DTYPES
+	)
 	vdj_df = vdj_df.set_index(VDJ_10X_COLUMNS.BARCODE.value)
 
 	if preprocessing:
@@ -34,61 +200,285 @@ def reformat_clonotypes(vdj_path, preprocessing=True):
 	return vdj_df
 
 
-def matching_barcodes(vdj_df, meta_df):
-	print ('WARNING: only keep intersect barcodes')
-	bc_idx = common.matching_barcodes_idx(
+def load_sample(info, sample_specific_columns, preprocessing=True):
+	"""
+	Read VDJ and clinical metadata of one batch_info entry,
+	barcodes and sample specific columns are prefixed by sample_name
+	"""
+	prefix = info.get(SAMPLE_NAME, '')
+	vdj_df = reformat_clonotypes(
+		info['vdj_path'], preprocessing, info.get('vdj_format', '10X')
+	)
+	clinical_df = common.read_csv(
+		info['clinical_meta_path'], index_col=0
+	)
+
+	if len(prefix):
+		for col in sample_specific_columns:
+			vdj_df[col] = prefix + '_' + vdj_df[col].values
+		vdj_df.index = prefix + '_' + vdj_df.index.values
+		vdj_df[SAMPLE_NAME] = prefix
+
+		clinical_df.index = prefix + '_' + clinical_df.index.values
+		clinical_df[SAMPLE_NAME] = prefix
+	return prefix, vdj_df, clinical_df
+
+
+def cdr3_lengths(cdr3_arr):
+	"""
+	uint8 length of every CDR3, 0 for missing values\n
+	Only unique sequences are measured
+	"""
+	cdr3_idx, uniques = pd.factorize(cdr3_arr)
+	uniques_length = np.minimum(
+		pd.Index(uniques, dtype='O').str.len().values, np.iinfo(np.uint8).max
+	)
+	# missing -> code -1 -> last item
+	return np.append(uniques_length, 0).astype(np.uint8)[cdr3_idx]
+
+
+def group_contigs_by_cell(vdj_df):
+	"""
+	Contigs of every cell in consecutive rows, cells and contigs keep their order of appearance\n
+	10X contig annotations are already grouped by barcode -> returned as is
+	"""
+	cell_idx, _ = pd.factorize(vdj_df.index.values)
+	if np.all(cell_idx[1:] >= cell_idx[:-1]):
+		return vdj_df
+	return vdj_df.iloc[np.argsort(cell_idx, kind='stable'), :]
+
+
+def first_row_of_cells(cell_idx):
+	"""
+	Row of the first contig of every cell, cells in order of appearance
+
+	Parameters
+	----------
+	cell_idx : np.ndarray[int]
+		Cell code of every contig, eg: from pd.factorize(vdj_df.index.values)
+	"""
+	return np.flatnonzero(~pd.Index(cell_idx).duplicated())
+
+
+def pairing_codes(n_TRA, n_TRB):
+	"""
+	Position in PAIRING_TYPES of every cell, from its number of TRA and TRB contigs
+	"""
+	n_types = len(PAIRING_TYPES) - 1
+	# lookup table over (n_TRA, n_TRB) in [0, 2] x [0, 2], anything else -> 'others'
+	lookup_table = np.full((3, 3), n_types, dtype=np.int64)
+	for i, k in enumerate(PAIRING_TYPES[:n_types]):
+		tmp_TRA, tmp_TRB = re.match(r'(\d+) TRA - (\d+) TRB', k).groups()
+		lookup_table[int(tmp_TRA), int(tmp_TRB)] = i
+
+	codes = np.full(len(n_TRA), n_types, dtype=np.int64)
+	in_table = (n_TRA <= 2) & (n_TRB <= 2)
+	codes[in_table] = lookup_table[n_TRA[in_table], n_TRB[in_table]]
+	return codes
+
+
+def _primary_of_chain(cell_idx, chains, umis, values, n_cells, chain_name):
+	"""
+	Value of the contig of chain_name having the most UMIs in every cell (first one on ties), missing: no such contig
+	"""
+	rows = np.flatnonzero(chains == chain_name)
+	rows = rows[np.lexsort((rows, -umis[rows], cell_idx[rows]))]
+	first = rows[np.flatnonzero(np.diff(cell_idx[rows], prepend=-1))]
+	codes, uniques = pd.factorize(values[first])
+	all_codes = np.full(n_cells, -1, dtype=np.int64)
+	all_codes[cell_idx[first]] = codes
+	return pd.Categorical.from_codes(all_codes, categories=pd.Index(uniques, dtype='O'))
+
+
+def summarize_cells(vdj_df, contig_offset=0):
+	"""
+	One row per cell: number of contigs per chain, pairing type, clonotype, primary TRA / TRB cdr3, UMI summaries\n
+	Contigs of every cell must be in consecutive rows (see group_contigs_by_cell)
+
+	Parameters
+	----------
+	vdj_df : pd.DataFrame
+		Contigs, index: barcodes
+	contig_offset : int
+		Row of the first contig of vdj_df in the contig table
+
+	Returns
+	----------
+	pd.DataFrame
+		Index: barcodes, in order of appearance\n
+		Columns: CELL_COLUMNS, raw_clonotype_id (of the first contig), BARCODE_KEY if vdj_df has it
+	"""
+	cell_idx, all_cells = pd.factorize(vdj_df.index.values)
+	n_cells = len(all_cells)
+	if np.any(cell_idx[1:] < cell_idx[:-1]):
+		raise Exception('contigs of a cell must be in consecutive rows')
+
+	n_contigs = np.bincount(cell_idx, minlength=n_cells)
+	starts = np.cumsum(n_contigs) - n_contigs
+	chains = np.asarray(vdj_df[VDJ_10X_COLUMNS.CHAIN.value].values, dtype='O')
+	umis = vdj_df[VDJ_10X_COLUMNS.UMIS.value].values.astype(np.int64)
+	cdr3 = np.asarray(vdj_df[VDJ_10X_COLUMNS.CDR3.value].values, dtype='O')
+
+	cells_dct = {}
+	for col, chain_name in [
+			(CELL_COLUMNS.N_TRA, 'TRA'),
+			(CELL_COLUMNS.N_TRB, 'TRB'),
+			(CELL_COLUMNS.N_TRG, 'TRG'),
+			(CELL_COLUMNS.N_TRD, 'TRD'),
+		]:
+		cells_dct[col.value] = np.bincount(
+			cell_idx[chains == chain_name], minlength=n_cells
+		).astype(np.uint16)
+	cells_dct[CELL_COLUMNS.PAIRING.value] = pd.Categorical.from_codes(
+		pairing_codes(cells_dct[CELL_COLUMNS.N_TRA.value], cells_dct[CELL_COLUMNS.N_TRB.value]),
+		categories=list(PAIRING_TYPES)
+	)
+	cells_dct[VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value] = vdj_df[VDJ_10X_COLUMNS.RAW_CLONOTYPE_ID.value].values[starts]
+	cells_dct[CELL_COLUMNS.CDR3_TRA.value] = _primary_of_chain(cell_idx, chains, umis, cdr3, n_cells, 'TRA')
+	cells_dct[CELL_COLUMNS.CDR3_TRB.value] = _primary_of_chain(cell_idx, chains, umis, cdr3, n_cells, 'TRB')
+
+	if len(umis):
+		cells_dct[CELL_COLUMNS.UMIS_MIN.value] = np.minimum.reduceat(umis, starts)
+		cells_dct[CELL_COLUMNS.UMIS_MAX.value] = np.maximum.reduceat(umis, starts)
+		cells_dct[CELL_COLUMNS.UMIS_SUM.value] = np.add.reduceat(umis, starts)
+	else:
+		for col in (CELL_COLUMNS.UMIS_MIN, CELL_COLUMNS.UMIS_MAX, CELL_COLUMNS.UMIS_SUM):
+			cells_dct[col.value] = np.zeros(0, dtype=np.int64)
+	cells_dct[CELL_COLUMNS.CONTIG_START.value] = contig_offset + starts.astype(np.int64)
+	cells_dct[CELL_COLUMNS.N_CONTIGS.value] = n_contigs.astype(np.uint16)
+	if BARCODE_KEY in vdj_df.columns:
+		cells_dct[BARCODE_KEY] = vdj_df[BARCODE_KEY].values[starts]
+	return pd.DataFrame(cells_dct, index=pd.Index(all_cells, name=vdj_df.index.name))
+
+
+def is_cells_table(df):
+	"""
+	True for a cells table (one row per cell, see summarize_cells), False for contigs
+	"""
+	return CELL_COLUMNS.N_CONTIGS.value in df.columns
+
+
+def _load_and_match_sample(info, sample_idx, sample_specific_columns, preprocessing, intersect_barcodes):
+	prefix, vdj_df, clinical_df = load_sample(
+		info, sample_specific_columns, preprocessing
+	)
+	(vdj_df[BARCODE_KEY], clinical_df[BARCODE_KEY]), encoding = common.pack_barcodes(
 		vdj_df.index.values,
-		meta_df.index.values
+		clinical_df.index.values,
+		prefix_code=sample_idx,
+		return_encoding=True
+	)
+	if encoding == BARCODE_ENCODING.HASHED.value:
+		print ('NOTE: barcodes of {} are not 10X-like, {} saved as 64-bit hashes'.format(prefix, BARCODE_KEY))
+	vdj_df[CDR3_LENGTH] = cdr3_lengths(vdj_df[VDJ_10X_COLUMNS.CDR3.value].values)
+	vdj_df = group_contigs_by_cell(vdj_df)
+	if intersect_barcodes:
+		vdj_df, clinical_df = matching_barcodes(vdj_df, clinical_df)
+	return prefix, vdj_df, clinical_df
+
+
+def iter_samples(
+		batch_info,
+		sample_specific_columns,
+		preprocessing=True,
+		intersect_barcodes=False,
+		n_workers=1,
+		first_sample_idx=0,
+	):
+	"""
+	Yield (sample_name, vdj_df, clinical_df) in the order of batch_info\n
+	BARCODE_KEY column: packed (or hashed) barcodes, the sample ordinal (from first_sample_idx) is used as prefix code\n
+	CDR3_LENGTH column: length of cdr3 in VDJ rows\n
+	Contigs of every cell are in consecutive rows\n
+	With n_workers > 1, samples are parsed in a process pool,
+	at most 2 * n_workers parsed samples are waiting to be consumed
+	"""
+	args = (sample_specific_columns, preprocessing, intersect_barcodes)
+	if n_workers is None or n_workers <= 1:
+		for sample_idx, info in enumerate(batch_info, first_sample_idx):
+			yield _load_and_match_sample(info, sample_idx, *args)
+		return
+
+	with ProcessPoolExecutor(max_workers=n_workers) as executor:
+		pending = deque()
+		for sample_idx, info in enumerate(batch_info, first_sample_idx):
+			pending.append(executor.submit(_load_and_match_sample, info, sample_idx, *args))
+			if len(pending) >= 2 * n_workers:
+				yield pending.popleft().result()
+		while pending:
+			yield pending.popleft().result()
+
+
+def _barcode_keys(vdj_df, meta_df):
+	if BARCODE_KEY in vdj_df.columns and BARCODE_KEY in meta_df.columns:
+		return vdj_df[BARCODE_KEY].values, meta_df[BARCODE_KEY].values
+	return vdj_df.index.values, meta_df.index.values
+
+
+def matching_barcodes(vdj_df, meta_df, return_indexer=False):
+	"""
+	Only keep intersect barcodes
+
+	Returns
+	----------
+	vdj_df, meta_df, (clinical_idx if return_indexer)\n
+	clinical_idx: for each row of the returned vdj_df, position of its barcode in the returned meta_df
+	"""
+	print ('WARNING: only keep intersect barcodes')
+	bc_idx, meta_idx = common.barcodes_indexer(
+		*_barcode_keys(vdj_df, meta_df)
+	)
+	matched_meta_idx, clinical_idx = np.unique(
+		meta_idx[bc_idx], return_inverse=True
 	)
-	matched_bc = np.unique(vdj_df.index.values[bc_idx])
 	vdj_df = vdj_df.iloc[
 		bc_idx,
 		:
 	]
-	meta_df = meta_df.loc[
-		matched_bc,
+	meta_df = meta_df.iloc[
+		matched_meta_idx,
 		:
 	]
+	if return_indexer:
+		return vdj_df, meta_df, clinical_idx
 	return vdj_df, meta_df
 
 
-def store_df_as_h5(df, output_h5_path):
+def store_df_as_h5(df, output_h5_path, compression='gzip'):
 	with common.H5AtomicWriter(output_h5_path) as f:
-		f.create_dataset(VDJ_10X_COLUMNS.BARCODE.value, data=df.index.values.astype('S'))
-		for i in df.columns:
-			try:
-				f.create_dataset(i, data=df[i].values)
-			except:
-				f.create_dataset(i, data=df[i].values.astype('S'))
+		h5_store.write_df(
+			f, df,
+			index_name=VDJ_10X_COLUMNS.BARCODE.value,
+			compression=compression
+		)
 	return output_h5_path
 
 
-def h5_to_pandas(h5_path, columns):
-	meta_dct = {}
-	with h5py.File(h5_path) as f:
-		bc = f[VDJ_10X_COLUMNS.BARCODE.value][:].astype('str')
-		for i in columns:
-			if i == VDJ_10X_COLUMNS.BARCODE.value:
-				continue
-			arr = f[i][:]
-			try:
-				arr = arr.astype(np.float32)
-			except:
-				arr = arr.astype('str')
-			meta_dct[i] = arr
-	df = pd.DataFrame(meta_dct, index=bc)
-	return df
+def h5_to_pandas(h5_path, columns, samples=None, index=None):
+	"""
+	Read only the chosen columns (and rows of the chosen samples)\n
+	See h5_store.H5Dataset.read
+	"""
+	return h5_store.H5Dataset(h5_path, samples).read(columns, index=index)
 
 
-def merge_vdj_and_clinical_meta(vdj_df, clinical_df):
-	if not np.all(
-		np.unique(vdj_df.index.values) == np.unique(clinical_df.index.values)
-	):
-		raise Exception('Barcodes of 2 dataframes must matched')
+def merge_vdj_and_clinical_meta(vdj_df, clinical_df, clinical_idx=None):
+	"""
+	Add clinical columns to vdj_df\n
+	clinical_idx: indexer returned by matching_barcodes(..., return_indexer=True)
+	"""
+	if clinical_idx is None:
+		bc_idx, clinical_idx = common.barcodes_indexer(
+			*_barcode_keys(vdj_df, clinical_df)
+		)
+		if not np.all(bc_idx) or not np.all(
+			np.bincount(clinical_idx, minlength=len(clinical_df))
+		):
+			raise Exception('Barcodes of 2 dataframes must matched')
 
-	vdj_df[clinical_df.columns.values] = clinical_df.loc[
-		vdj_df.index.values,
-		clinical_df.columns.values
-	]
+	for col in clinical_df.columns:
+		if col == BARCODE_KEY:
+			continue
+		vdj_df[col] = clinical_df[col].values[clinical_idx]
 
-	return vdj_df
\ No newline at end of file
+	return vdj_df
@@ -0,0 +1,231 @@
+import json
+import argparse
+
+import dash
+import plotly.express as px
+from dash import dcc
+from dash import html
+from dash.dependencies import Input, Output, State
+
+from .analyses import ClonotypeToolkits
+from .common.jobs import JobQueue
+
+
+# live dashboard: every panel is computed by ClonotypeToolkits in a background JobQueue,
+# callbacks only submit jobs and poll them -> the Dash server threads are never busy computing
+POLL_INTERVAL_MS = 500
+LOWER_N = list(range(1, 11))
+TOP_K = [5, 10, 20, 50]
+CHAINS = ['TRA', 'TRB', 'TRG', 'TRD']
+
+
+def _qc_figure(toolkits, meta_keys):
+	plotly_df = toolkits.plotly_clonotypes_QC_fraction(meta_keys).reset_index()
+	return px.bar(
+		plotly_df, x='Groups', y='Ratio', color='Clonotypes types', barmode='stack',
+		title='Ratio of Single / Ambiguous Clonotypes', height=600,
+	)
+
+
+def _diversity_figure(toolkits, meta_keys):
+	plotly_df = toolkits.plotly_clonotypes_diversity(meta_keys, 'shannon')
+	fig = px.box(
+		plotly_df, x=meta_keys[0], y=plotly_df.columns[1], color=meta_keys[0],
+		title='Clonotypes Diversity Estimation', height=600,
+	)
+	fig.update_traces(boxpoints='all')
+	return fig
+
+
+def _expansion_figure(toolkits, meta_keys, lower_n):
+	plotly_df = toolkits.plotly_clonotypes_expansion(meta_keys, lower_n)
+	return px.bar(
+		plotly_df, x='Groups', y='Ratio', color='Clonotypes size', barmode='stack',
+		title='Clonal Expansion', height=600,
+	)
+
+
+def _cdr3_length_figure(toolkits, meta_keys, chain):
+	plotly_df = toolkits.plotly_cdr3_length(meta_keys, chain)
+	return px.line(
+		plotly_df, x='CDR3 length', y='Ratio', color=plotly_df.columns[0], markers=True,
+		title='CDR3 - {} Length'.format(chain), height=500,
+	)
+
+
+def _tracing_figure(toolkits, meta_keys, top_k):
+	plotly_df = toolkits.plotly_clonotype_tracing(meta_keys, n_cdr3=top_k)
+	return px.bar(
+		plotly_df, x='Groups', y='Ratio', color='Clonotypes', barmode='stack',
+		title='Clonal Tracing across Groups', height=600,
+	)
+
+
+# panel -> (figure builder, controls it depends on): changing another control never recomputes the panel
+PANELS = {
+	'qc-fraction': (_qc_figure, ['meta_keys']),
+	'diversity': (_diversity_figure, ['meta_keys']),
+	'expansion': (_expansion_figure, ['meta_keys', 'lower_n']),
+	'cdr3-length': (_cdr3_length_figure, ['meta_keys', 'chain']),
+	'tracing': (_tracing_figure, ['meta_keys', 'top_k']),
+}
+# tracing needs all samples at once: not available on a sharded store
+SHARDED_PANELS = ('qc-fraction', 'diversity', 'expansion', 'cdr3-length')
+
+
+def _build_figure(toolkits, panel, params):
+	func, controls = PANELS[panel]
+	return func(toolkits, *[params[i] for i in controls]).to_plotly_json()
+
+
+def job_key(panel, params):
+	"""
+	Same panel and same parameters -> same key, shared by every client
+	"""
+	_, controls = PANELS[panel]
+	return json.dumps([panel, {i: params[i] for i in controls}], sort_keys=True, default=str)
+
+
+def _dropdown(control_id, label, options, value, multi=False):
+	return html.Div([
+		html.Label(label),
+		dcc.Dropdown(
+			id=control_id, options=options, value=value, multi=multi, clearable=False
+		),
+	], style={'width': '22%', 'display': 'inline-block', 'padding': '0 1%'})
+
+
+def create_app(
+		vdj_h5_path,
+		clinical_h5_path=None,
+		samples=None,
+		n_jobs=2,
+		n_workers=1,
+		cache_dir=None,
+	):
+	"""
+	Dash app computing the analyses of ClonotypeToolkits for the chosen controls
+
+	Parameters
+	----------
+	vdj_h5_path, clinical_h5_path, samples, n_workers, cache_dir :
+		See ClonotypeToolkits
+	n_jobs : int
+		Number of background jobs running at once
+
+	Returns
+	----------
+	dash.Dash
+	"""
+	toolkits = ClonotypeToolkits(
+		vdj_h5_path, clinical_h5_path, samples, cache_dir=cache_dir, n_workers=n_workers
+	)
+	queue = JobQueue(n_jobs)
+	meta_columns = toolkits.meta_columns
+	shown_panels = [i for i in PANELS if not toolkits.is_sharded or i in SHARDED_PANELS]
+
+	app = dash.Dash(__name__)
+	app.config.suppress_callback_exceptions = True
+	controls = [
+		('meta_keys', Input('meta_keys', 'value')),
+		('chain', Input('chain', 'value')),
+		('lower_n', Input('lower_n', 'value')),
+		('top_k', Input('top_k', 'value')),
+	]
+
+	panels = []
+	for panel in shown_panels:
+		panels.append(html.Div([
+			dcc.Store(id='{}-job'.format(panel)),
+			dcc.Interval(id='{}-poll'.format(panel), interval=POLL_INTERVAL_MS, disabled=True),
+			html.Div(id='{}-status'.format(panel), style={'color': '#888888'}),
+			dcc.Graph(id='{}-graph'.format(panel)),
+		], style={'padding': '10px 0'}))
+
+	app.layout = html.Div(children=[
+		html.H1(
+			'TCR ANALYSIS',
+			style={'textAlign': 'center', 'color': '#503D36', 'font-size': 40}
+		),
+		html.Div([
+			_dropdown('meta_keys', 'Groups', meta_columns, meta_columns[:1], multi=True),
+			_dropdown('chain', 'Chain', CHAINS, 'TRB'),
+			_dropdown('lower_n', 'Clone size pooled above', LOWER_N, 5),
+			_dropdown('top_k', 'Top clonotypes', TOP_K, 5),
+		]),
+	] + panels)
+
+	for panel in shown_panels:
+		_register_panel(app, queue, toolkits, panel, controls)
+	return app
+
+
+def _register_panel(app, queue, toolkits, panel, controls):
+	@app.callback(
+		Output('{}-job'.format(panel), 'data'),
+		Output('{}-poll'.format(panel), 'disabled'),
+		Output('{}-status'.format(panel), 'children'),
+		[i for _, i in controls],
+		State('{}-job'.format(panel), 'data'),
+	)
+	def submit_job(*args):
+		params = dict(zip([k for k, _ in controls], args[:-1]))
+		previous_key = args[-1]
+		if not params['meta_keys']:
+			return None, True, 'Choose at least one group'
+
+		key = job_key(panel, params)
+		if key == previous_key:
+			return dash.no_update, dash.no_update, dash.no_update
+		if previous_key is not None:
+			# a job this client stopped waiting for is dropped if nobody else waits for it
+			queue.release(previous_key)
+		queue.submit(key, _build_figure, toolkits, panel, params)
+		return key, False, 'Computing...'
+
+
+	@app.callback(
+		Output('{}-graph'.format(panel), 'figure'),
+		Output('{}-poll'.format(panel), 'disabled', allow_duplicate=True),
+		Output('{}-status'.format(panel), 'children', allow_duplicate=True),
+		Input('{}-poll'.format(panel), 'n_intervals'),
+		State('{}-job'.format(panel), 'data'),
+		prevent_initial_call=True,
+	)
+	def poll_job(n_intervals, key):
+		if key is None:
+			return dash.no_update, True, dash.no_update
+		job = queue.get(key)
+		if job is None:
+			# evicted before this client polled: compute again
+			job = queue.submit(key, _build_figure, toolkits, panel, json.loads(key)[1])
+		status = job.status
+		if status in ('pending', 'running'):
+			return dash.no_update, False, dash.no_update
+		if status == 'error':
+			return dash.no_update, True, 'Error: {}'.format(job.error())
+		if status == 'cancelled':
+			return dash.no_update, True, dash.no_update
+		return job.result(), True, ''
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Live TCR dashboard backed by ClonotypeToolkits')
+	parser.add_argument('vdj_h5_path', help='VDJ h5 of ClonotypePreprocessing.ingest_data, or a shard folder')
+	parser.add_argument('clinical_h5_path', nargs='?', default=None)
+	parser.add_argument('--samples', nargs='*', default=None)
+	parser.add_argument('--n_jobs', type=int, default=2)
+	parser.add_argument('--n_workers', type=int, default=1)
+	parser.add_argument('--cache_dir', default=None)
+	parser.add_argument('--port', type=int, default=8050)
+	args = parser.parse_args()
+
+	app = create_app(
+		args.vdj_h5_path, args.clinical_h5_path, args.samples,
+		args.n_jobs, args.n_workers, args.cache_dir
+	)
+	app.run(port=args.port)
+
+
+if __name__ == '__main__':
+	main()
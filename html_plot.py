@@ -1,4 +1,5 @@
 import plotly.express as px
+import plotly.graph_objects as go
 from dash import html
 from dash import dcc
 import dash
@@ -6,88 +7,165 @@ import pandas as pd
 import numpy as np
 from dash.dependencies import Input, Output, State
 import datetime as dt
+import os
+from functools import lru_cache
+
+from clonotype_analyses.common import export
+from clonotype_analyses.compute import analytics
 
 
 DATA_DIR = 'GSE185381_TCR/clonotypes'
 PLOTLY_DATA_DIR = DATA_DIR + '/plotly_data'
 
+# UMAPs: WebGL markers, above UMAP_MAX_POINTS cells the overview shows a subsample proportional to the density
+# and zooming in re-renders the cells inside the visible window
+UMAP_MAX_POINTS = 50000
+# background of the tracing UMAP: cell density binned on the server
+UMAP_DENSITY_BINS = 200
+
+
+def load_plotly_data(name):
+    """
+    PLOTLY_DATA_DIR/<name>.arrow (see ClonotypeToolkits.export) memory-mapped if present, otherwise the TSV
+    """
+    artifact_path = '{}/{}.arrow'.format(PLOTLY_DATA_DIR, name)
+    if os.path.isfile(artifact_path):
+        plotly_df = export.read_artifact(artifact_path)[0]
+        # same columns as the TSV written with its index
+        return plotly_df.reset_index() if any(plotly_df.index.names) else plotly_df
+    return pd.read_csv('{}/{}.tsv'.format(PLOTLY_DATA_DIR, name), sep='\t')
+
+
 # fig1: umap, Author's cell types
 clinical_meta = pd.read_csv('GSE185381_TCR/clinical_metadata.tsv', sep='\t')
 
 # fig2: single, ambigous clonotypes proportion
-single_ambiguos_clonotypes_df = pd.read_csv(PLOTLY_DATA_DIR + '/fraction_clo_df.tsv', sep='\t')
+single_ambiguos_clonotypes_df = load_plotly_data('fraction_clo_df')
 
 # fig3: clonotypes diversity estimation: Shannon entropy
-shannon_df = pd.read_csv(PLOTLY_DATA_DIR + '/shannon_df.tsv', sep='\t')
+shannon_df = load_plotly_data('shannon_df')
 
 # fig4: clonotypes expansion:
-clonotypes_expansion_df = pd.read_csv(PLOTLY_DATA_DIR + '/clono_expansion_df.tsv', sep='\t')
+clonotypes_expansion_df = load_plotly_data('clono_expansion_df')
 
 # fig5: cdr3 alpha, beta length:
-cdr3_alpha_length_df = pd.read_csv(PLOTLY_DATA_DIR + '/cdr3alpha_length_df.tsv', sep='\t')
-cdr3_beta_length_df = pd.read_csv(PLOTLY_DATA_DIR + '/cdr3beta_length_df.tsv', sep='\t')
+cdr3_alpha_length_df = load_plotly_data('cdr3alpha_length_df')
+cdr3_beta_length_df = load_plotly_data('cdr3beta_length_df')
 
 # # fig6: clonotypes tracing
-clonotype_tracing_bar_df = pd.read_csv(PLOTLY_DATA_DIR + '/clono_tracing_bar_df.tsv', sep='\t')
-clonotype_tracing_scatter_df = pd.read_csv(PLOTLY_DATA_DIR + '/clono_tracing_scatter_df.tsv', sep='\t')
+clonotype_tracing_bar_df = load_plotly_data('clono_tracing_bar_df')
+clonotype_tracing_scatter_df = load_plotly_data('clono_tracing_scatter_df')
 
 
 app = dash.Dash(__name__)
 app.config.suppress_callback_exceptions = True
 
-fig1_1 = px.scatter(
-    clinical_meta,
-    x='X_UMAP',
-    y='Y_UMAP',
-    title='UMAP 1',
-    color="Author's cell type",
-    labels={'color': "Author's cell type"},
-    height=500,
-    width=900,
-)
-fig1_1.update_traces(marker={'size': 3})
-fig1_1.update_layout(margin_t=50, margin_r=300)
+umap_x = clinical_meta['X_UMAP'].values
+umap_y = clinical_meta['Y_UMAP'].values
+# one subsample shared by every UMAP
+umap_overview = analytics.downsample_embedding(umap_x, umap_y, UMAP_MAX_POINTS)
 
-fig1_2 = px.scatter(
-    clinical_meta,
-    x='X_UMAP',
-    y='Y_UMAP',
-    title='UMAP 2',
-    color="simplified_celltype",
-    labels={'color': "simplified_celltype"},
-    category_orders={"simplified_celltype": ['naive / central memory T cells', 'transitional T cells', 'terminal effector T cells']},
-    height=500,
-    width=900,
-)
-fig1_2.update_traces(marker={'size': 3})
-fig1_2.update_layout(margin_t=50, margin_r=300)
+UMAPS = {
+    'umap-1': {
+        'title': 'UMAP 1',
+        'color': "Author's cell type",
+    },
+    'umap-2': {
+        'title': 'UMAP 2',
+        'color': "simplified_celltype",
+        'category_orders': {"simplified_celltype": ['naive / central memory T cells', 'transitional T cells', 'terminal effector T cells']},
+    },
+    'umap-3': {
+        'title': 'UMAP 3',
+        'color': "Condition",
+    },
+    'umap-4': {
+        'title': 'UMAP 4',
+        'color': "Subject ID",
+        'category_orders': {"Subject ID": sorted(clinical_meta['Subject ID'].unique())[::-1]},
+    },
+}
 
-fig1_3 = px.scatter(
-    clinical_meta,
-    x='X_UMAP',
-    y='Y_UMAP',
-    title='UMAP 3',
-    color="Condition",
-    labels={'color': "Condition"},
-    height=500,
-    width=900,
-)
-fig1_3.update_traces(marker={'size': 3})
-fig1_3.update_layout(margin_t=50, margin_r=300)
 
-fig1_4 = px.scatter(
-    clinical_meta,
-    x='X_UMAP',
-    y='Y_UMAP',
-    title='UMAP 4',
-    color="Subject ID",
-    labels={'color': "Subject ID"},
-    height=500,
-    width=900,
-    category_orders={"Subject ID": sorted(clinical_meta['Subject ID'].unique())[::-1]}
-)
-fig1_4.update_traces(marker={'size': 3})
-fig1_4.update_layout(margin_t=50, margin_r=300)
+def window_positions(x_range, y_range):
+    """
+    Cells inside the visible window, subsampled the same way as the overview
+    """
+    x_min, x_max = sorted(x_range)
+    y_min, y_max = sorted(y_range)
+    positions = np.flatnonzero(
+        (umap_x >= x_min) & (umap_x <= x_max) & (umap_y >= y_min) & (umap_y <= y_max)
+    )
+    return positions[analytics.downsample_embedding(umap_x[positions], umap_y[positions], UMAP_MAX_POINTS)]
+
+
+@lru_cache(maxsize=32)
+def umap_figure(umap_id, x_range=None, y_range=None):
+    """
+    Built once per (UMAP, window), the overview figure is shared by every graph showing it
+    """
+    umap = UMAPS[umap_id]
+    if x_range is None:
+        positions = umap_overview
+    else:
+        positions = window_positions(x_range, y_range)
+
+    fig = px.scatter(
+        clinical_meta.iloc[positions],
+        x='X_UMAP',
+        y='Y_UMAP',
+        title=umap['title'],
+        color=umap['color'],
+        labels={'color': umap['color']},
+        category_orders=umap.get('category_orders', {}),
+        height=500,
+        width=900,
+        render_mode='webgl',
+    )
+    fig.update_traces(marker={'size': 3})
+    fig.update_layout(margin_t=50, margin_r=300, uirevision=umap_id)
+    if len(positions) < len(clinical_meta):
+        fig.update_layout(title='{} ({} / {} cells shown)'.format(umap['title'], len(positions), len(clinical_meta)))
+    if x_range is not None:
+        fig.update_layout(xaxis_range=list(x_range), yaxis_range=list(y_range))
+    return fig
+
+
+def zoomed_ranges(relayout_data):
+    """
+    (x_range, y_range) of a zoom, None on reset, dash.no_update for other relayouts (legend, drag mode, ...)
+    """
+    if relayout_data is None:
+        return dash.no_update
+    if relayout_data.get('xaxis.autorange'):
+        return None
+    keys = ['xaxis.range[0]', 'xaxis.range[1]', 'yaxis.range[0]', 'yaxis.range[1]']
+    if not all(k in relayout_data for k in keys):
+        return dash.no_update
+    return (
+        (relayout_data[keys[0]], relayout_data[keys[1]]),
+        (relayout_data[keys[2]], relayout_data[keys[3]]),
+    )
+
+
+def umap_density_layer(bins=UMAP_DENSITY_BINS):
+    """
+    Gray log-density of all cells, one value per grid bin instead of one marker per cell
+    """
+    chosen = np.isfinite(umap_x) & np.isfinite(umap_y)
+    x_idx, x_edges = analytics.quantize(umap_x[chosen], bins)
+    y_idx, y_edges = analytics.quantize(umap_y[chosen], bins)
+    density = np.bincount(y_idx * bins + x_idx, minlength=bins * bins).reshape(bins, bins).astype(np.float64)
+    density[density == 0] = np.nan
+    return go.Heatmap(
+        x=(x_edges[:-1] + x_edges[1:]) / 2,
+        y=(y_edges[:-1] + y_edges[1:]) / 2,
+        z=np.log1p(density),
+        colorscale=[[0, 'rgb(235, 235, 235)'], [1, 'rgb(150, 150, 150)']],
+        showscale=False,
+        hoverinfo='skip',
+    )
+
 
 ###
 
@@ -205,19 +283,9 @@ fig6_3 = px.scatter(
     height=500,
     width=900,
     size='umis',
+    render_mode='webgl',
 )
-fig6_4 = px.scatter(
-    clinical_meta,
-    x='X_UMAP',
-    y='Y_UMAP',
-    title='UMAP',
-    color_discrete_sequence=['gray'],
-    height=500,
-    width=900,
-    opacity=0.01
-)
-fig6_4.update_traces(hoverinfo='skip', hovertemplate=None)
-fig6_3.add_trace(fig6_4.data[0])
+fig6_3.add_trace(umap_density_layer())
 fig6_3.update_layout(margin_t=50, margin_r=300)
 
 ###
@@ -229,12 +297,12 @@ app.layout = html.Div(
             style={'textAlign': 'center', 'color': '#503D36', 'font-size': 40}
         ),
         html.Div([
-            dcc.Graph(figure=fig1_1),
-            dcc.Graph(figure=fig1_2),
+            dcc.Graph(id='umap-1', figure=umap_figure('umap-1')),
+            dcc.Graph(id='umap-2', figure=umap_figure('umap-2')),
         ], style={'display': 'flex', 'justify-content': 'center'}),
         html.Div([
-            dcc.Graph(figure=fig1_3),
-            dcc.Graph(figure=fig1_4),
+            dcc.Graph(id='umap-3', figure=umap_figure('umap-3')),
+            dcc.Graph(id='umap-4', figure=umap_figure('umap-4')),
         ], style={'display': 'flex', 'justify-content': 'center'}),
         html.Div([
             dcc.Graph(figure=fig2)
@@ -253,12 +321,35 @@ app.layout = html.Div(
             dcc.Graph(figure=fig6_1)
         ], style={'display': 'flex', 'justify-content': 'center'}),
         html.Div([
-            dcc.Graph(figure=fig1_2),
+            dcc.Graph(id='umap-2-tracing', figure=umap_figure('umap-2')),
             dcc.Graph(figure=fig6_3),
         ], style={'display': 'flex', 'justify-content': 'center'}),
     ]
 )
 
 
+def register_umap_zoom(graph_id, umap_id):
+    @app.callback(
+        Output(graph_id, 'figure'),
+        Input(graph_id, 'relayoutData'),
+        prevent_initial_call=True,
+    )
+    def zoom_umap(relayout_data):
+        # every cell is already drawn
+        if len(umap_overview) == len(clinical_meta):
+            return dash.no_update
+        ranges = zoomed_ranges(relayout_data)
+        if ranges is dash.no_update:
+            return dash.no_update
+        if ranges is None:
+            return umap_figure(umap_id)
+        return umap_figure(umap_id, *ranges)
+
+
+for umap_id in UMAPS:
+    register_umap_zoom(umap_id, umap_id)
+register_umap_zoom('umap-2-tracing', 'umap-2')
+
+
 if __name__ == '__main__':
     app.run_server()
\ No newline at end of file
@@ -0,0 +1,107 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def write_10X_sample(folder, name, n_cells=40, seed=0, clinical_columns=None):
+	"""
+	Small 10X sample: <name>_vdj.csv (1 or 2 contigs per cell) and <name>_clinical.tsv
+
+	Parameters
+	----------
+	clinical_columns : Dict
+		column name -> values (one per cell), default: 'Condition'
+
+	Returns
+	----------
+	batch_info entry
+	"""
+	rng = np.random.default_rng(seed)
+	barcodes = np.unique([
+		''.join(rng.choice(list('ACGT'), 16)) + '-1' for _ in range(n_cells)
+	])[:n_cells]
+	rows = []
+	for i, bc in enumerate(barcodes):
+		clonotype = 'clonotype{}'.format(rng.integers(1, 8))
+		for chain in ['TRA', 'TRB'][:rng.integers(1, 3)]:
+			rows.append({
+				'barcode': bc, 'is_cell': True, 'contig_id': '{}_contig_{}'.format(bc, chain),
+				'high_confidence': True, 'length': 500, 'chain': chain,
+				'v_gene': chain + 'V1', 'd_gene': None, 'j_gene': chain + 'J1', 'c_gene': chain + 'C',
+				'full_length': True, 'productive': True,
+				'cdr3': 'CASS{}F'.format(rng.integers(0, 6)), 'reads': int(rng.integers(10, 900)),
+				'umis': int(rng.integers(1, 9)), 'raw_clonotype_id': clonotype,
+				'raw_consensus_id': clonotype + '_consensus_1', 'exact_subclonotype_id': 1,
+			})
+	vdj_path = os.path.join(folder, '{}_vdj.csv'.format(name))
+	pd.DataFrame(rows).to_csv(vdj_path, index=False)
+
+	if clinical_columns is None:
+		clinical_columns = {'Condition': rng.choice(['A', 'B'], len(barcodes))}
+	clinical_df = pd.DataFrame(clinical_columns, index=pd.Index(barcodes, name='barcode'))
+	clinical_path = os.path.join(folder, '{}_clinical.tsv'.format(name))
+	clinical_df.to_csv(clinical_path, sep='\t')
+	return {'sample_name': name, 'vdj_path': vdj_path, 'clinical_meta_path': clinical_path}
+
+
+@pytest.fixture
+def sample_factory(tmp_path):
+	def _factory(name, **kwargs):
+		return write_10X_sample(str(tmp_path), name, **kwargs)
+	return _factory
+
+
+def write_parse_sample(folder, name, n_cells=40, seed=0):
+	"""
+	Small Parse Biosciences output folder <name>/ and <name>_clinical.tsv
+
+	Returns
+	----------
+	batch_info entry, vdj_format 'parsebio'
+	"""
+	rng = np.random.default_rng(seed)
+	parse_dir = os.path.join(folder, name)
+	os.makedirs(parse_dir, exist_ok=True)
+	barcodes = ['{:02d}_{:02d}_{:02d}__s1'.format(*rng.integers(0, 96, 3)) for _ in range(n_cells)]
+	barcodes = list(dict.fromkeys(barcodes))
+	cdr3 = ['CAV{}F'.format(i) for i in range(5)]
+
+	rows, report_rows = [], []
+	for bc in barcodes:
+		pair = {'TRA': rng.choice(cdr3), 'TRB': rng.choice(cdr3).replace('CAV', 'CASS')}
+		report_rows.append({'Barcode': bc, 'TRA_cdr3_aa': pair['TRA'], 'TRB_cdr3_aa': pair['TRB']})
+		for locus in ['TRA', 'TRB'][:rng.integers(1, 3)]:
+			rows.append({
+				'sequence_id': bc + '__' + locus, 'locus': locus, 'productive': 'T',
+				'v_call': locus + 'V1*01', 'd_call': None, 'j_call': locus + 'J1*01', 'c_call': locus + 'C*01',
+				'cdr1': 'AAA', 'cdr2': 'CCC', 'cdr3': 'TGT', 'cdr3_aa': pair[locus],
+				'read_count': float(rng.integers(1, 500)), 'transcript_count': float(rng.integers(1, 9)),
+				'cell_barcode': bc,
+			})
+	pd.DataFrame(rows).to_csv(os.path.join(parse_dir, 'tcr_annotation_airr.tsv'), sep='\t', index=False)
+	report_df = pd.DataFrame(report_rows)
+	report_df.to_csv(os.path.join(parse_dir, 'barcode_report.tsv'), sep='\t', index=False)
+	pairs_df = report_df[['TRA_cdr3_aa', 'TRB_cdr3_aa']].drop_duplicates()
+	pd.DataFrame({
+		'TRA': pairs_df['TRA_cdr3_aa'].values,
+		'TRB': pairs_df['TRB_cdr3_aa'].values,
+		'clonotype_id': ['clonotype_{}'.format(i + 1) for i in range(len(pairs_df))],
+	}).to_csv(os.path.join(parse_dir, 'clonotype_frequency.tsv'), sep='\t', index=False)
+
+	clinical_path = os.path.join(folder, '{}_clinical.tsv'.format(name))
+	pd.DataFrame(
+		{'Condition': rng.choice(['A', 'B'], len(barcodes))},
+		index=pd.Index(barcodes, name='barcode')
+	).to_csv(clinical_path, sep='\t')
+	return {'sample_name': name, 'vdj_format': 'parsebio', 'vdj_path': parse_dir, 'clinical_meta_path': clinical_path}
+
+
+@pytest.fixture
+def parse_factory(tmp_path):
+	def _factory(name, **kwargs):
+		return write_parse_sample(str(tmp_path), name, **kwargs)
+	return _factory
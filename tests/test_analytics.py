@@ -0,0 +1,35 @@
+import numpy as np
+
+from clonotype_analyses.compute import analytics
+
+
+def _clusters(seed=0):
+	rng = np.random.default_rng(seed)
+	# dense population (90%), rare population (10%), 1 outlier
+	x = np.concatenate([rng.normal(0, 1, 180000), rng.normal(10, 1, 20000), [50]])
+	y = np.concatenate([rng.normal(0, 1, 180000), rng.normal(10, 1, 20000), [50]])
+	return x, y
+
+
+def test_downsample_keeps_abundances():
+	x, y = _clusters()
+	kept = analytics.downsample_embedding(x, y, max_points=20000)
+	assert len(kept) <= 20000
+	assert np.all(np.diff(kept) > 0)
+	rare_fraction = np.mean(x[kept] > 5)
+	assert abs(rare_fraction - 0.1) < 0.02
+	assert len(x) - 1 in kept
+
+
+def test_downsample_keeps_every_bin():
+	x, y = _clusters()
+	kept = analytics.downsample_embedding(x, y, max_points=20000, n_bins=50)
+	all_bins = set(zip(*[analytics.quantize(i, 50)[0] for i in (x, y)]))
+	kept_bins = set(zip(*[analytics.quantize(i, 50)[0][kept] for i in (x, y)]))
+	assert all_bins == kept_bins
+
+
+def test_downsample_small_input_and_nan():
+	x = np.array([0.0, np.nan, 1.0])
+	y = np.array([0.0, 1.0, 1.0])
+	np.testing.assert_array_equal(analytics.downsample_embedding(x, y, max_points=10), [0, 2])
@@ -0,0 +1,183 @@
+import shutil
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+
+from clonotype_analyses.analyses import ClonotypePreprocessing
+from clonotype_analyses.common import h5_store
+from clonotype_analyses.common.constants import INDEXED_COLUMNS
+
+
+def _snapshot(path):
+	"""
+	Every column of the root table and of the cells table, sample offsets, inverted indexes
+	"""
+	out = {}
+	with h5py.File(path, 'r') as f:
+		groups = [None] + [i for i in (h5_store.CELLS_GROUP,) if i in f]
+		for col in INDEXED_COLUMNS:
+			index = h5_store.read_inverted_index(f, col)
+			if index is not None:
+				out[col] = (list(index.categories), index.indptr.tolist(), index.indices.tolist())
+		out['keys'] = sorted(f.keys()), sorted(f[h5_store.INDEX_GROUP].keys()) if h5_store.INDEX_GROUP in f else []
+	for group in groups:
+		dataset = h5_store.H5Dataset(path, group=group)
+		out[group] = (dataset.read(dataset.columns), dataset.sample_offsets)
+	return out
+
+
+def _assert_same(left, right):
+	assert left.keys() == right.keys()
+	for k in left:
+		if k in (None, h5_store.CELLS_GROUP):
+			pd.testing.assert_frame_equal(left[k][0], right[k][0])
+			assert left[k][1] == right[k][1]
+		else:
+			assert left[k] == right[k], k
+
+
+@pytest.fixture
+def cohort(tmp_path, sample_factory):
+	"""
+	2 ingested samples, 1 sample to append with new cdr3 values, a new clinical column and string Age
+	"""
+	first = [
+		sample_factory('s1', seed=1, clinical_columns={'Age': np.arange(40)}),
+		sample_factory('s2', seed=2, clinical_columns={'Age': np.arange(40)}),
+	]
+	new = sample_factory('s3', seed=3, clinical_columns={'Age': ['unknown'] * 40, 'Sex': ['F'] * 40})
+	new_vdj_df = pd.read_csv(new['vdj_path'])
+	new_vdj_df['cdr3'] = new_vdj_df['cdr3'] + 'NEW'
+	new_vdj_df.to_csv(new['vdj_path'], index=False)
+
+	paths = {k: str(tmp_path / '{}.h5'.format(k)) for k in ('vdj', 'clinical', 'full_vdj', 'full_clinical')}
+	ClonotypePreprocessing(first).ingest_data(paths['vdj'], paths['clinical'])
+	ClonotypePreprocessing(first + [new]).ingest_data(paths['full_vdj'], paths['full_clinical'])
+	before = {k: _snapshot(paths[k]) for k in ('vdj', 'clinical')}
+	return ClonotypePreprocessing([new]), paths, before
+
+
+def _interrupted_append(preprocessing, paths, done=()):
+	"""
+	Append written but not committed, files in done marked as fully written
+	"""
+	with h5py.File(paths['vdj'], 'r+') as vdj_f, h5py.File(paths['clinical'], 'r+') as clinical_f:
+		h5_store.begin_append(vdj_f, ['s3'])
+		h5_store.begin_append(clinical_f, ['s3'])
+		preprocessing._write_samples(
+			vdj_f, clinical_f, preprocessing._iter_samples(True, False, 1, 2), 'gzip'
+		)
+		for k, f in (('vdj', vdj_f), ('clinical', clinical_f)):
+			if k in done:
+				h5_store.mark_append_done(f)
+
+
+def test_append_matches_ingest(cohort):
+	preprocessing, paths, _ = cohort
+	preprocessing.append_samples(paths['vdj'], paths['clinical'])
+	for k in ('vdj', 'clinical'):
+		_assert_same(_snapshot(paths[k]), _snapshot(paths['full_' + k]))
+
+
+def test_pending_files_cannot_be_read(cohort):
+	preprocessing, paths, _ = cohort
+	_interrupted_append(preprocessing, paths)
+	with pytest.raises(Exception, match='pending append'):
+		h5_store.H5Dataset(paths['vdj'])
+
+
+@pytest.mark.parametrize('done', [(), ('vdj',), ('clinical',)])
+def test_recover_rolls_back_unless_all_done(cohort, done):
+	preprocessing, paths, before = cohort
+	_interrupted_append(preprocessing, paths, done)
+	assert h5_store.recover_append(paths['vdj'], paths['clinical']) == 'rolled back'
+	for k in ('vdj', 'clinical'):
+		_assert_same(_snapshot(paths[k]), before[k])
+	assert h5_store.recover_append(paths['vdj'], paths['clinical']) is None
+
+
+def test_recover_commits_when_all_done(cohort):
+	preprocessing, paths, _ = cohort
+	_interrupted_append(preprocessing, paths, ('vdj', 'clinical'))
+	assert h5_store.recover_append(paths['vdj'], paths['clinical']) == 'committed'
+	for k in ('vdj', 'clinical'):
+		_assert_same(_snapshot(paths[k]), _snapshot(paths['full_' + k]))
+
+
+def test_recover_commits_when_other_file_committed(cohort):
+	preprocessing, paths, _ = cohort
+	_interrupted_append(preprocessing, paths, ('vdj', 'clinical'))
+	# crash between the 2 commits
+	with h5py.File(paths['vdj'], 'r+') as f:
+		h5_store.commit_append(f)
+	assert h5_store.recover_append(paths['vdj'], paths['clinical']) == 'committed'
+	_assert_same(_snapshot(paths['clinical']), _snapshot(paths['full_clinical']))
+
+
+def test_rollback_new_categories_columns_and_promotion(cohort):
+	preprocessing, paths, before = cohort
+	_interrupted_append(preprocessing, paths)
+	with h5py.File(paths['clinical'], 'r') as f:
+		# the append added a column and rewrote Age as categorical
+		assert 'Sex' in f
+		assert h5_store.get_encoding(f, 'Age') == 'categorical'
+		assert h5_store.JOURNAL_BACKUP in f
+	with h5py.File(paths['vdj'], 'r') as f:
+		assert len(f['cdr3']['categories']) > len(before['vdj']['cdr3'][0])
+
+	h5_store.recover_append(paths['vdj'], paths['clinical'])
+	with h5py.File(paths['clinical'], 'r') as f:
+		assert 'Sex' not in f and h5_store.JOURNAL_BACKUP not in f
+		assert h5_store.get_encoding(f, 'Age') == 'numeric'
+	for k in ('vdj', 'clinical'):
+		_assert_same(_snapshot(paths[k]), before[k])
+	# the same append succeeds afterwards
+	preprocessing.append_samples(paths['vdj'], paths['clinical'])
+	_assert_same(_snapshot(paths['clinical']), _snapshot(paths['full_clinical']))
+
+
+def test_rollback_drops_temp_index(cohort):
+	preprocessing, paths, before = cohort
+	_interrupted_append(preprocessing, paths)
+	# crash while an index was written under its temporary name
+	with h5py.File(paths['vdj'], 'r+') as f:
+		index_group = f[h5_store.INDEX_GROUP]
+		index_group.copy(index_group['cdr3'], 'cdr3' + h5_store.TEMP_SUFFIX)
+		del index_group['cdr3']
+	h5_store.recover_append(paths['vdj'], paths['clinical'])
+	with h5py.File(paths['vdj'], 'r') as f:
+		assert not any(i.endswith(h5_store.TEMP_SUFFIX) for i in f[h5_store.INDEX_GROUP].keys())
+	# the index saved before the append is restored
+	_assert_same(_snapshot(paths['vdj']), before['vdj'])
+	vdj = h5_store.H5Dataset(paths['vdj'])
+	cdr3 = vdj.read_column('cdr3')
+	np.testing.assert_array_equal(
+		vdj.lookup('cdr3', [cdr3[0]]), np.flatnonzero(np.asarray(cdr3) == cdr3[0])
+	)
+
+
+def test_index_without_backup_is_dropped(cohort):
+	preprocessing, paths, before = cohort
+	_interrupted_append(preprocessing, paths)
+	with h5py.File(paths['vdj'], 'r+') as f:
+		del f[h5_store.JOURNAL_BACKUP]['{}|cdr3'.format(h5_store.INDEX_GROUP)]
+	h5_store.recover_append(paths['vdj'], paths['clinical'])
+	with h5py.File(paths['vdj'], 'r') as f:
+		# covers dropped rows -> removed, rebuilt in memory when read
+		assert h5_store.read_inverted_index(f, 'cdr3') is None
+	vdj = h5_store.H5Dataset(paths['vdj'])
+	cdr3 = np.asarray(vdj.read_column('cdr3'))
+	np.testing.assert_array_equal(vdj.lookup('cdr3', [cdr3[0]]), np.flatnonzero(cdr3 == cdr3[0]))
+
+
+def test_rollback_after_failed_write(cohort, sample_factory):
+	preprocessing, paths, before = cohort
+	broken = sample_factory('s4', seed=4)
+	broken['vdj_path'] = broken['vdj_path'] + '.missing'
+	with pytest.raises(Exception):
+		ClonotypePreprocessing([preprocessing._ClonotypePreprocessing__batch_info[0], broken]).append_samples(
+			paths['vdj'], paths['clinical']
+		)
+	for k in ('vdj', 'clinical'):
+		_assert_same(_snapshot(paths[k]), before[k])
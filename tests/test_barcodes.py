@@ -0,0 +1,145 @@
+import h5py
+import numpy as np
+import pandas as pd
+
+from clonotype_analyses import common
+from clonotype_analyses.analyses import ClonotypePreprocessing
+from clonotype_analyses.analyses import ClonotypeToolkits
+from clonotype_analyses.common.constants import BARCODE_ENCODING
+from clonotype_analyses.common.constants import BARCODE_ENCODING_ATTR
+from clonotype_analyses.common.constants import BARCODE_KEY
+
+
+HASHED_BIT = np.uint64(1 << 63)
+
+
+def _10X_barcodes(seed=0, n=2000):
+	rng = np.random.default_rng(seed)
+	cores = [''.join(i) for i in rng.choice(list('ACGT'), (n, 16))]
+	suffixes = rng.choice(['', '-1', '-2', '-12'], n)
+	prefixes = rng.choice(['', 'S1_', 'sample2#'], n)
+	return np.array([p + c + s for p, c, s in zip(prefixes, cores, suffixes)], dtype='O')
+
+
+def _same_partition(a, b):
+	np.testing.assert_array_equal(pd.factorize(a)[0], pd.factorize(b)[0])
+
+
+def test_packed_keys_are_exact():
+	barcodes = _10X_barcodes()
+	# duplicates, and barcodes only differing by their suffix / prefix
+	core = barcodes[0].split('-')[0][-16:]
+	barcodes = np.concatenate([barcodes, barcodes[:100], [core, core + '-1', core + '-11', 'S1_' + core]])
+	(keys, ), encoding = common.pack_barcodes(barcodes, return_encoding=True)
+	assert encoding == BARCODE_ENCODING.PACKED.value
+	assert keys.dtype == np.uint64
+	assert not np.any(keys & HASHED_BIT)
+	_same_partition(keys, barcodes)
+
+
+def test_packed_keys_stable_across_arrays():
+	barcodes = _10X_barcodes(1)
+	vdj_keys, clinical_keys = common.pack_barcodes(barcodes[:1500], barcodes[500:])
+	np.testing.assert_array_equal(vdj_keys[500:], clinical_keys[:1000])
+	# same barcodes packed alone: same keys
+	np.testing.assert_array_equal(common.pack_barcodes(barcodes[:1500])[0], vdj_keys)
+
+
+def test_prefix_code_override():
+	barcodes = np.array(['S1_' + i for i in _10X_barcodes(2) if '_' not in i and '#' not in i], dtype='O')
+	keys_0 = common.pack_barcodes(barcodes, prefix_code=0)[0]
+	keys_7 = common.pack_barcodes(barcodes, prefix_code=7)[0]
+	low_bits = np.uint64((1 << 40) - 1)
+	np.testing.assert_array_equal(keys_0 & low_bits, keys_7 & low_bits)
+	np.testing.assert_array_equal(keys_7 >> np.uint64(40), 7)
+	# without prefix: same packed key once overridden
+	np.testing.assert_array_equal(
+		common.pack_barcodes(np.array([i[3:] for i in barcodes], dtype='O'), prefix_code=7)[0], keys_7
+	)
+	_same_partition(keys_7, barcodes)
+
+
+def test_prefix_code_with_several_prefixes_falls_back_to_hashes():
+	barcodes = _10X_barcodes(3)
+	(keys, ), encoding = common.pack_barcodes(barcodes, prefix_code=1, return_encoding=True)
+	assert encoding == BARCODE_ENCODING.HASHED.value
+	assert np.all(keys & HASHED_BIT)
+	_same_partition(keys, barcodes)
+
+
+def test_hash_fallback():
+	barcodes = np.array(['{:02d}_{:02d}__s1'.format(i % 96, i // 96) for i in range(3000)], dtype='O')
+	(vdj_keys, clinical_keys), encoding = common.pack_barcodes(
+		barcodes, barcodes[::-1], prefix_code=0, return_encoding=True
+	)
+	assert encoding == BARCODE_ENCODING.HASHED.value
+	assert np.all(vdj_keys & HASHED_BIT)
+	np.testing.assert_array_equal(vdj_keys, clinical_keys[::-1])
+	_same_partition(vdj_keys, barcodes)
+	# same barcode in another sample -> another key
+	other_keys = common.pack_barcodes(barcodes, prefix_code=1)[0]
+	assert not np.any(np.isin(other_keys, vdj_keys))
+	# one non-10X barcode -> every barcode is hashed
+	mixed = np.concatenate([_10X_barcodes(4, 10), ['not_a_barcode']])
+	assert np.all(common.pack_barcodes(mixed)[0] & HASHED_BIT)
+	# leading zero GEM well: not packed, '-01' and '-1' keep different keys
+	core = _10X_barcodes(4, 1)[0].split('-')[0]
+	keys = common.pack_barcodes(np.array([core + '-1', core + '-01'], dtype='O'))[0]
+	assert np.all(keys & HASHED_BIT) and keys[0] != keys[1]
+
+
+def test_barcode_encoding():
+	packed = common.pack_barcodes(_10X_barcodes(5, 10))[0]
+	hashed = common.pack_barcodes(np.array(['a', 'b'], dtype='O'))[0]
+	assert common.barcode_encoding(packed) == BARCODE_ENCODING.PACKED.value
+	assert common.barcode_encoding(hashed) == BARCODE_ENCODING.HASHED.value
+	assert common.barcode_encoding(np.concatenate([packed, hashed])) == BARCODE_ENCODING.MIXED.value
+	assert common.barcode_encoding(packed, BARCODE_ENCODING.PACKED.value) == BARCODE_ENCODING.PACKED.value
+	assert common.barcode_encoding(hashed, BARCODE_ENCODING.PACKED.value) == BARCODE_ENCODING.MIXED.value
+	assert common.barcode_encoding(packed[:0], BARCODE_ENCODING.HASHED.value) == BARCODE_ENCODING.HASHED.value
+
+
+def _encodings(*h5_paths):
+	encodings = []
+	for path in h5_paths:
+		with h5py.File(path, 'r') as f:
+			encodings.append(f[BARCODE_KEY].attrs[BARCODE_ENCODING_ATTR])
+	return encodings
+
+
+def test_ingest_records_encoding(sample_factory, parse_factory, tmp_path, capsys):
+	vdj_path, clinical_path = str(tmp_path / 'vdj.h5'), str(tmp_path / 'clinical.h5')
+	ClonotypePreprocessing([sample_factory('x1')]).ingest_data(vdj_path, clinical_path)
+	assert _encodings(vdj_path, clinical_path) == [BARCODE_ENCODING.PACKED.value] * 2
+	packed_df = ClonotypeToolkits(vdj_path, clinical_path).clonotypes_diversity(['Condition'])
+
+	# Parse barcodes are not 10X-like -> hashed, the files hold both encodings
+	ClonotypePreprocessing([parse_factory('pb')]).append_samples(vdj_path, clinical_path)
+	assert 'NOTE: barcodes of pb are not 10X-like' in capsys.readouterr().out
+	assert _encodings(vdj_path, clinical_path) == [BARCODE_ENCODING.MIXED.value] * 2
+	with h5py.File(vdj_path, 'r') as f:
+		assert f['__cells__'][BARCODE_KEY].attrs[BARCODE_ENCODING_ATTR] == BARCODE_ENCODING.MIXED.value
+	toolkits = ClonotypeToolkits(vdj_path, clinical_path)
+	assert toolkits._join_index() == BARCODE_KEY
+	pd.testing.assert_frame_equal(
+		ClonotypeToolkits(vdj_path, clinical_path, samples=['x1']).clonotypes_diversity(['Condition']),
+		packed_df
+	)
+
+
+def test_keys_without_encoding_are_not_joined(sample_factory, tmp_path):
+	vdj_path, clinical_path = str(tmp_path / 'vdj.h5'), str(tmp_path / 'clinical.h5')
+	ClonotypePreprocessing([sample_factory('x1')]).ingest_data(vdj_path, clinical_path)
+	expected_df = ClonotypeToolkits(vdj_path, clinical_path).clonotypes_diversity(['Condition'])
+	# older files: keys without encoding
+	with h5py.File(clinical_path, 'a') as f:
+		del f[BARCODE_KEY].attrs[BARCODE_ENCODING_ATTR]
+	toolkits = ClonotypeToolkits(vdj_path, clinical_path)
+	assert toolkits._join_index() is None
+	pd.testing.assert_frame_equal(toolkits.clonotypes_diversity(['Condition']), expected_df)
+
+	# appending to an older file does not start recording an encoding
+	ClonotypePreprocessing([sample_factory('x2', seed=1)]).append_samples(vdj_path, clinical_path)
+	with h5py.File(clinical_path, 'r') as f:
+		assert BARCODE_ENCODING_ATTR not in f[BARCODE_KEY].attrs
+	assert ClonotypeToolkits(vdj_path, clinical_path)._join_index() is None
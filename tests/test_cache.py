@@ -0,0 +1,137 @@
+import os
+
+import pandas as pd
+import pytest
+
+from clonotype_analyses.analyses import ClonotypePreprocessing
+from clonotype_analyses.analyses import ClonotypeToolkits
+from clonotype_analyses.common.cache import ResultCache
+from clonotype_analyses.common.cache import file_fingerprint
+from clonotype_analyses.common.cache import make_key
+
+
+def test_lru_eviction():
+	cache = ResultCache(max_size=3)
+	for i in 'abc':
+		cache.set(i, i.upper())
+	# reading 'a' makes 'b' the least recently used
+	assert cache.get('a') == 'A'
+	cache.set('d', 'D')
+	assert 'b' not in cache
+	assert [i in cache for i in 'acd'] == [True] * 3
+	cache.set('c', 'C2')
+	cache.set('e', 'E')
+	assert 'a' not in cache
+	assert cache.get('c') == 'C2'
+	assert cache.get('b', 'missing') == 'missing'
+
+	cache = ResultCache(max_size=0)
+	assert cache.set('a', 1) == 1
+	assert 'a' not in cache
+
+
+def test_get_or_compute_calls_once():
+	calls = []
+	def _compute(x, y=0):
+		calls.append((x, y))
+		return x + y
+	cache = ResultCache(max_size=2)
+	assert cache.get_or_compute('k', _compute, 1, y=2) == 3
+	assert cache.get_or_compute('k', _compute, 1, y=2) == 3
+	assert calls == [(1, 2)]
+	# None is a result too
+	assert cache.get_or_compute('none', lambda: calls.append('none')) is None
+	assert cache.get_or_compute('none', lambda: calls.append('none')) is None
+	assert calls == [(1, 2), 'none']
+
+
+def test_disk_round_trip(tmp_path):
+	cache_dir = str(tmp_path / 'cache')
+	df = pd.DataFrame({'a': pd.Categorical(['x', 'y', 'x']), 'b': [1.5, 2.5, 3.5]})
+	cache = ResultCache(max_size=1, cache_dir=cache_dir)
+	cache.set('df', df)
+	cache.set('tuple', (df, 'Condition'))
+	# evicted from memory, read back from disk
+	pd.testing.assert_frame_equal(cache.get('df'), df)
+
+	# another process / instance
+	cache = ResultCache(max_size=4, cache_dir=cache_dir)
+	assert 'df' in cache
+	res_df, name = cache.get('tuple')
+	pd.testing.assert_frame_equal(res_df, df)
+	assert name == 'Condition'
+	assert not any('.TEMP' in i for i in os.listdir(cache_dir))
+
+	# truncated pickle: computed again
+	with open(os.path.join(cache_dir, 'broken.pkl'), 'wb') as f:
+		f.write(b'\x80')
+	assert cache.get_or_compute('broken', lambda: 'recomputed') == 'recomputed'
+	assert ResultCache(cache_dir=cache_dir).get('broken') == 'recomputed'
+
+	cache.clear()
+	assert 'df' in cache
+	cache.clear(disk=True)
+	assert 'df' not in cache
+	assert cache.get('df') is None
+
+
+def test_make_key():
+	assert make_key(['a', 1], {'x': 1, 'y': [2]}) == make_key(['a', 1], {'y': [2], 'x': 1})
+	assert make_key(['a', 1], 'name') != make_key(['a', 2], 'name')
+	assert make_key(None, 'name') != make_key(['s1'], 'name')
+
+
+def test_toolkits_cache_invalidated_by_append(sample_factory, tmp_path, monkeypatch):
+	infos = [sample_factory('s{}'.format(i), seed=i) for i in range(3)]
+	vdj_path, clinical_path = str(tmp_path / 'vdj.h5'), str(tmp_path / 'clinical.h5')
+	cache_dir = str(tmp_path / 'cache')
+	ClonotypePreprocessing(infos[:2]).ingest_data(vdj_path, clinical_path)
+	meta_keys = ['sample_name']
+	expected_df = ClonotypeToolkits(vdj_path, clinical_path, cache_dir=cache_dir).clonotypes_diversity(meta_keys)
+
+	# same files: served from memory, then from disk by new toolkits
+	compute = ClonotypeToolkits._compute_clonotypes_diversity
+	def _fail(*args):
+		raise AssertionError('computed again')
+	monkeypatch.setattr(ClonotypeToolkits, '_compute_clonotypes_diversity', _fail)
+	toolkits = ClonotypeToolkits(vdj_path, clinical_path, cache_dir=cache_dir)
+	pd.testing.assert_frame_equal(toolkits.clonotypes_diversity(meta_keys), expected_df)
+	# callers may modify the returned result
+	res_df = toolkits.clonotypes_diversity(meta_keys)
+	res_df['extra'] = 1
+	pd.testing.assert_frame_equal(toolkits.clonotypes_diversity(meta_keys), expected_df)
+	# other parameters / samples are other keys
+	with pytest.raises(AssertionError, match='computed again'):
+		toolkits.clonotypes_diversity(meta_keys, abundance='umis')
+	with pytest.raises(AssertionError, match='computed again'):
+		ClonotypeToolkits(vdj_path, clinical_path, samples=['s0'], cache_dir=cache_dir).clonotypes_diversity(meta_keys)
+
+	# appending changes the h5 fingerprints -> computed again, with the new sample
+	fingerprints = file_fingerprint(vdj_path), file_fingerprint(clinical_path)
+	ClonotypePreprocessing(infos[2:]).append_samples(vdj_path, clinical_path)
+	assert fingerprints[0] != file_fingerprint(vdj_path)
+	assert fingerprints[1] != file_fingerprint(clinical_path)
+	with pytest.raises(AssertionError, match='computed again'):
+		toolkits.clonotypes_diversity(meta_keys)
+
+	monkeypatch.setattr(ClonotypeToolkits, '_compute_clonotypes_diversity', compute)
+	appended_df = toolkits.clonotypes_diversity(meta_keys)
+	assert sorted(appended_df['sample_name'].astype(str).unique()) == ['s0', 's1', 's2']
+	pd.testing.assert_frame_equal(
+		appended_df,
+		ClonotypeToolkits(vdj_path, clinical_path).clonotypes_diversity(meta_keys)
+	)
+
+
+def test_sharded_toolkits_reopen_new_shards(sample_factory, tmp_path):
+	infos = [sample_factory('s{}'.format(i), seed=i) for i in range(3)]
+	shard_dir = str(tmp_path / 'shards')
+	ClonotypePreprocessing(infos[:2]).ingest_shards(shard_dir)
+	toolkits = ClonotypeToolkits(shard_dir)
+	assert sorted(toolkits.clonotypes_diversity(['sample_name'])['sample_name'].astype(str)) == ['s0', 's1']
+
+	# new shard, and a replaced one: their old files are removed
+	ClonotypePreprocessing(infos[1:]).ingest_shards(shard_dir)
+	appended_df = toolkits.clonotypes_diversity(['sample_name'])
+	assert sorted(appended_df['sample_name'].astype(str)) == ['s0', 's1', 's2']
+	pd.testing.assert_frame_equal(appended_df, ClonotypeToolkits(shard_dir).clonotypes_diversity(['sample_name']))
@@ -0,0 +1,28 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from clonotype_analyses.compute import clonotypes_cdr3_length
+
+
+def _contigs(trb_cdr3s):
+	n_TRB = len(trb_cdr3s)
+	return pd.DataFrame({
+		'chain': ['TRA'] * 2 + ['TRB'] * n_TRB,
+		'cdr3': ['CAVS', 'CAVSF'] + trb_cdr3s,
+		'Condition': ['A', 'B'] + ['A'] * n_TRB,
+	})
+
+
+def test_cdr3_length_ratio():
+	hist_df = clonotypes_cdr3_length.create_cdr3_length_hist(_contigs(['CASSF', np.nan]))
+	ratio_df = clonotypes_cdr3_length.cdr3_length_ratio(hist_df, chain='TRA')
+	assert list(ratio_df.columns) == [4, 5]
+	np.testing.assert_allclose(ratio_df.values, [[1, 0], [0, 1]])
+
+
+@pytest.mark.parametrize('trb_cdr3s', [[], [np.nan, np.nan]])
+def test_cdr3_length_ratio_without_chain(trb_cdr3s):
+	hist_df = clonotypes_cdr3_length.create_cdr3_length_hist(_contigs(trb_cdr3s))
+	with pytest.raises(Exception, match='No TRB contig'):
+		clonotypes_cdr3_length.cdr3_length_ratio(hist_df, chain='TRB')
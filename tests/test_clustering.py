@@ -0,0 +1,142 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from clonotype_analyses.common.constants import CDR3_CLUSTER
+from clonotype_analyses.common.constants import CLONOTYPE_CLUSTER
+from clonotype_analyses.compute import clonotypes_clustering
+
+
+def _levenshtein(a, b):
+	prev = list(range(len(b) + 1))
+	for i, ca in enumerate(a, 1):
+		cur = [i]
+		for j, cb in enumerate(b, 1):
+			cur.append(min(prev[j - 1] + (ca != cb), prev[j] + 1, cur[j - 1] + 1))
+		prev = cur
+	return prev[-1]
+
+
+def _hamming(a, b):
+	if len(a) != len(b):
+		return np.inf
+	return sum(i != j for i, j in zip(a, b))
+
+
+def _reference_clusters(seqs, partitions, k, metric):
+	"""
+	All pairs + union-find, clusters numbered by first appearance
+	"""
+	distance = _hamming if metric == 'hamming' else _levenshtein
+	parent = list(range(len(seqs)))
+
+	def find(i):
+		while parent[i] != i:
+			parent[i] = parent[parent[i]]
+			i = parent[i]
+		return i
+
+	for i in range(len(seqs)):
+		for j in range(i + 1, len(seqs)):
+			if partitions[i] == partitions[j] and distance(seqs[i], seqs[j]) <= k:
+				parent[find(i)] = find(j)
+	return pd.factorize(np.array([find(i) for i in range(len(seqs))]))[0]
+
+
+def _random_seqs(rng, n, alphabet='ACG', lengths=(3, 7)):
+	seqs = {''.join(rng.choice(list(alphabet), rng.integers(*lengths))) for _ in range(n)}
+	return np.array(sorted(seqs), dtype='O')
+
+
+@pytest.mark.parametrize('metric', ['hamming', 'levenshtein'])
+@pytest.mark.parametrize('k', [1, 2])
+def test_clusters_match_all_pairs(metric, k):
+	rng = np.random.default_rng(k)
+	for _ in range(30):
+		seqs = _random_seqs(rng, 40)
+		partitions = rng.integers(0, 3, len(seqs))
+		np.testing.assert_array_equal(
+			clonotypes_clustering.cluster_sequences(seqs, partitions, k, metric),
+			_reference_clusters(seqs, partitions, k, metric)
+		)
+
+
+def test_clusters_stay_within_partitions():
+	seqs = np.array(['CASSF', 'CASSY', 'CASSF', 'CASF'], dtype='O')
+	partitions = np.array([0, 0, 1, 1])
+	clusters = clonotypes_clustering.cluster_sequences(seqs, partitions, k=1)
+	np.testing.assert_array_equal(clusters, [0, 0, 1, 1])
+	clusters = clonotypes_clustering.cluster_sequences(seqs, k=1, metric='hamming')
+	np.testing.assert_array_equal(clusters, [0, 0, 0, 1])
+
+
+def test_clusters_same_with_workers():
+	rng = np.random.default_rng(7)
+	seqs = _random_seqs(rng, 200, lengths=(4, 9))
+	partitions = rng.integers(0, 5, len(seqs))
+	np.testing.assert_array_equal(
+		clonotypes_clustering.cluster_sequences(seqs, partitions, 1, n_workers=2),
+		clonotypes_clustering.cluster_sequences(seqs, partitions, 1, n_workers=1)
+	)
+
+
+def test_long_sequences_are_not_clustered(capsys):
+	long_seq = 'C' * clonotypes_clustering._MAX_HASH_LENGTH
+	seqs = np.array([long_seq, long_seq[:-1] + 'F', 'CASSF', 'CASSY'], dtype='O')
+	clusters = clonotypes_clustering.cluster_sequences(seqs, k=1)
+	np.testing.assert_array_equal(clusters, [0, 1, 2, 2])
+	assert 'WARNING: 2 sequences' in capsys.readouterr().out
+
+
+def test_levenshtein_distance():
+	rng = np.random.default_rng(0)
+	seqs_a = _random_seqs(rng, 100, lengths=(0, 8))
+	seqs_b = rng.permutation(seqs_a)
+	np.testing.assert_array_equal(
+		clonotypes_clustering.levenshtein_distance(seqs_a, seqs_b),
+		[_levenshtein(a, b) for a, b in zip(seqs_a, seqs_b)]
+	)
+
+
+def test_connected_components():
+	# chain 4-3-2 linked in reverse order, 5 alone, 0-1
+	components = clonotypes_clustering.connected_components(
+		6, np.array([4, 3, 1]), np.array([3, 2, 0])
+	)
+	np.testing.assert_array_equal(components, [0, 0, 1, 1, 1, 2])
+	np.testing.assert_array_equal(
+		clonotypes_clustering.connected_components(3, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)),
+		[0, 1, 2]
+	)
+
+
+def test_create_cdr3_clusters():
+	VDJ_10X = pd.DataFrame({
+		'chain': ['TRA', 'TRB', 'TRA', 'TRB', 'TRB', 'TRB'],
+		'cdr3': ['CAVF', 'CASSF', 'CAVY', 'CASSF', 'CASSY', np.nan],
+		'v_gene': ['V1'] * 6,
+		'j_gene': ['J1'] * 6,
+	}, index=['c1', 'c1', 'c2', 'c2', 'c3', 'c4'])
+	clusters_df = clonotypes_clustering.create_cdr3_clusters(VDJ_10X, k=1)
+	assert list(clusters_df.index) == list(VDJ_10X.index)
+
+	cdr3_clusters = clusters_df[CDR3_CLUSTER].astype('O').values
+	# CASSF x2 is the most frequent cdr3 of its cluster, CAVF / CAVY tie -> either one
+	assert list(cdr3_clusters[[1, 3, 4]]) == ['CASSF|TRB|V1|J1'] * 3
+	assert cdr3_clusters[0] == cdr3_clusters[2]
+	assert pd.isna(cdr3_clusters[5])
+
+	clonotypes = clusters_df[CLONOTYPE_CLUSTER].astype('O').values
+	# c1 and c2 have the same pair of clusters, c3 only the TRB one, c4 none
+	assert clonotypes[0] == clonotypes[1] == clonotypes[2] == clonotypes[3]
+	# cluster labels of a cell are sorted
+	assert clonotypes[0] == 'CASSF|TRB|V1|J1;{}'.format(cdr3_clusters[0])
+	assert clonotypes[4] == 'CASSF|TRB|V1|J1'
+	assert pd.isna(clonotypes[5])
+
+	# different V gene -> different partition
+	VDJ_10X.loc['c3', 'v_gene'] = 'V2'
+	clusters_df = clonotypes_clustering.create_cdr3_clusters(VDJ_10X, k=1)
+	assert clusters_df[CDR3_CLUSTER].astype('O').values[4] == 'CASSY|TRB|V2|J1'
+	clusters_df = clonotypes_clustering.create_cdr3_clusters(VDJ_10X, k=1, by_genes=False)
+	assert clusters_df[CDR3_CLUSTER].astype('O').values[4] == 'CASSF|TRB'
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('dash')
+
+from clonotype_analyses import dashboard
+from clonotype_analyses.analyses import ClonotypePreprocessing
+from clonotype_analyses.analyses import ClonotypeToolkits
+
+
+def _graph_ids(layout):
+	ids = []
+	def _visit(node):
+		if getattr(node, 'id', None) is not None:
+			ids.append(node.id)
+		children = getattr(node, 'children', None)
+		for i in children if isinstance(children, list) else [children]:
+			if i is not None and not isinstance(i, str):
+				_visit(i)
+	_visit(layout)
+	return [i[:-len('-graph')] for i in ids if i.endswith('-graph')]
+
+
+@pytest.fixture
+def batch_info(sample_factory):
+	return [
+		sample_factory('s{}'.format(i), seed=i, clinical_columns={
+			'Condition': np.random.default_rng(i).choice(['A', 'B'], 40),
+			'Age': np.arange(40) + 0.5,
+			'X_UMAP': np.random.default_rng(i).normal(size=40),
+		})
+		for i in range(2)
+	]
+
+
+def test_meta_columns_are_labels(batch_info, tmp_path):
+	paths = ClonotypePreprocessing(batch_info).ingest_data(str(tmp_path / 'vdj.h5'), str(tmp_path / 'clinical.h5'))
+	toolkits = ClonotypeToolkits(paths['10X_VDJ'], paths['clinical_meta'])
+	assert set(toolkits.meta_columns) == {'Condition', 'sample_name'}
+
+
+def test_sharded_store_panels(batch_info, tmp_path):
+	shard_dir = str(tmp_path / 'shards')
+	ClonotypePreprocessing(batch_info).ingest_shards(shard_dir)
+	app = dashboard.create_app(shard_dir)
+	assert _graph_ids(app.layout) == list(dashboard.SHARDED_PANELS)
+
+	toolkits = ClonotypeToolkits(shard_dir)
+	assert toolkits.is_sharded
+	assert set(toolkits.meta_columns) == {'Condition', 'sample_name'}
+	params = {'meta_keys': ['Condition'], 'chain': 'TRB', 'lower_n': 3, 'top_k': 5}
+	for panel in dashboard.SHARDED_PANELS:
+		assert 'data' in dashboard._build_figure(toolkits, panel, params)
+
+
+def test_single_store_panels(batch_info, tmp_path):
+	paths = ClonotypePreprocessing(batch_info).ingest_data(str(tmp_path / 'vdj.h5'), str(tmp_path / 'clinical.h5'))
+	app = dashboard.create_app(paths['10X_VDJ'], paths['clinical_meta'])
+	assert _graph_ids(app.layout) == list(dashboard.PANELS)
@@ -0,0 +1,154 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from clonotype_analyses.compute import clonotypes_diversity_rate
+
+
+def _contigs():
+	# 3 paired cells: c1, c2 share clonotype 1
+	return pd.DataFrame({
+		'chain': ['TRA', 'TRB'] * 3,
+		'umis': [5, 3, 4, 7, 2, 9],
+		'raw_clonotype_id': ['clonotype1'] * 4 + ['clonotype2'] * 2,
+		'Condition': ['A'] * 6,
+	}, index=['c1', 'c1', 'c2', 'c2', 'c3', 'c3'])
+
+
+@pytest.mark.parametrize('abundance, total', [('cells', 3), ('umis', 3 + 4 + 2)])
+def test_diversity_total_named_after_abundance(abundance, total):
+	contigs = _contigs()
+	diversity_df = clonotypes_diversity_rate.create_diversity_df(contigs, abundance=abundance)
+	assert diversity_df['n_{}'.format(abundance)].tolist() == [total]
+	assert diversity_df['n_clonotypes'].tolist() == [2]
+
+	abundance_df = clonotypes_diversity_rate.merge_clonotype_abundances([
+		clonotypes_diversity_rate.create_clonotype_abundance_df(contigs.iloc[:4], abundance=abundance),
+		clonotypes_diversity_rate.create_clonotype_abundance_df(contigs.iloc[4:], abundance=abundance),
+	])
+	merged_df = clonotypes_diversity_rate.diversity_from_abundances(abundance_df, abundance=abundance)
+	pd.testing.assert_frame_equal(merged_df, diversity_df, check_dtype=False)
+
+	resampled_df = clonotypes_diversity_rate.create_resampled_diversity_df(
+		contigs, abundance=abundance, n_iter=10
+	)
+	np.testing.assert_allclose(resampled_df['n_{}_mean'.format(abundance)].values, [total])
+
+
+def _contigs_without_clonotype():
+	# c2 (group A, first group) and c5 (group B) have no clonotype
+	return pd.DataFrame({
+		'chain': ['TRA', 'TRB'] * 6,
+		'umis': [1] * 12,
+		'raw_clonotype_id': (
+			['clonotype1'] * 2 + [np.nan] * 2 + ['clonotype2'] * 2
+			+ ['clonotype1'] * 2 + [np.nan] * 2 + ['clonotype3'] * 2
+		),
+		'Condition': ['A'] * 6 + ['B'] * 6,
+	}, index=np.repeat(['c1', 'c2', 'c3', 'c4', 'c5', 'c6'], 2))
+
+
+def test_diversity_drops_cells_without_clonotype():
+	contigs = _contigs_without_clonotype()
+	diversity_df = clonotypes_diversity_rate.create_diversity_df(contigs)
+	assert diversity_df['n_cells'].tolist() == [2, 2]
+	assert diversity_df['n_clonotypes'].tolist() == [2, 2]
+	np.testing.assert_allclose(diversity_df['shannon'].values, np.log(2))
+
+	# same as the map-reduce path, one partition per group
+	abundance_df = clonotypes_diversity_rate.merge_clonotype_abundances([
+		clonotypes_diversity_rate.create_clonotype_abundance_df(contigs.iloc[:6]),
+		clonotypes_diversity_rate.create_clonotype_abundance_df(contigs.iloc[6:]),
+	])
+	pd.testing.assert_frame_equal(
+		clonotypes_diversity_rate.diversity_from_abundances(abundance_df), diversity_df, check_dtype=False
+	)
+
+	resampled_df = clonotypes_diversity_rate.create_resampled_diversity_df(contigs, n_iter=10)
+	np.testing.assert_allclose(resampled_df['n_clonotypes_mean'].values, [2, 2])
+
+
+def test_diversity_without_any_clonotype_in_a_group():
+	contigs = _contigs_without_clonotype()
+	contigs['raw_clonotype_id'] = contigs['raw_clonotype_id'].where(contigs['Condition'] == 'B')
+	diversity_df = clonotypes_diversity_rate.create_diversity_df(contigs)
+	assert diversity_df.index.tolist() == ['B']
+	assert diversity_df['n_cells'].tolist() == [2]
+
+
+def test_fuzzy_diversity_with_missing_cdr3(sample_factory, tmp_path):
+	from clonotype_analyses.analyses import ClonotypePreprocessing
+	from clonotype_analyses.analyses import ClonotypeToolkits
+
+	info = sample_factory('s1', n_cells=60)
+	clinical_df = pd.read_csv(info['clinical_meta_path'], sep='\t', index_col=0)
+	vdj_df = pd.read_csv(info['vdj_path'])
+	paired = vdj_df.groupby('barcode')['chain'].nunique() == 2
+	# one paired cell of the first group and one of a later group without cdr3: no CLONOTYPE_CLUSTER
+	missing = [
+		clinical_df.index[(clinical_df['Condition'] == i) & paired.reindex(clinical_df.index).values][0]
+		for i in ('A', 'B')
+	]
+	vdj_df.loc[vdj_df['barcode'].isin(missing), 'cdr3'] = np.nan
+	vdj_df.to_csv(info['vdj_path'], index=False)
+
+	vdj_path, clinical_path = str(tmp_path / 'vdj.h5'), str(tmp_path / 'clinical.h5')
+	ClonotypePreprocessing([info]).ingest_data(vdj_path, clinical_path)
+	toolkits = ClonotypeToolkits(vdj_path, clinical_path)
+	diversity_df = toolkits.clonotypes_diversity(['Condition'], clusters={'k': 1})
+
+	has_cdr3 = vdj_df.groupby('barcode')['cdr3'].count() > 0
+	expected = clinical_df.loc[paired[paired & has_cdr3].index, 'Condition'].value_counts().sort_index()
+	assert diversity_df['n_cells'].tolist() == expected.tolist()
+
+
+def _random_abundances(seed=0, n_groups=4):
+	rng = np.random.default_rng(seed)
+	pair_group = np.repeat(np.arange(n_groups), 30)
+	pair_count = rng.integers(1, 20, len(pair_group)).astype(np.float64)
+	return pair_group, pair_count, n_groups
+
+
+@pytest.mark.parametrize('method', ['rarefaction', 'bootstrap'])
+def test_resampling_does_not_depend_on_workers(method):
+	pair_group, pair_count, n_groups = _random_abundances()
+	res = [
+		clonotypes_diversity_rate.resample_diversity(
+			pair_group, pair_count, n_groups, n_iter=50, method=method, seed=3,
+			n_workers=n_workers, batch_size=16
+		)
+		for n_workers in (1, 2, 3)
+	]
+	for other in res[1:]:
+		assert other.keys() == res[0].keys()
+		for k in res[0]:
+			np.testing.assert_array_equal(other[k], res[0][k])
+	# another seed -> other replicates
+	other_seed = clonotypes_diversity_rate.resample_diversity(
+		pair_group, pair_count, n_groups, n_iter=50, method=method, seed=4, batch_size=16
+	)
+	assert not np.array_equal(other_seed['shannon'], res[0]['shannon'])
+
+
+def test_rarefaction_skips_small_groups():
+	pair_group, pair_count, n_groups = _random_abundances()
+	# group 1: 30 cells < depth, other groups: 30 clonotypes of 1..19 cells
+	pair_count[pair_group == 1] = 1
+	depth = 31
+	res = clonotypes_diversity_rate.resample_diversity(
+		pair_group, pair_count, n_groups, depth=depth, n_iter=10
+	)
+	assert np.all(np.isnan(res['shannon'][1]))
+	assert not np.any(np.isnan(res['shannon'][[0, 2, 3]]))
+	np.testing.assert_array_equal(res['n_cells'][[0, 2, 3]], depth)
+
+
+def test_resampling_without_cells():
+	with pytest.raises(Exception, match='no cells to resample'):
+		clonotypes_diversity_rate.resample_diversity(
+			np.zeros(0, dtype=np.int64), np.zeros(0), 2, n_iter=10
+		)
+	# no paired cell
+	contigs = _contigs().iloc[::2]
+	with pytest.raises(Exception, match='no cells to resample'):
+		clonotypes_diversity_rate.create_resampled_diversity_df(contigs, n_iter=10)
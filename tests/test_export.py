@@ -0,0 +1,138 @@
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from clonotype_analyses.common import export
+
+
+def _matrix(seed=0, n_rows=6, n_columns=5, missing=True):
+	rng = np.random.default_rng(seed)
+	values = rng.integers(0, 4, (n_rows, n_columns)).astype(np.float64)
+	if missing:
+		values[rng.random(values.shape) < 0.2] = np.nan
+	values[1, :] = 0
+	return pd.DataFrame(
+		values,
+		index=pd.Index(['g{}'.format(i) for i in range(n_rows)][::-1], name='Groups'),
+		columns=list(range(1, n_columns)) + ['>{}'.format(n_columns - 1)],
+	)
+
+
+def _loop_long(df, names, dropna=False):
+	# previous plotly converters: one row per cell, appended in a loop
+	reformated_dct = {i: [] for i in names}
+	for i in df.index:
+		for j in df.columns:
+			if dropna and pd.isna(df.loc[i, j]):
+				continue
+			reformated_dct[names[0]].append(i)
+			reformated_dct[names[1]].append(j)
+			reformated_dct[names[2]].append(df.loc[i, j])
+	return pd.DataFrame(reformated_dct)
+
+
+def _loop_normalize(df, dtype):
+	# previous QC fraction normalization, row by row
+	df = df.astype(dtype)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		for i in range(len(df)):
+			df.iloc[i, :] /= np.sum(df.iloc[i, :].values)
+	return df
+
+
+@pytest.mark.parametrize('dropna', [False, True])
+def test_to_long_matches_loop(dropna):
+	df = _matrix()
+	names = ['Groups', 'Clonotypes size', 'Ratio']
+	long_df = export.to_long(df, names, dropna=dropna)
+	pd.testing.assert_frame_equal(long_df, _loop_long(df, names, dropna))
+	if dropna:
+		with warnings.catch_warnings():
+			warnings.simplefilter('ignore', FutureWarning)
+			stacked_df = df.stack().reset_index()
+		stacked_df.columns = names
+		pd.testing.assert_frame_equal(long_df, stacked_df)
+
+
+def test_to_long_keeps_column_types():
+	df = _matrix(1, missing=False)
+	df.columns = pd.CategoricalIndex(['1 TRA - 1 TRB', '0 TRA - 1 TRB', 'others', 'a', 'b'])
+	df = df.astype(np.float32)
+	long_df = export.to_long(df, ['Groups', 'Clonotypes types', 'Ratio'])
+	assert long_df['Ratio'].dtype == np.float32
+	pd.testing.assert_frame_equal(
+		long_df, _loop_long(df, ['Groups', 'Clonotypes types', 'Ratio']).astype({'Ratio': np.float32})
+	)
+	assert len(export.to_long(df.iloc[:0], ['a', 'b', 'c'])) == 0
+
+
+@pytest.mark.parametrize('dtype', [None, np.float32, np.float64])
+def test_normalize_rows_matches_loop(dtype):
+	df = _matrix(2, missing=False)
+	expected = _loop_normalize(df, np.float64 if dtype is None else dtype)
+	normalized_df = export.normalize_rows(df, dtype)
+	pd.testing.assert_frame_equal(normalized_df, expected)
+	# rows summing to 0 -> NaN
+	assert normalized_df.iloc[1].isna().all()
+	np.testing.assert_allclose(normalized_df.drop(index=df.index[1]).sum(axis=1), 1, rtol=1e-6)
+
+
+def _typed_df():
+	return pd.DataFrame({
+		'Groups': pd.Categorical(['B', 'A', 'B', np.nan], categories=['B', 'A']),
+		'Clonotypes': np.array(['CASSF', 'CASSY', None, 'CAVF'], dtype='O'),
+		'n_cells': np.array([1, 2, 3, 4], dtype=np.int64),
+		'Ratio': np.array([0.25, 0.5, np.nan, 1.0], dtype=np.float64),
+		'Ratio32': np.array([0.25, 0.5, 0.75, 1.0], dtype=np.float32),
+		'size_bin': np.array([1, 2, 3, 4], dtype=np.uint16),
+		'paired': np.array([True, False, True, False]),
+	})
+
+
+@pytest.mark.parametrize('extension', ['.parquet', '.arrow'])
+def test_artifact_round_trip(tmp_path, extension):
+	pytest.importorskip('pyarrow')
+	df = _typed_df()
+	metadata = {'analysis': 'clonotypes_expansion', 'params': {'meta_keys': ['Condition'], 'lower_n': 5}, 'samples': None}
+	path = str(tmp_path / 'expansion{}'.format(extension))
+	assert export.write_artifact(df, path, metadata) == path
+	assert os.listdir(str(tmp_path)) == [os.path.basename(path)]
+
+	for memory_map in (True, False):
+		read_df, read_metadata = export.read_artifact(path, memory_map=memory_map)
+		pd.testing.assert_frame_equal(read_df, df)
+		assert read_metadata == metadata
+
+	# index kept, no metadata -> empty dict
+	indexed_df = df.set_index('Clonotypes')
+	export.write_artifact(indexed_df, path)
+	read_df, read_metadata = export.read_artifact(path)
+	pd.testing.assert_frame_equal(read_df, indexed_df)
+	assert read_metadata == {}
+
+
+def test_toolkits_export(sample_factory, tmp_path):
+	pytest.importorskip('pyarrow')
+	from clonotype_analyses.analyses import ClonotypePreprocessing
+	from clonotype_analyses.analyses import ClonotypeToolkits
+	from clonotype_analyses.common.constants import H5_LAYOUT_VERSION
+
+	infos = [sample_factory('s{}'.format(i), seed=i) for i in range(2)]
+	vdj_path, clinical_path = str(tmp_path / 'vdj.h5'), str(tmp_path / 'clinical.h5')
+	ClonotypePreprocessing(infos).ingest_data(vdj_path, clinical_path)
+	toolkits = ClonotypeToolkits(vdj_path, clinical_path, samples=['s1'])
+
+	path = toolkits.export('clonotypes_expansion', str(tmp_path / 'expansion.arrow'), meta_keys=['Condition'], lower_n=3)
+	read_df, metadata = export.read_artifact(path)
+	pd.testing.assert_frame_equal(read_df, toolkits.plotly_clonotypes_expansion(['Condition'], lower_n=3))
+	assert metadata['analysis'] == 'clonotypes_expansion'
+	assert metadata['params'] == {'meta_keys': ['Condition'], 'lower_n': 3}
+	assert metadata['samples'] == ['s1']
+	assert metadata['layout_version'] == H5_LAYOUT_VERSION
+	assert [i[0] for i in metadata['inputs']] == [os.path.abspath(vdj_path), os.path.abspath(clinical_path)]
+
+	with pytest.raises(Exception, match='cannot find plotly_missing'):
+		toolkits.export('missing', path)
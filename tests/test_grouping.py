@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from clonotype_analyses.common import grouping
+
+
+def _meta_df(seed=0, n_rows=300):
+	rng = np.random.default_rng(seed)
+	return pd.DataFrame({
+		'Condition': pd.Categorical(rng.choice(['B', 'A', 'C'], n_rows), categories=['C', 'B', 'A']),
+		'Subject ID': rng.choice(['p10', 'p2', 'p1'], n_rows).astype('O'),
+		'Age': rng.integers(20, 23, n_rows),
+	})
+
+
+def _naive_labels(df, meta_keys, rows=None):
+	if rows is not None:
+		df = df.iloc[rows]
+	return np.array([
+		grouping.GROUP_SEP.join(str(i) for i in values)
+		for values in zip(*[df[k].values for k in meta_keys])
+	], dtype='O')
+
+
+@pytest.mark.parametrize('meta_keys', [['Condition'], ['Condition', 'Subject ID'], ['Subject ID', 'Age', 'Condition']])
+def test_codes_follow_sorted_labels(meta_keys):
+	df = _meta_df()
+	group_key = grouping.factorize_groups(df, meta_keys)
+	labels = _naive_labels(df, meta_keys)
+
+	assert group_key.name == grouping.GROUP_SEP.join(meta_keys)
+	assert list(group_key.labels) == sorted(set(labels))
+	np.testing.assert_array_equal(group_key.row_labels(), labels)
+	# same rows <-> same code
+	np.testing.assert_array_equal(pd.factorize(group_key.codes)[0], pd.factorize(labels)[0])
+	for i, k in enumerate(meta_keys):
+		values = group_key.level_values(k)
+		assert [str(v) for v in values] == [j.split(grouping.GROUP_SEP)[i] for j in group_key.labels]
+
+
+def test_rows_subset():
+	df = _meta_df(1)
+	rows = np.random.default_rng(1).permutation(len(df))[:50]
+	meta_keys = ['Condition', 'Subject ID']
+	group_key = grouping.factorize_groups(df, meta_keys, rows=rows)
+	labels = _naive_labels(df, meta_keys, rows)
+
+	assert len(group_key.codes) == len(rows)
+	assert list(group_key.labels) == sorted(set(labels))
+	np.testing.assert_array_equal(group_key.row_labels(), labels)
+	# only the groups of the chosen rows, categories of other rows are left out
+	df.loc[df.index.difference(rows), 'Condition'] = 'C'
+	df.loc[rows, 'Condition'] = 'A'
+	group_key = grouping.factorize_groups(df, ['Condition'], rows=rows)
+	assert list(group_key.labels) == ['A']
+	assert list(group_key.level_values('Condition').categories) == ['A']
+
+
+def test_missing_values_form_a_group():
+	df = pd.DataFrame({
+		'Condition': np.array(['B', np.nan, 'A', 'B', np.nan], dtype='O'),
+		'Age': [1.0, 2.0, np.nan, 1.0, 2.0],
+	})
+	group_key = grouping.factorize_groups(df, ['Condition'])
+	assert group_key.n_groups == 3
+	np.testing.assert_array_equal(pd.factorize(group_key.codes)[0], [0, 1, 2, 0, 1])
+	assert group_key.codes[1] == group_key.codes[4]
+
+	group_key = grouping.factorize_groups(df, ['Condition', 'Age'])
+	assert group_key.n_groups == 3
+	np.testing.assert_array_equal(pd.factorize(group_key.codes)[0], [0, 1, 2, 0, 1])
+	assert sorted(group_key.labels) == list(group_key.labels)
+	assert 'A{}nan'.format(grouping.GROUP_SEP) in group_key.labels
+
+	group_key = grouping.factorize_groups(df.astype({'Condition': 'category'}), ['Condition'])
+	assert group_key.n_groups == 3
+	assert group_key.codes[1] == group_key.codes[4]
+
+
+def test_mixed_types_are_compared_as_strings():
+	df = pd.DataFrame({'Batch': np.array([2, 'b1', 10, 'b1'], dtype='O')})
+	group_key = grouping.factorize_groups(df, ['Batch'])
+	assert list(group_key.labels) == [10, 2, 'b1']
+	np.testing.assert_array_equal(group_key.codes, [1, 2, 0, 2])
+
+
+def test_input_is_not_modified():
+	df = _meta_df(2)
+	df.loc[::7, 'Subject ID'] = np.nan
+	expected = df.copy()
+	rows = np.arange(0, len(df), 3)
+	grouping.factorize_groups(df, ['Condition', 'Subject ID', 'Age'])
+	grouping.factorize_groups(df, ['Subject ID'], rows=rows)
+	pd.testing.assert_frame_equal(df, expected)
+	assert list(df['Condition'].cat.categories) == ['C', 'B', 'A']
+
+
+def test_no_meta_keys():
+	with pytest.raises(Exception, match='at least one meta column'):
+		grouping.factorize_groups(_meta_df(), [])
@@ -0,0 +1,106 @@
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+
+from clonotype_analyses.analyses import ClonotypePreprocessing
+from clonotype_analyses.common import h5_store
+from clonotype_analyses.common.constants import ENCODING
+
+
+def _write(path, dfs):
+	with h5py.File(path, 'w') as f:
+		writer = h5_store.H5ColumnWriter(f, 'barcode', compression=None)
+		for i, df in enumerate(dfs):
+			writer.append(df, 'sample_{}'.format(i))
+		writer.close()
+	return h5_store.H5Dataset(path)
+
+
+def _df(n_rows, offset=0, **columns):
+	return pd.DataFrame(columns, index=['bc{}'.format(i + offset) for i in range(n_rows)])
+
+
+def test_int_then_float_promotes(tmp_path):
+	dataset = _write(str(tmp_path / 'a.h5'), [
+		_df(3, Age=np.array([30, 40, 50])),
+		_df(2, 3, Age=np.array([np.nan, 61.5])),
+	])
+	values = dataset.read_column('Age')
+	assert values.dtype == np.float64
+	np.testing.assert_array_equal(values, [30, 40, 50, np.nan, 61.5])
+
+
+def test_int_widened_by_result_type(tmp_path):
+	dataset = _write(str(tmp_path / 'a.h5'), [
+		_df(2, n=np.array([1, 2], dtype=np.int8)),
+		_df(2, 2, n=np.array([1000, 2000], dtype=np.int32)),
+	])
+	values = dataset.read_column('n')
+	assert values.dtype == np.int32
+	np.testing.assert_array_equal(values, [1, 2, 1000, 2000])
+
+
+def test_numeric_then_string_becomes_categorical(tmp_path):
+	path = str(tmp_path / 'a.h5')
+	dataset = _write(path, [
+		_df(2, Age=np.array([30, 40])),
+		_df(2, 2, Age=np.array(['unknown', None], dtype='O')),
+	])
+	with h5py.File(path, 'r') as f:
+		assert h5_store.get_encoding(f, 'Age') == ENCODING.CATEGORICAL.value
+	values = dataset.read_column('Age')
+	assert list(values.astype('O')[:3]) == ['30', '40', 'unknown']
+	assert pd.isna(values[3])
+
+
+def test_missing_column_is_nan(tmp_path):
+	dataset = _write(str(tmp_path / 'a.h5'), [
+		_df(2, Age=np.array([30, 40]), Condition=['A', 'B']),
+		_df(2, 2, Condition=['A', 'A']),
+		_df(1, 4, Age=np.array([50])),
+	])
+	values = dataset.read_column('Age')
+	assert values.dtype == np.float64
+	np.testing.assert_array_equal(values, [30, 40, np.nan, np.nan, 50])
+	# column first seen in a later sample
+	dataset = _write(str(tmp_path / 'b.h5'), [
+		_df(2, Condition=['A', 'B']),
+		_df(1, 2, Age=np.array([50])),
+	])
+	np.testing.assert_array_equal(dataset.read_column('Age'), [np.nan, np.nan, 50])
+
+
+def test_ingest_mixed_clinical_dtypes(tmp_path, sample_factory):
+	batch_info = [
+		sample_factory('s1', seed=1, clinical_columns={'Age': np.arange(40)}),
+		sample_factory('s2', seed=2, clinical_columns={'Age': [np.nan] + list(range(39))}),
+		sample_factory('s3', seed=3, clinical_columns={'Age': ['unknown'] * 40, 'Sex': ['F'] * 40}),
+	]
+	vdj_path, clinical_path = str(tmp_path / 'vdj.h5'), str(tmp_path / 'clinical.h5')
+	ClonotypePreprocessing(batch_info).ingest_data(vdj_path, clinical_path)
+
+	clinical = h5_store.H5Dataset(clinical_path)
+	age = clinical.read_column('Age').astype('O')
+	assert list(age[:2]) == ['0.0', '1.0']
+	assert pd.isna(age[40])
+	assert list(age[-2:]) == ['unknown', 'unknown']
+	sex = clinical.read_column('Sex').astype('O')
+	assert pd.isna(sex[0]) and sex[-1] == 'F'
+
+
+@pytest.mark.parametrize('names', [['', ''], ['s1', ''], ['s1', 's1']])
+def test_sample_names_must_be_unique(sample_factory, names):
+	batch_info = [sample_factory('s{}'.format(i), seed=i) for i in range(len(names))]
+	for info, name in zip(batch_info, names):
+		info['sample_name'] = name
+	with pytest.raises(Exception, match='sample names'):
+		ClonotypePreprocessing(batch_info)
+
+
+def test_writer_rejects_duplicated_sample(tmp_path):
+	with h5py.File(str(tmp_path / 'a.h5'), 'w') as f:
+		writer = h5_store.H5ColumnWriter(f, 'barcode', compression=None)
+		writer.append(_df(1, x=[1]), 's1')
+		with pytest.raises(Exception, match='sample names'):
+			writer.append(_df(1, 1, x=[2]), 's1')
@@ -0,0 +1,95 @@
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+
+from clonotype_analyses.analyses import ClonotypePreprocessing
+from clonotype_analyses.common import h5_store
+
+
+def _naive_rows(values, value):
+	return np.flatnonzero(np.asarray(values, dtype='O') == value)
+
+
+def _random_values(seed, n_rows=500, n_values=30):
+	rng = np.random.default_rng(seed)
+	values = np.array(['CASS{}F'.format(i) for i in rng.integers(0, n_values, n_rows)], dtype='O')
+	values[rng.random(n_rows) < 0.1] = np.nan
+	return values
+
+
+def _check_index(index, values):
+	assert len(index.categories) == len(pd.unique(values[pd.notna(values)]))
+	for value in index.categories:
+		np.testing.assert_array_equal(index.rows([value]), _naive_rows(values, value))
+	np.testing.assert_array_equal(
+		index.rows(['CASS1F', 'CASS2F', 'missing']),
+		np.flatnonzero(np.isin(values, ['CASS1F', 'CASS2F']))
+	)
+	np.testing.assert_array_equal(
+		index.categories[index.row_codes()], values[index.indices]
+	)
+
+
+def test_index_from_values():
+	values = _random_values(0)
+	index = h5_store.InvertedIndex.from_values(values)
+	_check_index(index, values)
+	assert index.codes_of(['missing', index.categories[3]]).tolist() == [-1, 3]
+	assert len(index.rows(['missing'])) == 0
+
+
+def test_append_rows_equals_rebuild():
+	values = _random_values(1)
+	# new values only in the appended rows
+	new_values = np.concatenate([_random_values(2, 200, 40), ['CASS99F']])
+	codes, categories = pd.factorize(np.concatenate([values, new_values]))
+	index = h5_store.InvertedIndex.from_codes(codes[:len(values)], np.zeros(len(categories)))
+	index = index.append_rows(codes[len(values):], len(categories), len(values))
+
+	expected = h5_store.InvertedIndex.from_codes(codes, categories)
+	np.testing.assert_array_equal(index.indptr, expected.indptr)
+	np.testing.assert_array_equal(index.indices, expected.indices)
+
+
+def test_write_update_read_inverted_index(tmp_path):
+	values = _random_values(3)
+	path = str(tmp_path / 'a.h5')
+	with h5py.File(path, 'w') as f:
+		writer = h5_store.H5ColumnWriter(f, 'barcode', compression=None)
+		writer.append(pd.DataFrame({
+			'cdr3': pd.Categorical(values[:300]), 'umis': np.arange(300),
+		}), 's1')
+		writer.close()
+		h5_store.write_inverted_index(f, 'cdr3', compression=None)
+		with pytest.raises(Exception, match='only categorical'):
+			h5_store.write_inverted_index(f, 'umis')
+
+		writer = h5_store.H5ColumnWriter(f, 'barcode', compression=None)
+		writer.append(pd.DataFrame({
+			'cdr3': pd.Categorical(values[300:]), 'umis': np.arange(200),
+		}, index=np.arange(300, 500)), 's2')
+		writer.close()
+		# rows appended after the index was saved -> stale
+		assert h5_store.read_inverted_index(f, 'cdr3') is None
+
+		h5_store.update_inverted_index(f, 'cdr3', compression=None)
+		index = h5_store.read_inverted_index(f, 'cdr3')
+	_check_index(index, values)
+
+	dataset = h5_store.H5Dataset(path, samples=['s2'])
+	np.testing.assert_array_equal(
+		dataset.lookup('cdr3', ['CASS1F']), _naive_rows(values[300:], 'CASS1F')
+	)
+
+
+def test_ingested_index_matches_columns(sample_factory, tmp_path):
+	infos = [sample_factory('s{}'.format(i), seed=i) for i in range(3)]
+	vdj_path, clinical_path = str(tmp_path / 'vdj.h5'), str(tmp_path / 'clinical.h5')
+	ClonotypePreprocessing(infos[:2]).ingest_data(vdj_path, clinical_path)
+	ClonotypePreprocessing(infos[2:]).append_samples(vdj_path, clinical_path)
+
+	with h5py.File(vdj_path, 'r') as f:
+		for col in ('cdr3', 'raw_clonotype_id'):
+			index = h5_store.read_inverted_index(f, col)
+			_check_index(index, np.asarray(h5_store.read_column(f, col), dtype='O'))
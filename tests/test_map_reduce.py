@@ -0,0 +1,77 @@
+import os
+
+import pandas as pd
+import pytest
+
+from clonotype_analyses import analyses
+from clonotype_analyses.analyses import ClonotypePreprocessing
+from clonotype_analyses.analyses import ClonotypeToolkits
+from clonotype_analyses.common import shard_store
+
+
+ANALYSES = {
+	'QC_fraction': lambda toolkits, meta_keys: toolkits._prepare_clonotypes_QC_fraction(meta_keys),
+	'diversity': lambda toolkits, meta_keys: toolkits.clonotypes_diversity(meta_keys),
+	'expansion': lambda toolkits, meta_keys: toolkits.clonotypes_expansion(meta_keys, lower_n=3),
+	'cdr3_length': lambda toolkits, meta_keys: toolkits.cdr3_length(meta_keys, chain='TRB'),
+}
+
+
+@pytest.fixture
+def stores(sample_factory, tmp_path):
+	infos = [sample_factory('s{}'.format(i), n_cells=30 + 10 * i, seed=i) for i in range(3)]
+	paths = ClonotypePreprocessing(infos).ingest_data(str(tmp_path / 'vdj.h5'), str(tmp_path / 'clinical.h5'))
+	shard_dir = str(tmp_path / 'shards')
+	ClonotypePreprocessing(infos).ingest_shards(shard_dir)
+	return paths['10X_VDJ'], paths['clinical_meta'], shard_dir
+
+
+def _assert_same(res, expected):
+	if isinstance(res, tuple):
+		for i, j in zip(res, expected):
+			_assert_same(i, j)
+		return
+	if not isinstance(res, pd.DataFrame):
+		assert res == expected
+		return
+	pd.testing.assert_frame_equal(res.sort_index(), expected.sort_index(), check_dtype=False)
+
+
+@pytest.mark.parametrize('name', list(ANALYSES))
+@pytest.mark.parametrize('meta_keys', [['Condition'], ['sample_name', 'Condition']])
+def test_sharded_equals_monolithic(stores, name, meta_keys):
+	vdj_path, clinical_path, shard_dir = stores
+	expected = ANALYSES[name](ClonotypeToolkits(vdj_path, clinical_path), meta_keys)
+
+	_assert_same(ANALYSES[name](ClonotypeToolkits(shard_dir), meta_keys), expected)
+	# map-reduce over the samples of a single store
+	toolkits = ClonotypeToolkits(vdj_path, clinical_path, n_workers=2)
+	assert toolkits._use_map_reduce()
+	_assert_same(ANALYSES[name](toolkits, meta_keys), expected)
+
+	# subset of samples
+	expected = ANALYSES[name](ClonotypeToolkits(vdj_path, clinical_path, samples=['s0', 's2']), meta_keys)
+	_assert_same(ANALYSES[name](ClonotypeToolkits(shard_dir, samples=['s0', 's2']), meta_keys), expected)
+
+
+def test_samples_only_read_chosen_shards(stores, monkeypatch):
+	_, _, shard_dir = stores
+	paths = {i: (v, c) for i, v, c in shard_store.shard_paths(shard_dir)}
+	# an unreadable shard of another sample is never opened
+	for path in paths['s1']:
+		os.remove(path)
+
+	partitions = []
+	partial_aggregate = analyses._partial_aggregate
+	def _recording_aggregate(partition, method_name, args):
+		partitions.append(partition[:2])
+		return partial_aggregate(partition, method_name, args)
+	monkeypatch.setattr(analyses, '_partial_aggregate', _recording_aggregate)
+
+	toolkits = ClonotypeToolkits(shard_dir, samples=['s2', 's0'])
+	for func in ANALYSES.values():
+		func(toolkits, ['Condition'])
+	# one partial per analysis and chosen shard
+	assert len(partitions) == 2 * len(ANALYSES)
+	assert set(partitions) == {paths['s0'], paths['s2']}
+	assert set(toolkits.meta_columns) == {'Condition', 'sample_name'}
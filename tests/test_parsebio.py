@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+
+from clonotype_analyses.compute import parsebio
+from clonotype_analyses.compute import processing
+
+
+def test_counts_are_integers(parse_factory, tmp_path):
+	info = parse_factory('p1')
+	chunks = list(parsebio.iter_10X_chunks(info['vdj_path'], chunksize=7))
+	assert len(chunks) > 1
+	for chunk in chunks:
+		assert chunk['reads'].dtype == np.int64
+		assert chunk['umis'].dtype == np.int64
+
+	vdj_df = processing.reformat_clonotypes(info['vdj_path'], vdj_format='parsebio')
+	assert vdj_df['umis'].dtype == np.int64
+
+	csv_path = parsebio.convert_to_10X(info['vdj_path'], str(tmp_path / 'p1.csv'), chunksize=7)
+	with open(csv_path) as f:
+		f.readline()
+		assert '.0,' not in f.readline()
+	assert pd.read_csv(csv_path)['umis'].dtype == np.int64
+
+
+def test_contig_ids_span_chunks(parse_factory):
+	info = parse_factory('p1')
+	out_df = pd.concat(list(parsebio.iter_10X_chunks(info['vdj_path'], chunksize=3)))
+	expected = out_df['barcode'] + '_contig_' + (out_df.groupby('barcode').cumcount() + 1).astype(str)
+	assert list(out_df['contig_id']) == list(expected)
@@ -0,0 +1,65 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+from clonotype_analyses.analyses import ClonotypePreprocessing
+from clonotype_analyses.analyses import ClonotypeToolkits
+from clonotype_analyses.common import h5_store
+from clonotype_analyses.compute import processing
+
+
+def _to_airr(info, airr_path, clone_id=True):
+	x = pd.read_csv(info['vdj_path'])
+	airr_df = pd.DataFrame({
+		'sequence_id': x['contig_id'], 'productive': np.where(x['productive'], 'T', 'F'),
+		'v_call': x['v_gene'], 'd_call': x['d_gene'], 'j_call': x['j_gene'], 'c_call': x['c_gene'],
+		'junction_aa': x['cdr3'], 'locus': x['chain'], 'cell_id': x['barcode'], 'umi_count': x['umis'],
+	})
+	if clone_id:
+		airr_df['clone_id'] = x['raw_clonotype_id']
+	airr_df.to_csv(airr_path, sep='\t', index=False)
+	return dict(info, vdj_format='airr', vdj_path=airr_path)
+
+
+def test_airr_matches_10X(sample_factory, tmp_path):
+	info = sample_factory('s1')
+	airr_info = _to_airr(info, str(tmp_path / 's1_airr.tsv.gz'))
+	airr_df = processing.reformat_clonotypes(airr_info['vdj_path'], vdj_format='airr')
+	vdj_df = processing.reformat_clonotypes(info['vdj_path'])
+	assert list(airr_df.index) == list(vdj_df.index)
+	for col in ('chain', 'v_gene', 'cdr3', 'umis', 'raw_clonotype_id', 'productive'):
+		assert list(airr_df[col].astype('O')) == list(vdj_df[col].astype('O')), col
+	assert airr_df['umis'].dtype == vdj_df['umis'].dtype
+
+
+def test_airr_without_clone_id(sample_factory, tmp_path):
+	info = _to_airr(sample_factory('s1'), str(tmp_path / 's1_airr.tsv'), clone_id=False)
+	vdj_df = processing.reformat_clonotypes(info['vdj_path'], vdj_format='airr')
+	cell_key = vdj_df.groupby(level=0).apply(lambda df: tuple(sorted(zip(df['chain'], df['cdr3']))))
+	clonotypes = vdj_df.groupby(level=0)['raw_clonotype_id'].first()
+	# same set of (locus, junction_aa) <-> same clonotype
+	assert cell_key.groupby(clonotypes).nunique().max() == 1
+	assert clonotypes.groupby(cell_key).nunique().max() == 1
+
+
+@pytest.mark.parametrize('order', [('10X', 'airr', 'parsebio'), ('parsebio', '10X', 'airr'), ('airr', 'parsebio', '10X')])
+def test_mixed_cohort_one_ingest(sample_factory, parse_factory, tmp_path, order):
+	infos = {
+		'10X': sample_factory('x10', seed=1),
+		'airr': _to_airr(sample_factory('ai', seed=2), str(tmp_path / 'ai_airr.tsv')),
+		'parsebio': parse_factory('pb', seed=3),
+	}
+	vdj_path, clinical_path = str(tmp_path / 'vdj.h5'), str(tmp_path / 'clinical.h5')
+	ClonotypePreprocessing([infos[i] for i in order]).ingest_data(vdj_path, clinical_path)
+
+	vdj = h5_store.H5Dataset(vdj_path)
+	assert vdj.samples == [infos[i]['sample_name'] for i in order]
+	assert vdj.read_column('umis').dtype == np.int64
+	for fmt, info in infos.items():
+		n_rows = len(processing.reformat_clonotypes(info['vdj_path'], vdj_format=info.get('vdj_format', '10X')))
+		start, end = vdj.sample_offsets[info['sample_name']]
+		assert end - start == n_rows, fmt
+
+	qc_df = ClonotypeToolkits(vdj_path, clinical_path).plotly_clonotypes_QC_fraction(['sample_name'])
+	assert sorted(set(qc_df.index)) == sorted(i['sample_name'] for i in infos.values())
@@ -0,0 +1,178 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from clonotype_analyses.analyses import ClonotypePreprocessing
+from clonotype_analyses.analyses import ClonotypeToolkits
+from clonotype_analyses.common.h5_store import InvertedIndex
+from clonotype_analyses.compute import clonotypes_tracing
+
+
+def _cohort(seed=0, n_rows=2000, n_values=60, n_subjects=8):
+	"""
+	Contigs of a small cohort: few values -> many ties
+	"""
+	rng = np.random.default_rng(seed)
+	return pd.DataFrame({
+		'cdr3': np.array(['CASS{}F'.format(i) for i in rng.integers(0, n_values, n_rows)], dtype='O'),
+		'subject': rng.integers(0, n_subjects, n_rows),
+		'cell': rng.integers(0, n_rows // 2, n_rows),
+		'umis': rng.integers(1, 4, n_rows),
+	})
+
+
+def _naive_scores(contigs_df):
+	grouped = contigs_df.groupby('cdr3', sort=False)
+	return pd.DataFrame({
+		'subjects': grouped['subject'].nunique(),
+		'n_rows': grouped.size(),
+		'cells': grouped['cell'].nunique(),
+		'umis': grouped['umis'].sum().astype(np.float64),
+	})
+
+
+def _scores(contigs_df):
+	index = InvertedIndex.from_values(contigs_df['cdr3'].values)
+	return index, clonotypes_tracing.score_clonotypes(
+		index,
+		contigs_df['subject'].values[index.indices],
+		contigs_df['cell'].values[index.indices],
+		contigs_df['umis'].values[index.indices],
+	)
+
+
+def test_scores_match_naive_counts():
+	contigs_df = _cohort()
+	_, scores_df = _scores(contigs_df)
+	expected = _naive_scores(contigs_df).loc[scores_df.index]
+	pd.testing.assert_frame_equal(scores_df, expected, check_dtype=False, check_names=False)
+
+
+def test_top_k_matches_full_sort():
+	rng = np.random.default_rng(0)
+	for k in (0, 1, 5, 20, 200):
+		scores = rng.integers(0, 5, 100)
+		tie_scores = rng.integers(0, 3, 100)
+		expected = sorted(range(100), key=lambda i: (-scores[i], -tie_scores[i], i))[:k]
+		assert clonotypes_tracing.top_k(scores, k, tie_scores).tolist() == expected
+		expected = sorted(range(100), key=lambda i: (-scores[i], i))[:k]
+		assert clonotypes_tracing.top_k(scores, k).tolist() == expected
+
+
+@pytest.mark.parametrize('rank_by', ['subjects', 'cells', 'umis'])
+def test_public_clonotypes_match_naive_ranking(rank_by):
+	contigs_df = _cohort(1)
+	index, _ = _scores(contigs_df)
+	top_df = clonotypes_tracing.rank_public_clonotypes(
+		index, contigs_df['subject'].values[index.indices], 10, rank_by,
+		contigs_df['cell'].values[index.indices], contigs_df['umis'].values[index.indices],
+	)
+
+	# ties: the other scores in RANK_BY order, n_rows, then order of first appearance
+	naive_df = _naive_scores(contigs_df)
+	tie_columns = [i for i in clonotypes_tracing.RANK_BY if i != rank_by] + ['n_rows']
+	naive_df['position'] = np.arange(len(naive_df))
+	expected = naive_df.sort_values(
+		[rank_by] + tie_columns + ['position'], ascending=[False] * (len(tie_columns) + 1) + [True]
+	).index[:10]
+	assert list(top_df.index) == list(expected)
+	assert np.any(naive_df[rank_by].duplicated())
+
+
+def test_tracing_matches_naive_ratio():
+	contigs_df = _cohort(2)
+	contigs_df['Condition'] = np.where(contigs_df['subject'] < 3, 'A', 'B')
+	tracing_df = clonotypes_tracing.clonotype_tracing(contigs_df, ['Condition'], n_cdr3=5)
+
+	naive_df = _naive_scores(contigs_df)
+	naive_df['position'] = np.arange(len(naive_df))
+	# in-memory tracing groups by Condition
+	naive_df['subjects'] = contigs_df.groupby('cdr3', sort=False)['Condition'].nunique()
+	expected = naive_df.sort_values(
+		['subjects', 'n_rows', 'position'], ascending=[False, False, True]
+	).index[:5]
+	assert list(tracing_df.columns) == list(expected)
+	for cdr3 in expected:
+		ratio = (contigs_df['cdr3'] == cdr3).groupby(contigs_df['Condition']).mean()
+		np.testing.assert_allclose(tracing_df[cdr3].values, ratio.loc[tracing_df.index].values)
+
+
+def test_toolkits_tracing_uses_saved_index(sample_factory, tmp_path):
+	infos = [sample_factory('s{}'.format(i), seed=i) for i in range(3)]
+	vdj_path, clinical_path = str(tmp_path / 'vdj.h5'), str(tmp_path / 'clinical.h5')
+	ClonotypePreprocessing(infos).ingest_data(vdj_path, clinical_path)
+	toolkits = ClonotypeToolkits(vdj_path, clinical_path)
+	tracing_df = toolkits.clonotype_tracing(['Condition'], n_cdr3=3)
+
+	contigs_df = pd.concat([pd.read_csv(i['vdj_path']) for i in infos], ignore_index=True)
+	clinical_df = pd.concat([pd.read_csv(i['clinical_meta_path'], sep='\t') for i in infos], ignore_index=True)
+	contigs_df = contigs_df.merge(clinical_df, on='barcode', how='inner')
+	ratio = lambda cdr3: (contigs_df['cdr3'] == cdr3).groupby(contigs_df['Condition']).mean()
+	for cdr3 in tracing_df.columns:
+		np.testing.assert_allclose(tracing_df[cdr3].values, ratio(cdr3).loc[tracing_df.index].values)
+
+
+def _heavy_stream(seed=0, n_batches=20, n_values=2000):
+	"""
+	Batches of (values, weights): 5 heavy hitters, a long tail of light values
+	"""
+	rng = np.random.default_rng(seed)
+	values = np.array(['v{}'.format(i) for i in range(n_values)], dtype='O')
+	batches = []
+	for _ in range(n_batches):
+		chosen = rng.choice(n_values, 300, replace=False)
+		chosen = np.unique(np.concatenate([np.arange(5), chosen]))
+		weights = np.where(chosen < 5, 50 * (5 - chosen), 1).astype(np.float64)
+		batches.append((values[chosen], weights))
+	totals = pd.concat([pd.Series(w, index=v) for v, w in batches]).groupby(level=0).sum()
+	return batches, totals
+
+
+def test_space_saving_bounds():
+	batches, totals = _heavy_stream()
+	capacity = 100
+	sketch = clonotypes_tracing.SpaceSaving(capacity)
+	for values, weights in batches:
+		sketch.update(values, weights)
+
+	assert len(sketch.values) <= capacity
+	true_counts = totals.loc[sketch.values].values
+	# counts overestimate by at most error
+	assert np.all(sketch.counts >= true_counts)
+	assert np.all(sketch.counts - sketch.errors <= true_counts)
+	# every value above total / capacity is kept
+	frequent = totals.index[totals.values > totals.sum() / capacity]
+	assert set(frequent) <= set(sketch.values)
+	assert list(sketch.top(5).index) == ['v{}'.format(i) for i in range(5)]
+
+
+def test_count_min_bounds():
+	batches, totals = _heavy_stream(1)
+	width, depth = 1 << 10, 4
+	sketch = clonotypes_tracing.CountMinSketch(width, depth, capacity=50)
+	for values, weights in batches:
+		sketch.update(values, weights)
+
+	estimates = sketch.estimate(totals.index.values)
+	assert np.all(estimates >= totals.values)
+	# over-estimate <= e * total / width, except with probability exp(-depth) per value
+	too_large = estimates - totals.values > np.e * totals.sum() / width
+	assert np.mean(too_large) <= 2 * np.exp(-depth)
+	assert list(sketch.top(5).index) == ['v{}'.format(i) for i in range(5)]
+
+
+@pytest.mark.parametrize('method', ['space_saving', 'count_min'])
+def test_approximate_matches_exact_top(method):
+	contigs_df = _cohort(3, n_rows=4000, n_values=40000)
+	# 3 public values in all 8 subjects, other values in at most 4
+	contigs_df.loc[:47, 'cdr3'] = np.tile(['PUB1', 'PUB2', 'PUB3'], 16)
+	contigs_df.loc[:47, 'subject'] = np.repeat(np.arange(8), 6)
+	batches = [
+		clonotypes_tracing.batch_scores(
+			df['cdr3'].values, 'subjects', df['subject'].values
+		)
+		for _, df in contigs_df.groupby('subject')
+	]
+	top_df = clonotypes_tracing.approximate_public_clonotypes(batches, 3, method, capacity=50)
+	assert sorted(top_df.index) == ['PUB1', 'PUB2', 'PUB3']
+	np.testing.assert_array_equal(top_df['score'].values, 8)